@@ -25,6 +25,7 @@ from . import auth
 from . import slide
 from . import dltrain
 from . import dzi
+from . import tile_cache
 from . import delegate
 from . import project_cli
 from . import admin
@@ -80,10 +81,6 @@ def create_app(test_config = None):
         cache_config = {'CACHE_TYPE': 'SimpleCache'}
     cache.init_app(app, config=cache_config)
 
-    # DZI blueprint used in every mode
-    app.register_blueprint(dzi.bp)
-    dzi.init_app(app)
-
     # Configure database
     app.config['DATABASE'] = os.path.join(app.instance_path, 'phas.sqlite')
     
@@ -93,6 +90,120 @@ def create_app(test_config = None):
         os.path.join(app.instance_path, 'oslserver', f'oslserver_{i:02d}.sock') for i in range(n_proc) ]
     app.config['SLIDE_SERVER_CACHE_PAGE_SIZE_MB'] = app.config.get('SLIDE_SERVER_CACHE_PAGE_SIZE_MB', 1)
     app.config['SLIDE_SERVER_CACHE_SIZE_IN_PAGES'] = app.config.get('SLIDE_SERVER_CACHE_SIZE_IN_PAGES', 2048)
+    
+    # Smallest page size that the slide server may use for a slide. The page size of each
+    # slide is chosen from the size of its tiles and adapted to how it is accessed, up
+    # to SLIDE_SERVER_CACHE_PAGE_SIZE_MB (set to the same size to disable). The shared
+    # page cache is divided into units of this size, so small pages take less space
+    app.config['SLIDE_SERVER_MIN_PAGE_SIZE_KB'] = app.config.get('SLIDE_SERVER_MIN_PAGE_SIZE_KB', 64)
+    
+    # Limit on the memory used by all slide server workers for cached pages and open
+    # slides. By default this allows 25% on top of the page cache for open slides
+    app.config['SLIDE_SERVER_MEMORY_LIMIT_MB'] = app.config.get(
+        'SLIDE_SERVER_MEMORY_LIMIT_MB',
+        int(1.25 * app.config['SLIDE_SERVER_CACHE_SIZE_IN_PAGES'] * app.config['SLIDE_SERVER_CACHE_PAGE_SIZE_MB']))
+    
+    # Largest fraction of the memory for pages and open slides that a single slide may use
+    app.config['SLIDE_SERVER_SLIDE_SHARE'] = app.config.get('SLIDE_SERVER_SLIDE_SHARE', 0.5)
+    
+    # File where the slide server periodically writes its memory use (see slide-server-status)
+    app.config['SLIDE_SERVER_STATUS_FILE'] = app.config.get(
+        'SLIDE_SERVER_STATUS_FILE', os.path.join(app.instance_path, 'oslserver', 'status.json'))
+    
+    # Whether the page cache should be a single block of shared memory used by all slide
+    # server workers, rather than a separate cache in each worker
+    app.config['SLIDE_SERVER_SHARED_CACHE'] = app.config.get('SLIDE_SERVER_SHARED_CACHE', True)
+    
+    # Size of the decoded tile cache of each slide that the slide server opens with
+    # OpenSlide, which counts towards SLIDE_SERVER_MEMORY_LIMIT_MB
+    app.config['SLIDE_SERVER_OPENSLIDE_CACHE_MB'] = app.config.get('SLIDE_SERVER_OPENSLIDE_CACHE_MB', 32)
+    
+    # Number of threads in each slide server worker used to decode the tiles of a region
+    app.config['SLIDE_SERVER_DECODE_THREADS'] = app.config.get('SLIDE_SERVER_DECODE_THREADS', 4)
+    
+    # Missing cache pages of a slide that are separated by at most this gap are read 
+    # from GCS with a single ranged request, which also reads the pages in between
+    app.config['SLIDE_SERVER_COALESCE_GAP_KB'] = app.config.get('SLIDE_SERVER_COALESCE_GAP_KB', 1024)
+    
+    # Whether the slide server should load the tiles around each requested DeepZoom
+    # tile of a GCS-hosted slide into the page cache in the background
+    app.config['SLIDE_SERVER_READAHEAD'] = app.config.get('SLIDE_SERVER_READAHEAD', True)
+    
+    # Local disk store for pages of remote slides that are purged from memory, which is
+    # checked before reading from GCS and survives restarts (set size to 0 to disable)
+    app.config['SLIDE_SERVER_L2_CACHE_DIR'] = app.config.get(
+        'SLIDE_SERVER_L2_CACHE_DIR', os.path.join(app.instance_path, 'page_cache'))
+    app.config['SLIDE_SERVER_L2_CACHE_SIZE_MB'] = app.config.get('SLIDE_SERVER_L2_CACHE_SIZE_MB', 16384)
+    
+    # Local disk store for the TIFF structure (IFDs, tile offsets, JPEG tables) of remote
+    # slides, which lets the slide server reopen a slide without reading it from GCS
+    app.config['SLIDE_SERVER_INDEX_CACHE_DIR'] = app.config.get(
+        'SLIDE_SERVER_INDEX_CACHE_DIR', os.path.join(app.instance_path, 'slide_index'))
+    app.config['SLIDE_SERVER_INDEX_CACHE_SIZE_MB'] = app.config.get('SLIDE_SERVER_INDEX_CACHE_SIZE_MB', 1024)
+    
+    # Directory in the resource cache where the synthetic pyramid levels built by
+    # 'flask slides-build-levels' for slides with large gaps between levels are stored
+    app.config['SLIDE_LEVELS_DIR'] = app.config.get(
+        'SLIDE_LEVELS_DIR', os.path.join(app.instance_path, 'resource_cache', 'levels'))
+    
+    # Size of the shared memory block through which each uwsgi process receives pixel
+    # data from the slide server (set to 0 to send pixels over the socket instead)
+    app.config['SLIDE_SERVER_SHM_SIZE_MB'] = app.config.get('SLIDE_SERVER_SHM_SIZE_MB', 32)
+    
+    # How long (in seconds) uwsgi processes wait to connect to the slide server and for
+    # each of its responses before giving up on the request
+    app.config['SLIDE_SERVER_TIMEOUT'] = app.config.get('SLIDE_SERVER_TIMEOUT', 120)
+    
+    # How long (in seconds) uwsgi processes may reuse the geometry of a remote slide
+    # before asking the slide server to describe it again
+    app.config['SLIDE_SERVER_DESCRIPTOR_TTL'] = app.config.get('SLIDE_SERVER_DESCRIPTOR_TTL', 300)
+    
+    # Whether DeepZoom tiles of slides stored as square JPEG tiles should be aligned
+    # with the stored tiles and sent to the browser without decoding and re-encoding.
+    # The DZI descriptors of these slides advertise JPEG tiles unless the viewer asks
+    # for another format, which keeps the default DeepZoom geometry
+    app.config['SLIDE_SERVER_JPEG_PASSTHROUGH'] = app.config.get('SLIDE_SERVER_JPEG_PASSTHROUGH', True)
+
+    # Memory available in each uwsgi process for caching DeepZoom geometry
+    app.config['DZI_GEOMETRY_CACHE_SIZE_MB'] = app.config.get('DZI_GEOMETRY_CACHE_SIZE_MB', 16)
+
+    # Format of the DeepZoom tiles requested by the viewer, unless the DZI descriptor is
+    # requested with a 'format' parameter (jpeg, png, webp or avif). The codec negotiation
+    # and quality settings below only apply to JPEG tiles, lossless PNG tiles ignore them.
+    # The viewer requests overlays as PNG, since they may be transparent
+    app.config['DZI_TILE_FORMAT'] = app.config.get('DZI_TILE_FORMAT', 'jpeg')
+    
+    # More compact codecs that are sent instead of JPEG tiles to browsers that accept
+    # them, in order of preference (AVIF is smaller than WebP but much slower to encode)
+    app.config['DZI_TILE_NEGOTIATE_FORMATS'] = app.config.get('DZI_TILE_NEGOTIATE_FORMATS', ['webp'])
+    
+    # Whether tiles passed through from the stored JPEG tiles are also sent in the more
+    # compact codecs. This saves bandwidth at the cost of decoding and encoding each tile
+    app.config['DZI_TILE_NEGOTIATE_PASSTHROUGH'] = app.config.get('DZI_TILE_NEGOTIATE_PASSTHROUGH', False)
+    
+    # Quality of lossy tiles at and near full resolution and at low zoom, where low zoom
+    # means at least DZI_TILE_LOW_ZOOM_LEVELS halvings below full resolution. Projects
+    # and tasks can override the qualities with a 'tile-quality' entry in their JSON
+    app.config['DZI_TILE_QUALITY'] = app.config.get('DZI_TILE_QUALITY', 75)
+    app.config['DZI_TILE_QUALITY_LOW_ZOOM'] = app.config.get('DZI_TILE_QUALITY_LOW_ZOOM', 60)
+    app.config['DZI_TILE_LOW_ZOOM_LEVELS'] = app.config.get('DZI_TILE_LOW_ZOOM_LEVELS', 2)
+
+    # Cache-Control of tiles and slide images, which carry an ETag derived from the slide
+    # version. Tiles are only shared with other users if the caching policy is public,
+    # which is only safe if the proxy or CDN that caches them enforces access control
+    app.config['DZI_TILE_CACHE_CONTROL'] = app.config.get('DZI_TILE_CACHE_CONTROL', 'private, max-age=604800')
+    
+    # Cache-Control of DZI descriptors and slide headers, which browsers revalidate on
+    # every use, receiving a 304 response if the slide has not changed
+    app.config['DZI_METADATA_CACHE_CONTROL'] = app.config.get('DZI_METADATA_CACHE_CONTROL', 'private, no-cache')
+
+    # Size of the on-disk cache of encoded DeepZoom tiles (set to 0 to disable)
+    app.config['DZI_TILE_CACHE_SIZE_MB'] = app.config.get('DZI_TILE_CACHE_SIZE_MB', 4096)
+
+    # DZI blueprint used in every mode
+    app.register_blueprint(dzi.bp)
+    dzi.init_app(app)
+    tile_cache.init_app(app)
 
     # Database connection
     db.init_app(app)
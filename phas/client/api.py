@@ -2,6 +2,7 @@ from ..slide import *
 from .. import create_app
 import requests
 import json
+import zipfile
 import pandas as pd
 from urllib.parse import urlparse
 from io import StringIO, BytesIO
@@ -14,6 +15,7 @@ from ..dltrain import get_sampling_rois, make_sampling_roi_image, get_labelset_f
 from ..dltrain import create_sampling_roi, sampling_roi_delete_on_slice, compute_sampling_roi_bounding_box, draw_sampling_roi
 from ..dltrain import spatial_transform_roi, get_samples, get_sample_png
 from ..dzi import dzi_download_nii_gz, dzi_slide_dimensions, dzi_slide_filepath, get_patch_endpoint, dzi_download_header
+from ..dzi import get_patches_endpoint
 
 from warnings import simplefilter
 from urllib3.exceptions import InsecureRequestWarning
@@ -571,26 +573,42 @@ class Slide:
             return Image.open(BytesIO(r.content))
         
         else:            
-            # Break the image region into tiles
-            full_image = None
+            # Break the image region into tiles, which are all fetched in one request
             tiles_x, tiles_y = np.arange(0, size[0], tile_size), np.arange(0, size[1], tile_size)
             scale = self.level_downsamples[level]
+            patches, origins = [], []
             for x in tiles_x:
                 w = np.minimum(size[0] - x, tile_size)
                 cx = center[0] + scale * (x - 0.5 * (size[0] - w))
                 for y in tiles_y:
                     h = np.minimum(size[1] - y, tile_size)
                     cy = center[1] + scale * (y - 0.5 * (size[1] - h))
-                    r = self.client._get('dzi', get_patch_endpoint, 
-                                 project=self.project, slide_id=self.slide_id, resource='raw',
-                                 level=level, ctrx=cx, ctry=cy, w=w, h=h, format='png')
-                    tile = Image.open(BytesIO(r.content))
-                    print(f'Requesting region with center {cx, cy} size {w,h} from image, tile {tile} pasting at {x,y}')
-                    if full_image is None:
-                        full_image = Image.new(tile.mode, (size[0], size[1]))
-                    full_image.paste(tile, (x, y))
+                    patches.append((int(cx), int(cy), int(w), int(h)))
+                    origins.append((int(x), int(y)))
+                    
+            full_image = None
+            for tile, (x, y) in zip(self.get_patches(patches, level), origins):
+                if full_image is None:
+                    full_image = Image.new(tile.mode, (size[0], size[1]))
+                full_image.paste(tile, (x, y))
             return full_image
         
+    def get_patches(self, patches, level):
+        """Read a batch of regions from the slide in a single request.
+        
+        Args:
+            patches: List of tuples (cx, cy, w, h) giving the center of each patch in full-resolution
+                pixel units and the size of the patch at the requested level.
+            level: Downsample level from which to retrieve the regions.
+        Returns:
+            List of PIL Images containing the requested regions
+        """
+        r = self.client._post('dzi', get_patches_endpoint, json={'patches': patches},
+                              project=self.project, slide_id=self.slide_id, resource='raw',
+                              level=level, format='png')
+        with zipfile.ZipFile(BytesIO(r.content)) as zf:
+            return [ Image.open(BytesIO(zf.read(name))) for name in sorted(zf.namelist()) ]
+        
     def _get_header(self):        
         if self._header is None:
             self._header = self.client._get('dzi', dzi_slide_dimensions, project=self.project, slide_id=self.slide_id).json()
@@ -764,6 +782,32 @@ class SamplingROIPatchExtractor:
         # Return the two images
         return patch, mask_canvas_padded
     
+    def get_tile_patches_and_masks(self, tile_indices):
+        """
+        Download padded tiles and ROI masks for a list of tiles. The patches are fetched from
+        the server in a single request, which is much faster than calling `get_tile_patch_and_mask`
+        for each tile.
+
+        Args:
+            tile_indices (list): List of tile indices, each must be one of the rows of the array returned by `tiles()`
+
+        Returns:
+            List of tuples `image`,`mask`, as returned by `get_tile_patch_and_mask`.
+        """
+        tile_size_pad = self.tile_size + 2 * self.padding
+        patch_xy = [ np.array((self.tx, self.ty)) + np.array(t) * self.tile_size for t in tile_indices ]
+        patch_req = [ (*(xy + self.tile_size//2).tolist(), tile_size_pad, tile_size_pad) for xy in patch_xy ]
+        patches = self.slide.get_patches(patch_req, 0) if len(patch_req) > 0 else []
+        
+        result = []
+        for patch, xy in zip(patches, patch_xy):
+            mask_canvas_padded = Image.new('L', (tile_size_pad, tile_size_pad))
+            mask_canvas_inner = Image.new('L', (self.tile_size, self.tile_size))
+            draw_sampling_roi(mask_canvas_inner, self.translate_geom(self.geom, -xy[0], -xy[1]), 1, 1, fill='white')
+            mask_canvas_padded.paste(mask_canvas_inner, (self.padding, self.padding))
+            result.append((patch.convert("RGB"), mask_canvas_padded))
+        return result
+    
     def tile_patch_origin(self, tile_index):
         """
         Compute the origin (per ITK) of the patch returned by `get_tile_patch_and_mask`
@@ -23,10 +23,12 @@ from werkzeug.exceptions import abort
 from io import BytesIO
 import os
 import json
+import math
 import time
 import numpy as np
 import urllib
 import psutil
+import httpx
 
 from random import randint
 
@@ -36,6 +38,8 @@ from .slideref import SlideRef,get_slide_ref,get_project_task_slide_ref
 from .project_ref import ProjectRef, TaskRef
 from .auth import access_slide_read, access_slide_admin, access_task_slide_read, access_task_slide_admin
 from .common import cache
+from .db import get_db
+from .tile_cache import encoded_tile_cache, LocalDiskCache, WriteBehindDiskCache
 from google.cloud import storage
 
 bp = Blueprint('dzi', __name__)
@@ -45,16 +49,29 @@ import numpy
 from flask.cli import with_appcontext
 import nibabel as nib
 import gzip
-from PIL import Image
+import zipfile
+from PIL import Image, features
 import socket
 import pickle
 from datetime import datetime
 
 import socketserver
+import threading
+import hashlib
+import functools
+import atexit
+import bisect
+import weakref
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory, resource_tracker
+import traceback
+import concurrent.futures
 import multiprocessing
-import ctypes
-from .gcs_handler import GoogleCloudOpenSlideWrapper, MultiprocessManagedMultiFilePageCache
-from sortedcontainers import SortedKeyList
+import queue
+from .gcs_handler import (RemoteOpenSlideWrapper, AbstractStreamOpenSlideWrapper, open_byte_range_source, get_url_version,
+                          SelfManagedMultiFilePageCache, MultiprocessManagedMultiFilePageCache, SharedSlabPageCache, MemoryUsageReporter)
+from .slide_levels import (SyntheticLevelsSlide, open_synthetic_levels, plan_synthetic_levels, build_synthetic_levels,
+                           load_synthetic_levels_manifest, synthetic_levels_path)
 
 
 # The function that is enqueued in RQ
@@ -142,27 +159,68 @@ def dzi_slide_filepath(project, slide_id):
          "local": sr.get_resource_url('raw', True) })
 
 
+# Compute a strong ETag for a response that is derived from a version of a slide. The
+# ETag covers the slide URL and version and all the parameters that affect the response.
+# Returns None if the version of the slide is not known
+def slide_etag(url, version, *params):
+    if version is None:
+        return None
+    return hashlib.sha1(repr((url, version) + params).encode('utf-8')).hexdigest()
+
+
+# Add the validator and caching policy for a response with the given ETag
+def with_cache_headers(resp, etag, cache_control):
+    if etag is not None:
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+# Return a 304 response if the browser already has the current version of a response,
+# or None if the response has to be computed. This is checked before any slide I/O
+def not_modified_response(etag, cache_control):
+    if etag is None or request.method != 'GET' or not request.if_none_match.contains(etag):
+        return None
+    return with_cache_headers(make_response('', 304), etag, cache_control)
+
+
 # Get the DZI for a slide
 @bp.route('/dzi/<mode>/<project>/<int:slide_id>/<resource>.dzi', methods=('GET', 'POST'))
 @access_slide_read()
 def dzi(mode, project, slide_id, resource):
-    from openslide.deepzoom import DeepZoomGenerator
 
     # Get a project reference, using either local database or remotely supplied dict
     pr, sr = dzi_get_project_and_slide_ref(project, slide_id)
-    # tiff_file = sr.get_local_copy(resource, check_hash=True)
-    tiff_file = sr.get_resource_url(resource, False)
 
     # Get an affine transform if that is an option
     A = get_affine_matrix(sr, mode, resource, 'image')
 
+    url = get_slide_resource_url_cached(project, slide_id, resource)
+    if url is None:
+        abort(404, 'bad slide/resource')
+        
+    # The descriptor only changes with the version of the slide and with the settings
+    # that choose its format and geometry, which are checked before any slide I/O
+    cache_control = current_app.config['DZI_METADATA_CACHE_CONTROL']
+    etag = slide_etag(url, get_slide_version(url), 'dzi', resource, request.args.get('format'),
+                      *dz_settings())
+    resp = not_modified_response(etag, cache_control)
+    if resp is not None:
+        return resp
+    
+    # The tile format can be chosen by the viewer, and is carried over to the tile URLs
+    osa = OpenSlideThinInterface(url, current_app.config['SLIDE_SERVER_ADDR'])
+    format = request.args.get('format', get_default_tile_format(osa)).lower()
+    if format not in tile_codecs:
+        abort(404, 'bad format')
+
     # Load the slide
-    osa = get_osl(slide_id, sr, resource)
-    dz = DeepZoomGenerator(osa)
-    dz.filename = os.path.basename(tiff_file)
-    resp = make_response(dz.get_dzi('png'))
+    dz = get_dz_generator_cached(project, slide_id, resource, format)
+    if dz is None:
+        abort(404, 'bad slide/resource')
+    resp = make_response(dz.get_dzi(format))
     resp.mimetype = 'application/xml'
-    return resp
+    return with_cache_headers(resp, etag, cache_control)
 
 
 # Generate a 2D NIFTI.GZ image from a PIL image
@@ -300,23 +358,255 @@ class PILBytesIO(BytesIO):
         raise AttributeError('Not supported')
 
 
-# Get the Deep Zoom generator for a slide. The output of this function is cached
-# in order to speed up tile retrieval and minimize database access. The user_id is
-# passed in order to have separate caches for different users (since different users
-# may have different view/access to the same slide)
-@cache.memoize(50)
-def get_dz_generator_cached(user_id, project, slide_id, resource):
+# Get the URL of a slide resource. The output of this function is cached in order to
+# minimize database access when serving tiles. It does not depend on the user, since
+# access to the slide is checked separately by access_slide_read
+@cache.memoize(300)
+def get_slide_resource_url_cached(project, slide_id, resource):
+    _, sr = dzi_get_project_and_slide_ref(project, slide_id)
+    return sr.get_resource_url(resource, False) if sr is not None else None
+
+
+# Clients for reading the metadata of remote slides in this process, created on demand
+slide_metadata_clients = {}
+
+
+# Get the version of a remote slide from the metadata of its file. The output of this 
+# function is cached like the slide URLs, so that it costs one metadata request per slide
+# every few minutes rather than one per tile
+@cache.memoize(300)
+def get_remote_slide_version_cached(url):
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme == 'gs' and 'gs' not in slide_metadata_clients:
+        slide_metadata_clients['gs'] = storage.Client()
+    elif scheme in ('http', 'https') and 'http' not in slide_metadata_clients:
+        slide_metadata_clients['http'] = httpx.Client(follow_redirects=True, timeout=10.0)
+    return get_url_version(url, slide_metadata_clients.get('gs'), slide_metadata_clients.get('http'))
+
+
+# Get the version of a slide without any slide I/O, i.e., without asking the slide server.
+# This is the blob generation of slides on GCS, the ETag of slides on HTTP servers and the
+# modification time of local files, which are checked on every call since this is cheap.
+# Responses that are derived from the slide are validated against this version
+def get_slide_version(url):
+    if urllib.parse.urlparse(url).scheme in ('gs', 'http', 'https'):
+        return get_remote_slide_version_cached(url)
+    return get_url_version(url)
+
+
+class DeepZoomGeometryCache:
+    """
+    A per-process cache of DeepZoom generators, which hold the geometry of the DeepZoom
+    pyramid and its mapping onto the slide levels. Generators are keyed by slide URL, 
+    resource and slide version, and do not depend on the user, so all users viewing a
+    slide share one generator. The cache is bounded by the total size of the entries 
+    in bytes and evicts the least recently used entries.
+    """
+    
+    def __init__(self, max_bytes=16 * 1024**2):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, key, fn_create):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+            
+        # Create the entry and estimate its size from its pickled representation
+        value = fn_create()
+        n_bytes = len(pickle.dumps(value))
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, n_bytes)
+                self.total_bytes += n_bytes
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, n_evict) = self._entries.popitem(last=False)
+                self.total_bytes -= n_evict
+        return value
+    
+
+# DeepZoom geometry cache shared by all users in this process
+dz_geometry_cache = DeepZoomGeometryCache()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical computations. The first caller for a key runs the
+    computation, and callers that ask for the same key while it is in flight wait for
+    it and share its result, or its exception. Nothing is kept once the computation
+    completes, so this only merges requests that overlap in time.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.n_coalesced = 0
+        
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.n_coalesced += 1
+                leader = False
+            else:
+                self._calls[key] = call = concurrent.futures.Future()
+                leader = True
+        if not leader:
+            return call.result()
+        
+        # Run the computation and hand its outcome to the callers that are waiting
+        try:
+            result = fn()
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+    
+
+# Requests for DeepZoom tiles that are in flight in this process
+dz_tile_flights = SingleFlight()
+
+
+# Parameters of the DeepZoom pyramid. The DZI descriptors generated in uwsgi and the 
+# tiles generated by the slide server must use the same values
+dz_params = { 'tile_size': 254, 'overlap': 1, 'limit_bounds': False }
+
+
+# Size of the stored JPEG tiles of a slide that DeepZoom JPEG tiles can be aligned with,
+# or None if the slide's tiles can't be passed through to the browser
+def get_passthrough_tile_size(osa):
+    if not current_app.config.get('SLIDE_SERVER_JPEG_PASSTHROUGH', True):
+        return None
+    return osa.describe().get('jpeg_tile_size')
+
+
+# Get the tile format advertised by the DZI descriptor of a slide when the viewer does
+# not ask for one. Slides whose stored JPEG tiles can be passed through get JPEG tiles
+def get_default_tile_format(osa):
+    return 'jpeg' if get_passthrough_tile_size(osa) else current_app.config['DZI_TILE_FORMAT']
+
+
+# Settings that decide the format and geometry of the DeepZoom tiles of a slide together
+# with its version. These are part of the ETags of the descriptors and tiles
+def dz_settings():
+    return (current_app.config.get('SLIDE_SERVER_JPEG_PASSTHROUGH', True), current_app.config['DZI_TILE_FORMAT'],
+            current_app.config['DZI_TILE_NEGOTIATE_PASSTHROUGH'], current_app.config['DZI_TILE_LOW_ZOOM_LEVELS'])
+
+
+# Get the DeepZoom parameters for a slide and tile format. When JPEG tiles are served 
+# for a slide stored as square JPEG tiles, the DeepZoom tiles are aligned with the stored
+# tiles, so the slide server can send the stored JPEG streams without decoding and
+# re-encoding them. Other formats keep the default geometry
+def get_dz_params(osa, format='jpeg'):
+    jpeg_tile_size = get_passthrough_tile_size(osa)
+    if jpeg_tile_size and format == 'jpeg':
+        return { 'tile_size': jpeg_tile_size, 'overlap': 0, 'limit_bounds': False }
+    return dz_params
+
+
+# Get the Deep Zoom generator for a slide and tile format. The generator is shared between users
+def get_dz_generator_cached(project, slide_id, resource, format='jpeg'):
     from openslide.deepzoom import DeepZoomGenerator
     
-    # Get a project reference, using either local database or remotely supplied dict
-    _, sr = dzi_get_project_and_slide_ref(project, slide_id)
-   
-    # Get the raw SVS/tiff file for the slide (the resource should exist, 
-    # or else we will spend a minute here waiting with no response to user)
-    # tiff_file = sr.get_local_copy(resource)
-    os = get_osl(slide_id, sr, resource) if sr is not None else None
-    dz = DeepZoomGenerator(os) if os is not None else None
-    return dz
+    # Get the URL of the slide (the resource should exist, or else we will 
+    # spend a minute here waiting with no response to user)
+    url = get_slide_resource_url_cached(project, slide_id, resource)
+    if url is None:
+        return None
+    
+    osa = OpenSlideThinInterface(url, current_app.config['SLIDE_SERVER_ADDR'])
+    params = get_dz_params(osa, format)
+    return dz_geometry_cache.get((url, resource, osa.version, tuple(params.values())), 
+                                 lambda: DeepZoomGenerator(osa, **params))
+
+
+# Downsample of each DeepZoom level relative to the slide level that its tiles are read
+# from. DeepZoomGenerator keeps these internally, so they are computed here in the same
+# way from the public properties of the slide. They don't depend on the tile size or the
+# overlap. Levels with a downsample of 1 are slide levels at full resolution
+def dz_level_downsamples(osl):
+    z_size, n_levels = tuple(osl.level_dimensions[0]), 1
+    while z_size[0] > 1 or z_size[1] > 1:
+        z_size = tuple(max(1, math.ceil(z / 2)) for z in z_size)
+        n_levels += 1
+    l0_z = [ 2 ** (n_levels - z - 1) for z in range(n_levels) ]
+    return [ d / osl.level_downsamples[osl.get_best_level_for_downsample(d)] for d in l0_z ]
+
+
+# Map a DeepZoom tile onto the slide using the public API of DeepZoomGenerator. Returns
+# the read_region arguments of the tile, i.e., its location in level 0, the slide level
+# and its size in the slide level, and the size of the tile in the DeepZoom level
+def dz_tile_region(dz, level, col, row):
+    return dz.get_tile_coordinates(level, (col, row)), dz.get_tile_dimensions(level, (col, row))
+
+
+# Whether the JPEG tiles of a DeepZoom level are passed through from the stored JPEG
+# tiles of a slide, i.e., the tiles are aligned with the stored tiles and the level is 
+# a slide level at full resolution. The slide server describes the levels that it reads
+# DeepZoom tiles from, including synthetic levels, so this is decided from the same
+# levels as in the slide server
+def is_passthrough_level(osa, level, params):
+    if params['overlap'] != 0 or params['limit_bounds'] or params['tile_size'] != get_passthrough_tile_size(osa):
+        return False
+    ds = osa.describe().get('dz_level_downsamples', [])
+    return 0 <= level < len(ds) and ds[level] == 1
+
+
+# Mime types of the formats in which DeepZoom tiles can be encoded
+tile_formats = { 'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp', 'avif': 'image/avif' }
+
+# Tile formats that can be encoded by the installed Pillow
+tile_codecs = [ f for f in tile_formats if f in ('jpeg', 'png') or features.check(f) ]
+
+
+# Choose the codec of a JPEG tile. Tiles that are lossy anyway are sent in a more
+# compact codec if the browser accepts it, in the order of DZI_TILE_NEGOTIATE_FORMATS.
+# Tiles that are passed through from the stored JPEG tiles stay JPEG, since re-encoding
+# them costs a decode and an encode for each tile, unless DZI_TILE_NEGOTIATE_PASSTHROUGH
+def negotiate_tile_format(format, passthrough=False):
+    if format != 'jpeg':
+        return format
+    if passthrough and not current_app.config['DZI_TILE_NEGOTIATE_PASSTHROUGH']:
+        return format
+    for f in current_app.config['DZI_TILE_NEGOTIATE_FORMATS']:
+        if f in tile_codecs and any(m == tile_formats[f] and q > 0 for m, q in request.accept_mimetypes):
+            return f
+    return format
+
+
+# Get the qualities of lossy tiles for a project and task, which can be set in the 
+# 'tile-quality' entry of the project and of the task. The output of this function is 
+# cached, like the slide URLs, so that serving tiles does not access the database
+@cache.memoize(300)
+def get_tile_quality_settings(project, task_id):
+    quality = { 'full': current_app.config['DZI_TILE_QUALITY'], 
+                'low-zoom': current_app.config['DZI_TILE_QUALITY_LOW_ZOOM'] }
+    quality.update(dzi_get_project_ref(project).get_dict().get('tile-quality', {}))
+    if task_id is not None and current_app.config['HISTOANNOT_SERVER_MODE'] != 'dzi_node':
+        try:
+            tr = TaskRef(task_id)
+            if tr.project == project:
+                quality.update(tr.data.get('tile-quality', {}))
+        except ValueError:
+            pass
+    return quality
+
+
+# Get the quality of the lossy encoding of a DeepZoom tile. Levels that are at least
+# DZI_TILE_LOW_ZOOM_LEVELS halvings below full resolution use the low-zoom quality
+def get_tile_quality(project, task_id, dimensions, level):
+    quality = get_tile_quality_settings(project, task_id)
+        
+    # The full resolution DeepZoom level is the number of halvings to reach a 1x1 image
+    max_level = (max(dimensions) - 1).bit_length()
+    return quality['low-zoom' if max_level - level >= current_app.config['DZI_TILE_LOW_ZOOM_LEVELS'] else 'full']
 
 
 # Get the tiles for a slide
@@ -325,24 +615,63 @@ def get_dz_generator_cached(user_id, project, slide_id, resource):
 @access_slide_read()
 def tile_db(mode, project, slide_id, resource, level, col, row, format):
     format = format.lower()
-    if format != 'jpeg' and format != 'png':
+    if format not in tile_codecs:
         # Not supported by Deep Zoom
         abort(404, 'bad format')
 
-    # Get a project reference, using either local database or remotely supplied dict
-    dz = get_dz_generator_cached(g.user, project, slide_id, resource)
-    if dz is None:
+    # Get the URL of the slide, using either local database or remotely supplied dict
+    url = get_slide_resource_url_cached(project, slide_id, resource)
+    if url is None:
         abort(404, 'bad slide/resource')
         
-    tile = dz.get_tile(level, (col, row))
-
-    buf = PILBytesIO()
-    tile.save(buf, format, quality=75)
-    resp = make_response(buf.getvalue())
-    resp.mimetype = 'image/%s' % format
+    # The browser may already have the tile, which never changes for a slide version.
+    # The ETag is computed from the request and the settings without any slide I/O: 
+    # the codec is decided by the Accept header and the settings once the slide is known
+    task_id = request.args.get('task_id', type=int)
+    cache_control = current_app.config['DZI_TILE_CACHE_CONTROL']
+    etag = slide_etag(url, get_slide_version(url), resource, level, col, row, format, 
+                      negotiate_tile_format(format), *dz_settings(),
+                      tuple(sorted(get_tile_quality_settings(project, task_id).items())))
+    resp = not_modified_response(etag, cache_control)
+    if resp is not None:
+        if format == 'jpeg':
+            resp.vary.add('Accept')
+        return resp
+    
+    # Check the encoded tile cache, which is keyed by slide version and by the codec
+    # and quality of the tile
+    osa = OpenSlideThinInterface(url, current_app.config['SLIDE_SERVER_ADDR'])
+    params = get_dz_params(osa, format)
+    passthrough = format == 'jpeg' and is_passthrough_level(osa, level, params)
+    requested_format, format = format, negotiate_tile_format(format, passthrough)
+    quality = get_tile_quality(project, task_id, osa.dimensions, level)
+    key = (url, osa.version, resource, level, col, row, format, quality, tuple(params.values()))
+    
+    # Concurrent requests for the same tile in this process share one lookup
+    tile = dz_tile_flights.do(key, lambda: get_encoded_dz_tile(osa, key, params))
+    resp = with_cache_headers(make_response(tile), etag, cache_control)
+    resp.mimetype = tile_formats[format]
+    if requested_format == 'jpeg':
+        resp.vary.add('Accept')
     return resp
 
 
+# Get an encoded DeepZoom tile from the encoded tile cache, or have the slide server
+# compute and encode it. The key is the encoded tile cache key of the tile
+def get_encoded_dz_tile(osa, key, params):
+    tile = encoded_tile_cache.get(key)
+    if tile is None:
+        _, _, _, level, col, row, format, quality, _ = key
+        try:
+            tile = osa.get_dz_tile(level, col, row, format, quality, **params)
+        except SlideServerError as e:
+            if e.error_type == 'ValueError':
+                abort(404, 'bad tile address')
+            raise
+        encoded_tile_cache.put(key, tile)
+    return tile
+
+
 # Method to actually get a patch
 def get_patch(project, slide_id, resource, level, ctrx, ctry, w, h, format):
     format = format.lower()
@@ -358,7 +687,7 @@ def get_patch(project, slide_id, resource, level, ctrx, ctry, w, h, format):
     x = ctrx - int(w * 0.5 * os.level_downsamples[level])
     y = ctry - int(h * 0.5 * os.level_downsamples[level])
 
-    tile = os.read_region((x, y), level, (w, h));
+    tile = os.read_region((x, y), level, (w, h), mode='RGB' if format == 'jpeg' else 'RGBA')
 
     # Convert to PNG
     buf = PILBytesIO()
@@ -368,6 +697,37 @@ def get_patch(project, slide_id, resource, level, ctrx, ctry, w, h, format):
     return resp
 
 
+# Method to get a batch of patches from a slide in a single call to the slide server. 
+# Patches are given as a list of (ctrx, ctry, w, h) tuples and returned as a ZIP
+# archive of images named patch_00000.<format>, patch_00001.<format>, etc.
+def get_patches(project, slide_id, resource, level, patches, format):
+    format = format.lower()
+    if format != 'jpeg' and format != 'png':
+        # Not supported by Deep Zoom
+        return 'bad format'
+
+    # Get a project reference, using either local database or remotely supplied dict
+    pr, sr = dzi_get_project_and_slide_ref(project, slide_id)
+    os = get_osl(slide_id, sr, resource)
+
+    # Work out the offsets and read all the regions at once
+    ds = os.level_downsamples[level]
+    regions = [ ((int(ctrx - int(w * 0.5 * ds)), int(ctry - int(h * 0.5 * ds))), level, (int(w), int(h)))
+                for (ctrx, ctry, w, h) in patches ]
+    tiles = os.read_regions(regions, mode='RGB' if format == 'jpeg' else 'RGBA')
+
+    # Pack the images into an uncompressed archive
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        for i, tile in enumerate(tiles):
+            tile_buf = PILBytesIO()
+            tile.save(tile_buf, format)
+            zf.writestr(f'patch_{i:05d}.{format}', tile_buf.getvalue())
+    resp = make_response(buf.getvalue())
+    resp.mimetype = 'application/zip'
+    return resp
+
+
 # Method to get a patch sampled at random
 def get_random_patch(project, slide_id, resource, level, w, format):
     format = format.lower()
@@ -383,7 +743,7 @@ def get_random_patch(project, slide_id, resource, level, w, format):
     # Work out the offset
     cx = randint(0, int(os.level_dimensions[level][0] - w * os.level_downsamples[level]))
     cy = randint(0, int(os.level_dimensions[level][1] - w * os.level_downsamples[level]))
-    tile = os.read_region((cx, cy), level, (w, w))
+    tile = os.read_region((cx, cy), level, (w, w), mode='RGB' if format == 'jpeg' else 'RGBA')
 
     # Convert to PNG
     buf = PILBytesIO()
@@ -401,6 +761,15 @@ def get_patch_endpoint(project, slide_id, resource, level, ctrx, ctry, w, h, for
     return get_patch(project, slide_id, resource, level, ctrx, ctry, w, h, format)
 
 
+# Get a batch of image patches from the raw image. The patches are passed in the
+# request body as JSON {"patches": [[ctrx, ctry, w, h], ...]}
+@bp.route('/dzi/patches/<project>/<int:slide_id>/<resource>/<int:level>.<format>', methods=('POST',))
+@access_slide_read()
+def get_patches_endpoint(project, slide_id, resource, level, format):
+    patches = request.get_json(force=True).get('patches', [])
+    return get_patches(project, slide_id, resource, level, patches, format)
+
+
 # Get an image patch at level 0 from the raw image
 @bp.route('/dzi/random_patch/<project>/<int:slide_id>/<resource>/<int:level>/<int:width>.<format>',
         methods=('GET','POST'))
@@ -418,6 +787,13 @@ def dzi_download_thumblike_image(project, slide_id, resource, extension):
     # Get a project reference, using either local database or remotely supplied dict
     pr, sr = dzi_get_project_and_slide_ref(project, slide_id)
     osl = get_osl(slide_id, sr)
+    
+    # Associated images only change with the version of the slide
+    cache_control = current_app.config['DZI_TILE_CACHE_CONTROL']
+    etag = slide_etag(osl.url, get_slide_version(osl.url), 'assoc', resource.lower(), extension)
+    resp = not_modified_response(etag, cache_control)
+    if resp is not None:
+        return resp
     assoc_image = osl.associated_images.get(resource.lower(), None)
 
     # Get the resource
@@ -428,8 +804,8 @@ def dzi_download_thumblike_image(project, slide_id, resource, extension):
     buf = PILBytesIO()
     assoc_image.save(buf, extension)
     resp = make_response(buf.getvalue())
-    resp.mimetype = 'image/%s' % format
-    return resp
+    resp.mimetype = 'image/%s' % extension
+    return with_cache_headers(resp, etag, cache_control)
 
 
 # Download a label image for a slide 
@@ -481,6 +857,13 @@ def dzi_download_header(project, slide_id, resource):
     _, sr = dzi_get_project_and_slide_ref(project, slide_id)
     os = get_osl(slide_id, sr, resource)
     
+    # The header only changes with the version of the slide
+    cache_control = current_app.config['DZI_METADATA_CACHE_CONTROL']
+    etag = slide_etag(os.url, get_slide_version(os.url), 'header', resource)
+    resp = not_modified_response(etag, cache_control)
+    if resp is not None:
+        return resp
+    
     # Collect relevant properties
     prop_dict = {
         'properties': format_properties(os.properties),
@@ -488,78 +871,436 @@ def dzi_download_header(project, slide_id, resource):
         'level_downsamples': os.level_downsamples 
     }
     
-    return json.dumps(prop_dict), 200, {'ContentType':'application/json'}
+    resp = make_response(json.dumps(prop_dict), 200, {'ContentType':'application/json'})
+    return with_cache_headers(resp, etag, cache_control)
+
+
+# Send a pickled object over a socket, prefixed with its length as an 8-byte integer
+def send_message(sock, obj):
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(len(payload).to_bytes(8, byteorder='big'))
+    sock.sendall(payload)
+
+
+# Receive exactly n_bytes from a socket, raising an error if the peer hangs up
+def _recv_exact(sock, n_bytes):
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < n_bytes:
+        n_read = sock.recv_into(view[pos:], n_bytes - pos)
+        if n_read == 0:
+            raise ConnectionError('Connection closed by peer in the middle of a message')
+        pos += n_read
+    return buffer
+
+
+# Receive a length-prefixed pickled object from a socket. Returns None if the
+# peer closed the connection cleanly before sending a new message
+def recv_message(sock):
+    header = sock.recv(8)
+    if len(header) == 0:
+        return None
+    if len(header) < 8:
+        header += _recv_exact(sock, 8 - len(header))
+    n_bytes = int.from_bytes(header, byteorder='big')
+    return pickle.loads(_recv_exact(sock, n_bytes))
+
+
+class SlideServerError(RuntimeError):
+    """
+    Error raised in the client when the slide server fails to execute a command. The
+    name of the exception class raised in the server is stored in error_type.
+    """
+    def __init__(self, command, error_type, message):
+        RuntimeError.__init__(self, f'Slide server failed to execute {command}: {error_type}: {message}')
+        self.error_type = error_type
+        
+
+class SlideServerConnectionPool:
+    """
+    A pool of persistent connections to the slide server workers. Each worker socket
+    gets its own list of idle connections, and a connection carries any number of
+    framed request/response messages before it is closed. This avoids paying for a
+    connect and teardown on every property access and tile read.
+    
+    The pool belongs to the process that created it. Since uwsgi forks its workers
+    after the application is loaded, a pool used in a forked child drops the
+    connections inherited from the parent and starts over.
+    
+    Connecting and waiting for a response time out after timeout seconds, so that a
+    stuck worker does not hold up the uwsgi process forever. A connection that fails
+    in any way is closed rather than returned to the pool, since it may be left in 
+    the middle of a message.
+    """
+    
+    def __init__(self, max_idle_per_addr=8, timeout=120.0):
+        self.max_idle_per_addr = max_idle_per_addr
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._idle = {}
+        
+    def _acquire(self, socket_addr):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle, self._pid = {}, os.getpid()
+            idle = self._idle.get(socket_addr)
+            if idle:
+                return idle.pop(), True
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(socket_addr)
+        except OSError:
+            sock.close()
+            raise
+        return sock, False
+    
+    def _release(self, socket_addr, sock):
+        with self._lock:
+            if self._pid == os.getpid():
+                idle = self._idle.setdefault(socket_addr, [])
+                if len(idle) < self.max_idle_per_addr:
+                    idle.append(sock)
+                    return
+        sock.close()
+        
+    def execute(self, socket_addr, request):
+        """Send a request to the worker listening on socket_addr and return its response"""
+        while True:
+            sock, reused = self._acquire(socket_addr)
+            try:
+                send_message(sock, request)
+                response = recv_message(sock)
+                if response is None:
+                    raise ConnectionError('Slide server closed the connection')
+            except socket.timeout:
+                # A worker that does not answer in time is not asked again
+                sock.close()
+                raise
+            except OSError:
+                # A pooled connection may have been closed by a restarted server, in
+                # which case we retry on a fresh connection. Requests are idempotent.
+                sock.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                sock.close()
+                raise
+            self._release(socket_addr, sock)
+            break
+            
+        status, result = response
+        if status != 'ok':
+            error_type, message = result
+            raise SlideServerError(request['command'], error_type, message)
+        return result
+    
+
+# Connection pool shared by all thin interfaces in this process
+slide_server_pool = SlideServerConnectionPool()
+
+
+class SharedMemoryImage:
+    """
+    Descriptor returned by the slide server in place of an image when the pixels
+    have been written into the caller's shared memory arena.
+    """
+    def __init__(self, offset, shape, dtype, mode):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.mode = mode
+
+
+# Attach to an existing shared memory block without handing it over to the resource
+# tracker, which would otherwise unlink the block when this process exits
+def attach_shared_memory(name):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+class SharedMemoryArena:
+    """
+    A block of shared memory owned by a client (uwsgi) process into which the slide
+    server writes decoded pixels. The client allocates space for the expected result
+    before sending a read_region request, and the server returns a SharedMemoryImage
+    descriptor instead of pickling the pixels. The client then wraps the buffer as a
+    NumPy array or PIL image without copying. The space is returned to the arena when
+    the wrapping array is garbage collected.
+    
+    Allocation uses a first-fit free list. When the arena is full or cannot be created
+    (e.g., /dev/shm is too small), callers fall back to pickled transport.
+    """
+    
+    # Alignment of allocations in bytes
+    alignment = 64
+    
+    def __init__(self, size_mb=0):
+        self.size = int(size_mb * 1024**2)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._shm = None
+        self._free = []
+        
+    def _ensure_created(self):
+        # The arena is created lazily in the process that uses it, so that forked
+        # uwsgi workers each get their own block
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._shm, self._free = None, []
+            if self.size > 0:
+                try:
+                    self._shm = shared_memory.SharedMemory(create=True, size=self.size)
+                    self._free = [(0, self.size)]
+                    atexit.register(self._shm.unlink)
+                except OSError as e:
+                    print(f'Unable to create shared memory arena of size {self.size}: {e}')
+        return self._shm is not None
+    
+    @property
+    def name(self):
+        return self._shm.name
+    
+    @classmethod
+    def aligned(cls, n_bytes):
+        return -(-n_bytes // cls.alignment) * cls.alignment
+    
+    def allocate(self, n_bytes):
+        """Allocate a block of n_bytes, returning its offset or None if there is no space"""
+        n_bytes = self.aligned(n_bytes)
+        with self._lock:
+            if not self._ensure_created():
+                return None
+            for i, (offset, length) in enumerate(self._free):
+                if length >= n_bytes:
+                    if length == n_bytes:
+                        del self._free[i]
+                    else:
+                        self._free[i] = (offset + n_bytes, length - n_bytes)
+                    return offset
+        return None
+    
+    def free(self, offset, n_bytes):
+        """Return a block to the free list, merging it with adjacent free blocks"""
+        n_bytes = self.aligned(n_bytes)
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            i = bisect.bisect(self._free, (offset, 0))
+            self._free.insert(i, (offset, n_bytes))
+            if i + 1 < len(self._free) and offset + n_bytes == self._free[i+1][0]:
+                self._free[i] = (offset, n_bytes + self._free[i+1][1])
+                del self._free[i+1]
+            if i > 0 and self._free[i-1][0] + self._free[i-1][1] == offset:
+                self._free[i-1] = (self._free[i-1][0], self._free[i-1][1] + self._free[i][1])
+                del self._free[i]
+                
+    def wrap(self, result, offset, n_bytes):
+        """Replace SharedMemoryImage descriptors in result (a single value or a list) with
+        PIL images (or NumPy arrays) that reference the arena without copying. The block of n_bytes at
+        offset is freed once none of these images are referenced"""
+        results = result if isinstance(result, list) else [result]
+        if not any(isinstance(r, SharedMemoryImage) for r in results):
+            self.free(offset, n_bytes)
+            return result
+        
+        block = np.ndarray((n_bytes,), dtype=np.uint8, buffer=self._shm.buf, offset=offset)
+        weakref.finalize(block, self.free, offset, n_bytes)
+        for i, desc in enumerate(results):
+            if isinstance(desc, SharedMemoryImage):
+                n_desc = int(np.prod(desc.shape))
+                arr = block[desc.offset-offset:desc.offset-offset+n_desc].reshape(desc.shape)
+                if desc.mode == 'array':
+                    results[i] = arr
+                else:
+                    size = (desc.shape[1], desc.shape[0])
+                    results[i] = Image.frombuffer(desc.mode, size, arr, 'raw', desc.mode, 0, 1)
+        return results if isinstance(result, list) else results[0]
+    
+
+# Shared memory arena used by all thin interfaces in this process. It is sized
+# from the configuration in init_app
+slide_server_shm = SharedMemoryArena()
+
+
+# Compute the score of a slide server worker for a slide URL. The score only depends
+# on the name of the worker's socket and the URL, so it is the same in every process
+# and survives restarts (unlike the built-in hash, which is randomized per process)
+def _slide_server_route_score(url, socket_addr):
+    key = f'{os.path.basename(socket_addr)}|{url}'.encode('utf-8')
+    return hashlib.blake2b(key, digest_size=8).digest()
+
+
+# Choose the slide server worker for a slide URL using rendezvous hashing: the worker
+# with the highest score wins. When workers are added or removed, the only slides
+# that move are those whose winning worker was removed or that a new worker now wins
+@functools.lru_cache(maxsize=4096)
+def _slide_server_route_cached(url, socket_addr_tuple):
+    return max(socket_addr_tuple, key=lambda addr: _slide_server_route_score(url, addr))
+
+
+def slide_server_route(url, socket_addr_list):
+    return _slide_server_route_cached(url, tuple(socket_addr_list))
+
+
+# Version string of a local slide file, which changes whenever the file is modified.
+# Returns None if the file cannot be accessed from this process
+def local_file_version(path):
+    try:
+        st = os.stat(path)
+        return f'{st.st_mtime_ns}-{st.st_size}'
+    except OSError:
+        return None
+
+
+class SlideDescriptorCache:
+    """
+    A per-process cache of slide descriptors, i.e., the static geometry and properties
+    returned by the slide server's describe command. Entries are keyed by the slide URL
+    and the version of the slide, which is the blob generation for slides on GCS and 
+    the modification time for local files. The version of a local file is checked on
+    each lookup. Versions of remote slides are trusted for ttl seconds, after which
+    the slide is described again.
+    """
+    
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, url, fn_describe):
+        t_now = time.time()
+        version_local = local_file_version(url) if '://' not in url else None
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                version, t_checked, desc = entry
+                if (version == version_local) if version_local is not None else (t_now - t_checked < self.ttl):
+                    self._entries.move_to_end(url)
+                    return desc
+            
+        # Describe the slide and place the result into the cache
+        desc = fn_describe()
+        with self._lock:
+            self._entries[url] = (desc['version'], t_now, desc)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return desc
+    
+
+# Descriptor cache used by all thin interfaces in this process
+slide_descriptor_cache = SlideDescriptorCache()
 
 
 class OpenSlideThinInterface:
     """
     This class is a thin interface to an OpenSlide object that is running in a 
-    different process and is connected to via a socket. 
+    different process and is connected to via a socket. Requests are sent over
+    persistent connections from the process-wide slide_server_pool.
     """
     
     def __init__(self, url, socket_addr_list):
-        # Hash the URL to determine which socket to connect to
-        self.socket_addr = socket_addr_list[hash(url) % len(socket_addr_list)]
+        # Route the URL to a socket in a way that is the same in all processes
+        self.socket_addr = slide_server_route(url, socket_addr_list)
         self.url = url
         
-    def _exec_remote(self, method, **kwargs):
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
-            
-            # Request a region from an image 
-            request = {
-                'url': self.url,
-                'command': method,
-                'args': kwargs
-            }
-            
-            # Connect to server and send data
-            sock.connect(self.socket_addr)
-            sock.sendall(pickle.dumps(request))
-
-            # Receive data from the server and shut down
-            header = sock.recv(8)
-            n_bytes = int.from_bytes(header, byteorder='big')
-            payload = bytearray(n_bytes)
-            pos = 0
-            while pos < n_bytes:
-                chunk = sock.recv(n_bytes-pos)
-                payload[pos:pos+len(chunk)] = chunk
-                pos += len(chunk)
-            result = pickle.loads(payload)
-            return result
+    def _exec_remote(self, method, shm_target=None, **kwargs):
+        request = {
+            'url': self.url,
+            'command': method,
+            'args': kwargs
+        }
+        if shm_target:
+            request['shm'] = shm_target
+        return slide_server_pool.execute(self.socket_addr, request)
+        
+    def describe(self):
+        """Get the static geometry and properties of the slide, using the cache if possible"""
+        return slide_descriptor_cache.get(self.url, lambda: self._exec_remote('describe'))
+    
+    @property
+    def version(self):
+        return self.describe()['version']
         
     @property
     def level_count(self):
-        return self._exec_remote('level_count')
+        return self.describe()['level_count']
 
     @property
     def dimensions(self):
-        return self._exec_remote('dimensions')
+        return self.describe()['dimensions']
         
     @property
     def level_dimensions(self):
-        return self._exec_remote('level_dimensions')
+        return self.describe()['level_dimensions']
     
     @property
     def level_downsamples(self):
-        return self._exec_remote('level_downsamples')
+        return self.describe()['level_downsamples']
     
     @property
     def properties(self):
-        return self._exec_remote('properties')
+        return self.describe()['properties']
     
     @property
     def associated_images(self):
         return self._exec_remote('associated_images')
     
     def get_best_level_for_downsample(self, downsample):
-        return self._exec_remote('get_best_level_for_downsample', downsample=downsample)
+        # Same logic as OpenSlide, computed locally from the cached downsamples
+        ds = self.level_downsamples
+        for (i, ds_i) in enumerate(ds):
+            if downsample < ds_i:
+                return max(i-1, 0)
+        return len(ds)-1
+                
+    def _exec_remote_shm(self, method, n_bytes, **kwargs):
+        # Ask the server to place the pixels into our shared memory arena
+        offset = slide_server_shm.allocate(n_bytes) if n_bytes > 0 else None
+        if offset is None:
+            return self._exec_remote(method, **kwargs)
+        
+        try:
+            shm_target = { 'name': slide_server_shm.name, 'offset': offset, 'size': n_bytes }
+            result = self._exec_remote(method, shm_target=shm_target, **kwargs)
+        except Exception:
+            slide_server_shm.free(offset, n_bytes)
+            raise
+            
+        # The server sends images inline that did not fit
+        return slide_server_shm.wrap(result, offset, n_bytes)
                 
-    def read_region(self, location, level, size):
-        return self._exec_remote('read_region', location=location, level=level, size=size)
+    def read_region(self, location, level, size, mode='RGBA', out_size=None):
+        """Read a region as a PIL image in the given mode ('RGBA', 'RGB') or as
+        a NumPy array (mode='array'), optionally resampled to out_size"""
+        w, h = out_size if out_size is not None else size
+        n_bytes = w * h * (3 if mode == 'RGB' else 4)
+        return self._exec_remote_shm('read_region', n_bytes, location=location, level=level, size=size, 
+                                     mode=mode, out_size=out_size)
+    
+    def read_regions(self, regions, mode='RGBA'):
+        """Read a list of (location, level, size) regions in a single request"""
+        regions = [ (tuple(loc), level, tuple(size)) for (loc, level, size) in regions ]
+        n_bytes = sum(SharedMemoryArena.aligned(size[0] * size[1] * (3 if mode == 'RGB' else 4)) 
+                      for (_, _, size) in regions)
+        return self._exec_remote_shm('read_regions', n_bytes, regions=regions, mode=mode)
     
     def get_thumbnail(self, size):
         return self._exec_remote('get_thumbnail', size=size)
+    
+    def get_dz_tile(self, level, col, row, format='jpeg', quality=75, **dz_params):
+        """Get an encoded DeepZoom tile, computed by the slide server"""
+        return self._exec_remote('get_dz_tile', level=level, col=col, row=row, 
+                                 format=format, quality=quality, **dz_params)
         
 
 
@@ -577,33 +1318,217 @@ class SlideCacheEntry:
     """
     Representation of a slide that is kept by a slide server process. Stores a
     handle to the slide wrapper and a timestamp from last use, which is
-    updated whenever the wrapper is requested
+    updated whenever the slide is requested from the cache. The wrapper is opened 
+    lazily under the entry's lock, so that concurrent requests for a new slide open it once.
+    DeepZoom tiles are read from the slide combined with its synthetic levels, if these
+    have been built, while all other requests see the levels of the slide itself.
     """    
-    def __init__(self, osl_wrapper):
+    def __init__(self, osl_wrapper=None):
         self._osl = osl_wrapper
+        self._dz_osl = osl_wrapper
+        self._dz = {}
+        self._dz_ds = None
+        self.lock = threading.Lock()
         self.t_access = time.time_ns()
         
     @property
     def osl_wrapper(self):
-        self.t_access = time.time_ns()
         return self._osl
     
+    @property
+    def dz_osl_wrapper(self):
+        return self._dz_osl
+    
+    def touch(self):
+        self.t_access = time.time_ns()
+        return self.t_access
+    
+    # Estimate of the memory held by a DeepZoom generator, which keeps a few tuples per level
+    dz_level_overhead = 512
+    
+    def memory_usage(self):
+        """Estimate of the memory held by the open slide, i.e., by the slide wrapper with
+        its decoded tile cache and associated images, and by the DeepZoom generators"""
+        if self._dz_osl is None:
+            return 0
+        return self._dz_osl.memory_usage() + sum(self.dz_level_overhead * dz.level_count for dz in self._dz.values())
+    
+    @property
+    def dz_level_downsamples(self):
+        """Downsamples of the DeepZoom levels relative to the slide levels they are read from"""
+        if self._dz_ds is None:
+            self._dz_ds = dz_level_downsamples(self.dz_osl_wrapper)
+        return self._dz_ds
+    
+    def describe(self):
+        """Describe the slide for the DeepZoom geometry computed by uwsgi processes. The
+        pass-through tile size and the DeepZoom level downsamples are those of the levels
+        that DeepZoom tiles are read from, which include the synthetic levels"""
+        return { **self.osl_wrapper.describe(), 
+                 'jpeg_tile_size': getattr(self.dz_osl_wrapper, 'jpeg_tile_size', None),
+                 'dz_level_downsamples': self.dz_level_downsamples }
+    
+    def get_dz_generator(self, tile_size=254, overlap=1, limit_bounds=False):
+        """Get a DeepZoom generator for the slide with given parameters"""
+        from openslide.deepzoom import DeepZoomGenerator
+        key = (tile_size, overlap, limit_bounds)
+        dz = self._dz.get(key)
+        if dz is None:
+            self._dz[key] = dz = DeepZoomGenerator(self.dz_osl_wrapper, tile_size, overlap, limit_bounds)
+        return dz
+    
 
-class OpenSlideRequestHandler(socketserver.BaseRequestHandler):
+class SlideReadahead:
     """
-    The request handler class for our server.
-
-    It is instantiated once per connection to the server, and must
-    override the handle() method to implement communication to the
-    client.
+    Background readahead of slide data in a slide server worker. After a DeepZoom tile
+    has been served, the tiles that the viewer is likely to ask for next (neighbours at
+    the same level, the parent tile and the child tiles) are queued, and a background
+    thread loads their bytes into the page cache, so that GCS latency is hidden when
+    the user pans or zooms.
+    
+    Readahead has low priority: the thread only runs when the worker is not serving
+    any requests, the most recently queued jobs are done first and the oldest jobs are
+    dropped when the queue is full. A job is also dropped when more than window tiles
+    of the same slide have been requested since it was queued, meaning that the user 
+    has moved elsewhere, and readahead pauses for a while after the cache manager 
+    purges the page cache, or the shared page cache replaces pages that were recently
+    used, so that it does not push out pages that are in use.
     """
-    def handle(self):
+    def __init__(self, max_jobs=64, window=64, pause_after_purge=30.0):
+        self.jobs = deque(maxlen=max_jobs)
+        self.generation = {}
+        self.window = window
+        self.pause_after_purge = pause_after_purge
+        self.t_last_purge = 0.0
+        self.n_active = 0
+        self.cond = threading.Condition()
+        
+    def begin_request(self):
+        with self.cond:
+            self.n_active += 1
+            
+    def end_request(self):
+        with self.cond:
+            self.n_active -= 1
+            self.cond.notify()
+            
+    def on_purge(self):
+        self.t_last_purge = time.time()
+        
+    def submit(self, url, fn):
+        """Record a tile request for a slide and queue a readahead function for it"""
+        with self.cond:
+            gen = self.generation[url] = self.generation.get(url, 0) + 1
+            self.jobs.append((url, gen, fn))
+            self.cond.notify()
+            
+    def run(self):
+        # Readahead loop, runs in a background thread of the worker
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.jobs) > 0 and self.n_active == 0)
+                url, gen, fn = self.jobs.pop()
+                if self.generation.get(url, 0) - gen > self.window:
+                    continue
+            if time.time() - self.t_last_purge < self.pause_after_purge:
+                continue
+            try:
+                fn()
+            except Exception:
+                traceback.print_exc()
+                
+    @staticmethod
+    def dz_neighbour_regions(dz, level, col, row):
+        """Slide regions of the tiles around a DeepZoom tile: its neighbours at the same
+        level, its parent one level up and its children one level down"""
+        addr = [ (level, col + dx, row + dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy ]
+        addr.append((level - 1, col // 2, row // 2))
+        addr.extend([ (level + 1, 2 * col + dx, 2 * row + dy) for dy in (0, 1) for dx in (0, 1) ])
+        regions = []
+        for (l, c, r) in addr:
+            if 0 <= l < dz.level_count and 0 <= c < dz.level_tiles[l][0] and 0 <= r < dz.level_tiles[l][1]:
+                regions.append(dz_tile_region(dz, l, c, r)[0])
+        return regions
+
+
+class OpenSlideRequestHandler:
+    """
+    The request handler class for our server. There is one handler per worker
+    process and it keeps the state that is shared by all connections to the worker:
+    the cache of open slides, the page cache and the GCS client.
+    
+    Requests are dicts with the slide URL, the command (a method or property of
+    the OpenSlide object) and its arguments. The response is a tuple whose first
+    element is 'ok' or 'error' and whose second element is the result or the
+    error message.
+    """
+    def __init__(self, index, cache_queue, page_size_mb, decode_threads=4, coalesce_gap_kb=1024, readahead=True,
+                 l2_cache_dir=None, l2_cache_size_mb=0, shared_cache=None, index_cache_dir=None, index_cache_size_mb=0,
+                 min_page_size_kb=None, levels_dir=None, openslide_cache_mb=32):
+        self.osl_cache = {}
+        self.openslide_cache_size = int(openslide_cache_mb * 1024**2)
+        self.readahead = SlideReadahead() if readahead else None
+        self.coalesce_gap = coalesce_gap_kb * 1024
+        self.min_page_size = min_page_size_kb * 1024 if min_page_size_kb else None
+        self.decode_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=decode_threads, thread_name_prefix=f'decode_{index:02d}') if decode_threads > 1 else None
+        
+        # Memory used by the open slides and the worker's own page cache is reported
+        # to the cache manager, which enforces the memory limit of the slide server
+        self.reporter = MemoryUsageReporter(index, cache_queue)
+        
+        # Use the page cache shared by all workers if the server has created one. The
+        # slab stays registered with the resource tracker shared with the server process
+        if shared_cache is not None:
+            slab_name, slab_locks = shared_cache
+            self.slab_shm = shared_memory.SharedMemory(name=slab_name)
+            self.gcs_cache = SharedSlabPageCache(self.slab_shm.buf, slab_locks, page_size_mb=page_size_mb,
+                                                 unit_size=self.min_page_size)
+            self.n_hot_replaced = self.gcs_cache.hot_replacements()
+        else:
+            self.gcs_cache = MultiprocessManagedMultiFilePageCache(self.reporter, page_size_mb=page_size_mb)
+        if l2_cache_dir and l2_cache_size_mb > 0:
+            self.gcs_cache.l2 = WriteBehindDiskCache(l2_cache_dir, int(l2_cache_size_mb * 1024**2))
+            
+        # Index of the TIFF structure of remote slides, so that they can be reopened quickly
+        self.index_cache = LocalDiskCache(index_cache_dir, int(index_cache_size_mb * 1024**2)) if index_cache_dir else None
+        
+        # Directory of the synthetic pyramid levels built for sparsely pyramided slides
+        self.levels_dir = levels_dir
+        self.gcs_client = None
+        self.http_client = None
+        self.shm_blocks = OrderedDict()
+        self.lock = threading.Lock()
+        
+        # Identical tile and region requests from different uwsgi processes arrive at
+        # the same worker, since slides are routed by URL, and are computed once
+        self.flights = SingleFlight()
+
+    # Commands that are implemented by the handler rather than the slide wrapper
+    server_commands = ('get_dz_tile', 'describe')
+    
+    # Commands whose concurrent identical requests share a single computation
+    coalesced_commands = ('get_dz_tile', 'read_region', 'read_regions')
+    
+    def get_slide(self, url):
+        return self.get_slide_cache_entry(url).osl_wrapper
 
+    def get_slide_cache_entry(self, url):
+        import openslide
         from openslide import OpenSlide
         class OpenSlidePickleableWrapper(OpenSlide):
             
-            def __init__(self, filename):
+            def __init__(self, filename, cache_size):
                 OpenSlide.__init__(self, filename)
+                self.filename = filename
+                
+                # Give the slide its own tile cache of the configured size, so that its
+                # memory use is known. Older OpenSlide versions have a fixed 32MB cache
+                try:
+                    self.set_cache(openslide.OpenSlideCache(cache_size))
+                    self.cache_size = cache_size
+                except (AttributeError, openslide.OpenSlideVersionError):
+                    self.cache_size = 32 * 1024**2
                 
             @property
             def properties(self):
@@ -612,38 +1537,265 @@ class OpenSlideRequestHandler(socketserver.BaseRequestHandler):
             @property
             def associated_images(self):
                 return dict(super().associated_images)
+            
+            def read_region(self, location, level, size, mode='RGBA', out_size=None):
+                image = super().read_region(location, level, size)
+                if out_size is not None and image.size != tuple(out_size):
+                    image = image.resize(tuple(out_size), getattr(Image, 'Resampling', Image).LANCZOS)
+                if mode == 'array':
+                    return np.asarray(image)
+                return image if mode == 'RGBA' else image.convert(mode)
+            
+            def read_regions(self, regions, mode='RGBA'):
+                return [ self.read_region(location, level, size, mode) for (location, level, size) in regions ]
+            
+            def memory_usage(self):
+                # OpenSlide keeps the decoded tiles of the slide in its tile cache, and
+                # associated images are read on demand rather than kept
+                return self.cache_size
+            
+            def describe(self):
+                return {
+                    'version': local_file_version(self.filename),
+                    'jpeg_tile_size': None,
+                    'level_count': self.level_count,
+                    'dimensions': self.dimensions,
+                    'level_dimensions': self.level_dimensions,
+                    'level_downsamples': self.level_downsamples,
+                    'properties': self.properties
+                }
 
-        # Block to receive request
-        self.data = pickle.loads(self.request.recv(4096))
+        # Get a cached TIFF object for the URL or create and cache one
+        with self.lock:
+            slide_cache_entry = self.osl_cache.get(url, None)
+            if not slide_cache_entry:
+                self.osl_cache[url] = slide_cache_entry = SlideCacheEntry()
+                
+        # Open the slide if this has not been done yet. Other requests for the 
+        # same slide wait here rather than opening it again. Slides with a URL are read
+        # in byte ranges through the page cache, and local paths are read by OpenSlide
+        with slide_cache_entry.lock:
+            if slide_cache_entry.osl_wrapper is None:
+                source = self.get_byte_range_source(url)
+                if source is not None:
+                    tiff = RemoteOpenSlideWrapper(source, self.gcs_cache, self.decode_executor, 
+                                                  self.coalesce_gap, self.index_cache, self.min_page_size)
+                else:
+                    tiff = OpenSlidePickleableWrapper(url, self.openslide_cache_size)
+                slide_cache_entry._osl = tiff
+                slide_cache_entry._dz_osl = open_synthetic_levels(
+                    tiff, self.levels_dir, url, tiff.describe()['version'], self.decode_executor)
+                
+        # Report the use of the slide and the memory it holds to the cache manager
+        self.reporter.report(url, None, slide_cache_entry.touch(), slide_cache_entry.memory_usage())
+        return slide_cache_entry
+    
+    def get_byte_range_source(self, url):
+        """Get the byte range source for a slide based on the scheme of its URL, or None
+        if the URL is a local path"""
+        scheme = urllib.parse.urlparse(url).scheme
+        with self.lock:
+            if scheme == 'gs' and self.gcs_client is None:
+                self.gcs_client = storage.Client()
+            elif scheme in ('http', 'https') and self.http_client is None:
+                self.http_client = httpx.Client(follow_redirects=True, timeout=60.0)
+        return open_byte_range_source(url, self.gcs_client, self.http_client)
+
+    def describe(self, url):
+        """Describe a slide, including the levels that DeepZoom tiles are read from"""
+        return self.get_slide_cache_entry(url).describe()
+
+    def get_dz_tile(self, url, level, col, row, format='jpeg', quality=75, **dz_params):
+        """Compute a DeepZoom tile next to the slide data and return its encoded bytes"""
+        entry = self.get_slide_cache_entry(url)
+        dz = entry.get_dz_generator(**dz_params)
         
-        # Get the slide URL
-        url = self.data['url']
+        # Load the tiles around this one in the background if the slide supports it
+        osl = entry.dz_osl_wrapper
+        if self.readahead is not None and hasattr(osl, 'prefetch_regions'):
+            self.readahead.submit(url, lambda: osl.prefetch_regions(
+                SlideReadahead.dz_neighbour_regions(dz, level, col, row)))
+        if format == 'jpeg':
+            data = self.get_passthrough_dz_tile(entry, dz, level, col, row, **dz_params)
+            if data is not None:
+                return data
+        tile = self.get_dz_tile_image(osl, dz, level, col, row)
+        buf = PILBytesIO()
+        tile.save(buf, format, quality=quality)
+        return buf.getvalue()
+
+    def get_dz_tile_image(self, osl, dz, level, col, row):
+        """Compute a DeepZoom tile as an RGB image. Slides read by the stream wrapper
+        resample the tile region as it is read, so that tiles of levels that fall well
+        between pyramid levels are decoded at reduced resolution"""
+        slide = osl.slide if isinstance(osl, SyntheticLevelsSlide) else osl
+        if not isinstance(slide, AbstractStreamOpenSlideWrapper):
+            return dz.get_tile(level, (col, row))
+        (l0_location, slide_level, l_size), z_size = dz_tile_region(dz, level, col, row)
+        return osl.read_region(l0_location, slide_level, l_size, mode='RGB', out_size=z_size)
+
+    def get_passthrough_dz_tile(self, entry, dz, level, col, row, tile_size=254, overlap=1, limit_bounds=False):
+        """Get the stored JPEG tile that a DeepZoom tile maps onto exactly, or None if 
+        the DeepZoom tile has to be resampled from the slide"""
+        osl = entry.dz_osl_wrapper
+        if overlap != 0 or limit_bounds or getattr(osl, 'jpeg_tile_size', None) != tile_size:
+            return None
         
-        # Get a cached TIFF object for the URL or create and cache one
-        # TODO: purge tiff cache once in a while
-        slide_cache_entry = self.server.osl_cache.get(url, None)
-        if not slide_cache_entry:
-            if url.startswith('gs://'):
-                if self.server.gcs_client is None:
-                    self.server.gcs_client = storage.Client()                
-                tiff = GoogleCloudOpenSlideWrapper(self.server.gcs_client, url, self.server.gcs_cache)
+        # The DeepZoom level must be a slide level at full resolution and the tile must
+        # not be cropped by the edge of the image 
+        if entry.dz_level_downsamples[level] != 1:
+            return None
+        (l0_location, slide_level, l_size), z_size = dz_tile_region(dz, level, col, row)
+        if tuple(l_size) != (tile_size, tile_size) or tuple(z_size) != tuple(l_size):
+            return None
+        return osl.read_raw_jpeg_tile(slide_level, col, row)
+
+    def handle(self, data):
+        if self.readahead is not None:
+            self.readahead.begin_request()
+        try:
+            # Process the request, either by the handler itself or by the slide
+            if data['command'] in self.coalesced_commands:
+                key = (data['url'], data['command'], repr(sorted(data['args'].items())))
+                result = self.flights.do(key, lambda: self.execute(data))
             else:
-                tiff = OpenSlidePickleableWrapper(url)
-            self.server.osl_cache[url] = slide_cache_entry = SlideCacheEntry(tiff)
+                result = self.execute(data)
             
-        # Process the request
-        attr = getattr(slide_cache_entry.osl_wrapper, self.data['command'])
-        result = attr(**self.data['args']) if callable(attr) else attr
+            # Place images into the client's shared memory if requested
+            if 'shm' in data:
+                result = self.write_to_shared_memory(result, **data['shm'])
+            return 'ok', result
+        except Exception as e:
+            traceback.print_exc()
+            return 'error', (type(e).__name__, str(e))
+        finally:
+            if self.readahead is not None:
+                self.readahead.end_request()
+
+    def execute(self, data):
+        # Run the command of a request on the handler or on the slide
+        if data['command'] in self.server_commands:
+            return getattr(self, data['command'])(data['url'], **data['args'])
+        attr = getattr(self.get_slide(data['url']), data['command'])
+        return attr(**data['args']) if callable(attr) else attr
+
+    def write_to_shared_memory(self, result, name, offset, size, max_blocks=64):
+        # Attach to the client's shared memory block, keeping the most recently used
+        # blocks attached since clients send many requests to the same block
+        with self.lock:
+            shm = self.shm_blocks.pop(name, None)
+            if shm is None:
+                try:
+                    shm = attach_shared_memory(name)
+                except OSError:
+                    return result
+            self.shm_blocks[name] = shm
+            while len(self.shm_blocks) > max_blocks:
+                _, shm_old = self.shm_blocks.popitem(last=False)
+                try:
+                    shm_old.close()
+                except BufferError:
+                    # Another thread is still writing into this block
+                    pass
+        
+        # Copy the images one after another into the block, replacing each with a 
+        # descriptor in a new list, since the result may be shared by coalesced requests.
+        # Only plain 8-bit modes and arrays are supported, other images stay inline
+        results = list(result) if isinstance(result, list) else [result]
+        pos, end = offset, offset + size
+        for i, image in enumerate(results):
+            if isinstance(image, Image.Image) and image.mode in ('RGBA', 'RGB'):
+                shape, mode = (image.size[1], image.size[0], len(image.getbands())), image.mode
+            elif isinstance(image, np.ndarray) and image.dtype == np.uint8 and image.ndim == 3:
+                shape, mode = image.shape, 'array'
+            else:
+                continue
+            n_bytes = shape[0] * shape[1] * shape[2]
+            if pos + n_bytes <= end:
+                dest = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=pos)
+                dest[...] = np.asarray(image)
+                del dest
+                results[i] = SharedMemoryImage(pos, shape, 'uint8', mode)
+                pos += SharedMemoryArena.aligned(n_bytes)
+        return results if isinstance(result, list) else results[0]
+
+    def purge(self, evict_queue):
+        # Send pending reports to the manager and evict the pages and slides that the 
+        # manager has selected. Evictions mean that the memory limit has been reached,
+        # so readahead should back off
+        self.reporter.flush()
+        n_evicted = 0
+        while True:
+            try:
+                notices = evict_queue.get_nowait()
+            except queue.Empty:
+                break
+            n_evicted += self.gcs_cache.evict_pages([ n for n in notices if n[1] is not None ])
+            n_evicted += self.close_slides([ (url, t) for (url, item, t) in notices if item is None ])
+            
+        # The manager does not evict pages from the shared page cache, which instead 
+        # replaces its least recently used pages. Replacing pages that are still in use
+        # also means that the cache is full
+        if isinstance(self.gcs_cache, SharedSlabPageCache):
+            n_hot_replaced = self.gcs_cache.hot_replacements()
+            n_evicted += max(0, n_hot_replaced - self.n_hot_replaced)
+            self.n_hot_replaced = n_hot_replaced
+        if self.readahead is not None and n_evicted > 0:
+            self.readahead.on_purge()
+        
+        # Close slides that have not been accessed in 30 minutes
+        t_cutoff = time.time_ns() - 1800 * 1000**3
+        with self.lock:
+            idle = [ (url, t_cutoff) for url in self.osl_cache.keys() ]
+        self.close_slides(idle)
+        
+    def close_slides(self, slides):
+        """Remove slides, given as a list of (url, t_access) tuples, from the slide cache
+        unless they have been accessed since t_access"""
+        with self.lock:
+            closed = [ url for (url, t) in slides if url in self.osl_cache and self.osl_cache[url].t_access <= t ]
+            for url in closed:
+                del self.osl_cache[url]
+                
+        # Tell the manager that the memory held by these slides has been released
+        for url in closed:
+            self.reporter.report(url, None, time.time_ns(), 0)
+        return len(closed)
+            
+    def run_housekeeping(self, evict_queue, interval=1.0):
+        # Periodically purge the caches, runs in a background thread of the worker
+        while True:
+            time.sleep(interval)
+            try:
+                self.purge(evict_queue)
+            except Exception:
+                traceback.print_exc()
+
 
-        payload = pickle.dumps(result)
-        self.request.send(len(payload).to_bytes(8, byteorder='big'))
-        self.request.sendall(payload)
+class OpenSlideConnectionHandler(socketserver.BaseRequestHandler):
+    """
+    Handler for a single client connection. It is instantiated once per connection in
+    its own thread, and serves framed requests until the client closes the connection.
+    The requests themselves are executed by the worker's shared OpenSlideRequestHandler.
+    """
+    def handle(self):
+        while True:
+            try:
+                data = recv_message(self.request)
+                if data is None:
+                    break
+                send_message(self.request, self.server.osl_handler.handle(data))
+            except OSError as e:
+                print(f'Slide server lost connection: {e}')
+                break
 
 
 # Worker process that runs the openslide server. This thread operates a single 
 # unix socket based on its id and handles files that correspond to this ID 
-# based on its hash. 
-def slide_server_process_run(index, socket_addr_list, page_size_mb, cache_queue, purge_value):
+# based on its hash. Clients keep their connections open between requests, and
+# each connection is served by its own thread, so that a slow read from GCS does
+# not hold up requests for other tiles. All threads share the worker's caches.
+def slide_server_process_run(index, socket_addr_list, page_size_mb, cache_queue, evict_queue, **handler_opts):
     
     # Get the socket address
     socket_addr = socket_addr_list[index]
@@ -654,22 +1806,17 @@ def slide_server_process_run(index, socket_addr_list, page_size_mb, cache_queue,
         os.remove(socket_addr)
     
     # Run the socket server forever or until interrupted
+    handler = OpenSlideRequestHandler(index, cache_queue, page_size_mb, **handler_opts)
     try:
-        with socketserver.UnixStreamServer(socket_addr, OpenSlideRequestHandler) as server:
-            server.osl_cache = {}
-            server.gcs_cache = MultiprocessManagedMultiFilePageCache(index, cache_queue, page_size_mb=page_size_mb)
-            server.gcs_client = None
-            server.timeout = 30
-            while(True):
-                # Handle the request
-                server.handle_request()
-                
-                # Purge the memory cache of pages newer than specified value
-                server.gcs_cache.purge(purge_value.value)
-                
-                # Purge the slide wrapper cache of slides that have not been accessed in 30 minutes
-                t_cutoff = time.time_ns() - 1800 * 1000**3
-                server.osl_cache = dict({k:v for k,v in server.osl_cache.items() if v.t_access >= t_cutoff})
+        with socketserver.ThreadingUnixStreamServer(socket_addr, OpenSlideConnectionHandler) as server:
+            server.osl_handler = handler
+            server.daemon_threads = True
+            
+            # Purge the page and slide caches and read ahead in the background
+            threading.Thread(target=handler.run_housekeeping, args=(evict_queue,), daemon=True).start()
+            if handler.readahead is not None:
+                threading.Thread(target=handler.readahead.run, daemon=True).start()
+            server.serve_forever()
                 
     except KeyboardInterrupt:
         print(f'Worker {index} interrupted by keyboard')
@@ -678,52 +1825,212 @@ def slide_server_process_run(index, socket_addr_list, page_size_mb, cache_queue,
         os.remove(socket_addr)
 
 
-# Manager process that keeps an eye on the cache size and forces a purge when the
-# cache size is exceeded
-def slide_server_cache_manager_process_run(cache_queue, purge_value, max_pages=4096, purge_size_pct=0.25):
-    cache_metadata = dict()
-    t_last_print = time.time_ns()
+class SlideServerMemoryBudget:
+    """
+    Accounting of the memory used by all slide server workers, kept by the cache manager
+    process. Every item that a worker holds in memory (a cache page or an open slide) 
+    is recorded with its size in bytes and its last access time, both in an LRU ordered
+    dict of all items and in an LRU ordered dict for its slide, so that recording an
+    access and finding the least recently used item take constant time. Memory that 
+    cannot be evicted, such as the page cache shared by all workers, is counted as a
+    fixed amount.
+    
+    The total is kept below max_bytes by evicting the least recently used items. So that
+    a few giant slides cannot push all other slides out of memory, each slide may only
+    use a fraction (slide_share) of the memory available for evictable items, beyond
+    which its own least recently used items are evicted. Evictions go below the limit
+    by a fraction (headroom) so that they are batched.
+    """
+    def __init__(self, max_bytes, fixed_bytes=0, slide_share=0.5, headroom=0.05):
+        self.max_bytes = max_bytes
+        self.fixed_bytes = fixed_bytes
+        self.slide_share = slide_share
+        self.headroom = headroom
+        self.lru = OrderedDict()
+        self.slide_lru = {}
+        self.slide_bytes = {}
+        self.worker_bytes = {}
+        self.tier_bytes = { 'pages': 0, 'slides': 0 }
+        self.total_bytes = 0
+        self.n_evicted = 0
+        
+    @property
+    def budget(self):
+        """Memory available for items that can be evicted"""
+        return max(0, self.max_bytes - self.fixed_bytes)
+    
+    def _count(self, key, n_bytes):
+        worker, url, item = key
+        self.total_bytes += n_bytes
+        self.slide_bytes[url] = self.slide_bytes.get(url, 0) + n_bytes
+        self.worker_bytes[worker] = self.worker_bytes.get(worker, 0) + n_bytes
+        self.tier_bytes['slides' if item is None else 'pages'] += n_bytes
+
+    def _remove(self, key):
+        t_access, n_bytes = self.lru.pop(key)
+        url = key[1]
+        slide_lru = self.slide_lru[url]
+        del slide_lru[key]
+        self._count(key, -n_bytes)
+        if not slide_lru:
+            del self.slide_lru[url]
+            del self.slide_bytes[url]
+        return t_access
+    
+    def update(self, worker, batch):
+        """Record a batch of (url, item, t_access, n_bytes) reports from a worker. The
+        item is a page number or None for the open slide itself. Items reported with
+        zero bytes have been released by the worker"""
+        for (url, item, t_access, n_bytes) in sorted(batch, key=lambda x: x[2]):
+            key = (worker, url, item)
+            known = self.lru.get(key)
+            if known is not None:
+                if known[0] > t_access:
+                    continue
+                self._remove(key)
+            if n_bytes > 0:
+                self.lru[key] = (t_access, n_bytes)
+                self.slide_lru.setdefault(url, OrderedDict())[key] = None
+                self._count(key, n_bytes)
+                
+    def evict(self):
+        """Select the items to evict to stay within the limits. Returns a dict from each
+        worker to a list of (url, item, t_access) eviction notices for that worker"""
+        evictions = {}
+        def evict_item(key):
+            t_access = self._remove(key)
+            evictions.setdefault(key[0], []).append((key[1], key[2], t_access))
+            self.n_evicted += 1
+        
+        # Evict from slides that use more than their share
+        slide_limit = self.slide_share * self.budget
+        for url in [ url for (url, n) in self.slide_bytes.items() if n > slide_limit ]:
+            while self.slide_bytes.get(url, 0) > slide_limit * (1 - self.headroom):
+                evict_item(next(iter(self.slide_lru[url])))
+        
+        # Evict from all slides if the total is over the limit
+        if self.total_bytes > self.budget:
+            while self.total_bytes > self.budget * (1 - self.headroom) and len(self.lru):
+                evict_item(next(iter(self.lru)))
+        return evictions
+    
+    def status(self, n_slides=20):
+        """Current memory use, overall, by tier, by worker and for the largest slides"""
+        largest = sorted(self.slide_bytes.items(), key=lambda x: x[1], reverse=True)[:n_slides]
+        return {
+            'time': time.time(),
+            'max_bytes': self.max_bytes,
+            'total_bytes': self.fixed_bytes + self.total_bytes,
+            'tiers': { 'shared': self.fixed_bytes, **self.tier_bytes },
+            'workers': { str(k): v for (k, v) in sorted(self.worker_bytes.items()) },
+            'n_slides': len(self.slide_bytes),
+            'n_items': len(self.lru),
+            'n_evicted': self.n_evicted,
+            'slides': [ { 'url': url, 'bytes': n } for (url, n) in largest ]
+        }
+
+
+# Manager process that keeps track of the memory used by the workers and tells them
+# which pages and slides to evict when the memory limit is exceeded. It also writes the
+# current memory use to a status file every few seconds
+def slide_server_cache_manager_process_run(cache_queue, evict_queues, budget, status_file=None, status_interval=5.0):
+    t_last_status, changed = time.monotonic(), False
     try:
         while(True):
-            (id,url,index,t_access) = cache_queue.get()
-            cache_metadata[(id,url,index)] = t_access
-            if time.time_ns() - t_last_print > 5 * 1e9:
-                print(f'Cache Manager: {len(cache_metadata)} of {max_pages} allocated')
-                t_last_print = time.time_ns()
-            if len(cache_metadata) > max_pages:
-                l_purge = SortedKeyList(key=lambda x:x[1])
-                for key, t_access in cache_metadata.items():
-                    l_purge.add((key, t_access))
-
-                n_purge = min(max(1,int(purge_size_pct * max_pages)), len(l_purge)-1)
-                t_purge = l_purge[n_purge][1]
-                print(f'Cache manager: Purging cache with cutoff t={t_purge}')
-                cache_metadata = dict({
-                    key:t_access for key, t_access in cache_metadata.items() if t_access >= t_purge })
-
-                # This communicates to the workers that their caches must be freed
-                purge_value.value = t_purge
+            try:
+                (id, batch) = cache_queue.get(timeout=status_interval)
+                budget.update(id, batch)
+                changed = True
+                
+                # Each worker receives the list of its own items to evict
+                for id_ev, notices in budget.evict().items():
+                    evict_queues[id_ev].put(notices)
+            except queue.Empty:
+                pass
+                
+            if changed and time.monotonic() - t_last_status > status_interval:
+                status = budget.status()
+                print(f'Cache Manager: {status["total_bytes"] / 1024**2:.1f}MB of '
+                      f'{status["max_bytes"] / 1024**2:.1f}MB allocated, {status["n_evicted"]} items evicted')
+                if status_file:
+                    write_slide_server_status(status_file, status)
+                t_last_status, changed = time.monotonic(), False
     except KeyboardInterrupt:
         print('Cache manager processinterrupted by keyboard')
 
 
+# Write the slide server status file, replacing it atomically
+def write_slide_server_status(status_file, status):
+    try:
+        os.makedirs(os.path.dirname(status_file), exist_ok=True)
+        with open(status_file + '.tmp', 'w') as f:
+            json.dump(status, f)
+        os.replace(status_file + '.tmp', status_file)
+    except OSError as e:
+        print(f'Failed to write slide server status to {status_file}: {e}')
+
+
+# Create the block of shared memory that holds the page cache shared by all slide server
+# workers, divided into units of the smallest page size. Returns None if there is not 
+# enough shared memory for the requested cache size
+def create_shared_page_slab(page_size_mb, n_pages, min_page_size_kb=None):
+    size = SharedSlabPageCache.slab_size(page_size_mb, n_pages, min_page_size_kb * 1024 if min_page_size_kb else None)
+    try:
+        # Shared memory beyond the size of /dev/shm would crash the workers on access
+        st = os.statvfs('/dev/shm')
+        if st.f_bavail * st.f_frsize < size:
+            print(f'Not enough space in /dev/shm for a shared page cache of {size // 1024**2}MB')
+            return None
+        return shared_memory.SharedMemory(create=True, size=size)
+    except OSError as e:
+        print(f'Unable to create shared page cache of {size // 1024**2}MB: {e}')
+        return None
+
+
 # Command to run openslide server
 @click.command('slide-server-run')
 @with_appcontext
 def run_slide_server():
-    # Create the queue and value to share between processes
-    cache_queue = multiprocessing.Queue()
-    purge_value = multiprocessing.Value(ctypes.c_longlong, int(time.time_ns()))
+    # Create the queue for memory use reports and the eviction queue for each worker
     socket_addr_list = current_app.config['SLIDE_SERVER_ADDR']
+    cache_queue = multiprocessing.Queue()
+    evict_queues = [ multiprocessing.Queue() for _ in socket_addr_list ]
     
     # Load cache properties
     page_size_mb = current_app.config['SLIDE_SERVER_CACHE_PAGE_SIZE_MB']
     cache_size_pg = current_app.config['SLIDE_SERVER_CACHE_SIZE_IN_PAGES']
+    l2_cache_size_mb = current_app.config['SLIDE_SERVER_L2_CACHE_SIZE_MB']
+    memory_limit_mb = current_app.config['SLIDE_SERVER_MEMORY_LIMIT_MB']
+    handler_opts = dict(
+        decode_threads = current_app.config['SLIDE_SERVER_DECODE_THREADS'],
+        coalesce_gap_kb = current_app.config['SLIDE_SERVER_COALESCE_GAP_KB'],
+        readahead = current_app.config['SLIDE_SERVER_READAHEAD'],
+        l2_cache_dir = current_app.config['SLIDE_SERVER_L2_CACHE_DIR'],
+        l2_cache_size_mb = l2_cache_size_mb,
+        index_cache_dir = current_app.config['SLIDE_SERVER_INDEX_CACHE_DIR'],
+        index_cache_size_mb = current_app.config['SLIDE_SERVER_INDEX_CACHE_SIZE_MB'],
+        min_page_size_kb = current_app.config['SLIDE_SERVER_MIN_PAGE_SIZE_KB'],
+        levels_dir = current_app.config['SLIDE_LEVELS_DIR'],
+        openslide_cache_mb = current_app.config['SLIDE_SERVER_OPENSLIDE_CACHE_MB'])
     
-    # Start the manager process
+    # Create the page cache shared by all workers, unless this is disabled or not
+    # possible, in which case each worker has its own page cache
+    slab = None
+    if current_app.config['SLIDE_SERVER_SHARED_CACHE']:
+        slab = create_shared_page_slab(page_size_mb, cache_size_pg, handler_opts['min_page_size_kb'])
+    if slab is not None:
+        atexit.register(slab.unlink)
+        handler_opts['shared_cache'] = (slab.name, [ multiprocessing.Lock() for _ in range(64) ])
+        
+    # Start the manager process that keeps the memory used by the workers within the limit
+    budget = SlideServerMemoryBudget(
+        int(memory_limit_mb * 1024**2), fixed_bytes=slab.size if slab else 0,
+        slide_share=current_app.config['SLIDE_SERVER_SLIDE_SHARE'])
+    if slab is not None and budget.budget == 0:
+        print(f'Warning: the shared page cache uses all of SLIDE_SERVER_MEMORY_LIMIT_MB={memory_limit_mb}')
     p_man = multiprocessing.Process(
         target = slide_server_cache_manager_process_run,
-        args = (cache_queue, purge_value, cache_size_pg))
+        args = (cache_queue, evict_queues, budget, current_app.config['SLIDE_SERVER_STATUS_FILE']))
     p_man.start()
 
     # Start the worker processes
@@ -731,13 +2038,16 @@ def run_slide_server():
     for k in range(len(current_app.config['SLIDE_SERVER_ADDR'])):
         p = multiprocessing.Process(
             target = slide_server_process_run,
-            args = (k, socket_addr_list, page_size_mb, cache_queue, purge_value))
+            args = (k, socket_addr_list, page_size_mb, cache_queue, evict_queues[k]),
+            kwargs = handler_opts)
         p.start()
         p_workers.append(p)
 
     # Print startup message
     print(f'PHAS slide server started with {len(p_workers)} workers, '
-          f'total cache size {cache_size_pg*page_size_mb}MB')
+          f'total cache size {cache_size_pg*page_size_mb}MB ({"shared" if slab else "per worker"}), '
+          f'memory limit {memory_limit_mb}MB, '
+          f'disk cache size {l2_cache_size_mb}MB')
 
     # Wait for the workers to finish (never)
     for p in p_workers:
@@ -786,8 +2096,222 @@ def list_slide_associated_images(project, slide_id):
         print(f'{k}: {v}')
     
 
+# Command to show the memory used by the slide server
+@click.command('slide-server-status')
+@click.option('-n', '--num-slides', default=10, help='Number of largest slides to list')
+@with_appcontext
+def slide_server_status_command(num_slides):
+    """Print the memory used by the slide server by tier, worker and slide"""
+    status_file = current_app.config['SLIDE_SERVER_STATUS_FILE']
+    try:
+        with open(status_file) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        print(f'No slide server status in {status_file}, is the slide server running?')
+        return
+    
+    mb = lambda n: f'{n / 1024**2:10.1f}MB'
+    print(f'Slide server status as of {datetime.fromtimestamp(status["time"]).strftime("%Y-%m-%d %H:%M:%S")}')
+    print(f'  Memory used  : {mb(status["total_bytes"])} of {mb(status["max_bytes"])}')
+    for tier, n in status['tiers'].items():
+        print(f'  {tier:13s}: {mb(n)}')
+    print(f'  Open slides  : {status["n_slides"]}')
+    print(f'  Items        : {status["n_items"]}')
+    print(f'  Evicted      : {status["n_evicted"]}')
+    print('Workers:')
+    for worker, n in status['workers'].items():
+        print(f'  {int(worker):02d}           : {mb(n)}')
+    print('Largest slides:')
+    for slide in status['slides'][:num_slides]:
+        print(f'  {mb(slide["bytes"])}  {slide["url"]}')
+
+
+# Command to show how slides are assigned to slide server workers
+@click.command('slide-server-routing')
+@click.option('-p', '--project', default=None, help='Only list slides in this project')
+@click.option('-r', '--resource', default='raw', help='Slide resource to route (default: raw)')
+@click.option('-n', '--numproc', default=None, type=int, 
+              help='Show the assignment for this number of workers instead of SLIDE_SERVER_NUMPROC')
+@click.option('-s', '--summary', is_flag=True, help='Only print the per-worker load')
+@with_appcontext
+def slide_server_routing_command(project, resource, numproc, summary):
+    """Print the slide to slide server worker assignment and per-worker load"""
+    socket_addr_list = current_app.config['SLIDE_SERVER_ADDR']
+    if numproc is not None:
+        sock_dir = os.path.dirname(socket_addr_list[0])
+        new_addr_list = [ os.path.join(sock_dir, f'oslserver_{i:02d}.sock') for i in range(numproc) ]
+    else:
+        new_addr_list = socket_addr_list
+        
+    # Read the slides from the database
+    db = get_db()
+    if project is not None:
+        rc = db.execute('SELECT id, project FROM slide_info WHERE project=? ORDER BY id', (project,)).fetchall()
+    else:
+        rc = db.execute('SELECT id, project FROM slide_info ORDER BY project, id').fetchall()
+        
+    # Route each slide
+    load = { os.path.basename(addr): 0 for addr in new_addr_list }
+    n_moved, n_total, pr_cache = 0, 0, {}
+    for row in rc:
+        if row['project'] not in pr_cache:
+            pr_cache[row['project']] = ProjectRef(row['project'])
+        sr = get_slide_ref(row['id'], pr_cache[row['project']])
+        url = sr.get_resource_url(resource, False)
+        if url is None:
+            continue
+        worker = os.path.basename(slide_server_route(url, new_addr_list))
+        current = os.path.basename(slide_server_route(url, socket_addr_list))
+        load[worker] += 1
+        n_total += 1
+        n_moved += 1 if worker != current else 0
+        if not summary:
+            print(f'{row["id"]:8d}  {worker}  {url}')
+            
+    # Print the load for each worker
+    print(f'Per-worker load ({n_total} slides, {len(new_addr_list)} workers):')
+    for worker, n in load.items():
+        print(f'  {worker}: {n:6d} slides ({100.0 * n / max(n_total, 1):5.1f}%)')
+    if numproc is not None:
+        print(f'Slides moved relative to current configuration: {n_moved} of {n_total}')
+
+
+# Command to check that a slide can be read through the byte range sources
+@click.command('slide-source-check')
+@click.argument('url')
+@click.option('-n', '--num-reads', default=100, help='Number of random byte ranges to read')
+@with_appcontext
+def slide_source_check_command(url, num_reads):
+    """Check reading a slide URL (gs://, http(s)://, file://) as a byte range source.
+    
+    Each of a number of random ranges is compared with the same range read in two parts,
+    and the slide levels are then listed if the file is a TIFF slide.
+    """
+    try:
+        src = open_byte_range_source(url)
+    except Exception as e:
+        raise click.ClickException(f'Unable to open {url}: {e}')
+    if src is None:
+        raise click.ClickException(f'{url} is not a gs://, http(s):// or file:// URL')
+    print(f'Opened {url}: size {src.size}, version {src.version}')
+        
+    # Read random ranges and compare them with the same ranges read in two parts
+    n_bad, t0 = 0, time.time()
+    for i in range(num_reads):
+        offset = randint(0, src.size - 1)
+        size = randint(1, min(src.size - offset, 1024**2))
+        data = src.read_range(offset, size)
+        k = randint(0, size)
+        expected = (src.read_range(offset, k) if k > 0 else b'') + \
+                   (src.read_range(offset + k, size - k) if k < size else b'')
+        if data != expected:
+            print(f'Mismatch reading {size} bytes at offset {offset}')
+            n_bad += 1
+    print(f'Read {num_reads} ranges in {time.time() - t0:.2f}s, {n_bad} mismatches')
+    
+    # Open the file as a slide
+    try:
+        osl = RemoteOpenSlideWrapper(src, SelfManagedMultiFilePageCache(cache_max_size_mb=64))
+        print(f'Slide levels: {", ".join(f"{w}x{h}" for (w, h) in osl.level_dimensions)}')
+    except Exception as e:
+        print(f'Unable to read the file as a slide: {e}')
+    if n_bad > 0:
+        raise click.ClickException(f'{n_bad} of {num_reads} ranges did not match')
+
+
+# Build the synthetic pyramid levels of a slide if its pyramid has large gaps. The
+# slide is read directly by this process rather than through the slide server
+def build_slide_levels(url, levels_dir, max_ratio=4.0, min_size=1024, quality=90, force=False, dry_run=False):
+    source = open_byte_range_source(url)
+    if source is not None:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        osl = RemoteOpenSlideWrapper(source, SelfManagedMultiFilePageCache(cache_max_size_mb=512), executor)
+        version = source.version
+    else:
+        from openslide import OpenSlide
+        osl = OpenSlide(url)
+        version = local_file_version(url)
+
+    plan = plan_synthetic_levels(osl.level_dimensions, max_ratio, min_size)
+    if not plan:
+        return 'ok', 'no gaps'
+    if not force and load_synthetic_levels_manifest(levels_dir, url, version) is not None:
+        return 'ok', 'already built'
+    desc = ', '.join(f'{w}x{h}' for (_, _, (w, h)) in plan)
+    if dry_run:
+        return 'missing', desc
+
+    # Tiles of the synthetic levels match the stored tiles of the slide, so that they
+    # can also be passed through to the browser
+    build_synthetic_levels(osl, synthetic_levels_path(levels_dir, url, version), plan,
+                           tile_size=getattr(osl, 'jpeg_tile_size', None) or 256, quality=quality,
+                           metadata={'url': url, 'version': version})
+    return 'built', desc
+
+
+# Command to build synthetic pyramid levels for slides with large gaps between levels
+@click.command('slides-build-levels')
+@click.option('-p', '--project', default=None, help='Only build levels for slides in this project')
+@click.option('-s', '--slide', 'slide_ids', multiple=True, type=int, help='Only build levels for this slide')
+@click.option('-r', '--resource', default='raw', help='Slide resource to build levels for (default: raw)')
+@click.option('--max-ratio', default=4.0, help='Fill gaps where consecutive levels differ by more than this factor')
+@click.option('--min-size', default=1024, help='Add levels until the smallest level fits within this size')
+@click.option('--quality', default=90, help='JPEG quality of the synthetic levels')
+@click.option('--force', is_flag=True, help='Rebuild levels that have already been built')
+@click.option('--dry-run', is_flag=True, help='Only list the slides that need levels')
+@click.option('--repeat', default=None, type=float,
+              help='Keep running in the background, checking for new slides every this many minutes')
+@with_appcontext
+def slides_build_levels_command(project, slide_ids, resource, max_ratio, min_size, quality, force, dry_run, repeat):
+    """Build the missing intermediate pyramid levels of sparsely pyramided slides"""
+    levels_dir = current_app.config['SLIDE_LEVELS_DIR']
+    while True:
+        # Read the slides from the database
+        db = get_db()
+        if project is not None:
+            rc = db.execute('SELECT id, project FROM slide_info WHERE project=? ORDER BY id', (project,)).fetchall()
+        else:
+            rc = db.execute('SELECT id, project FROM slide_info ORDER BY project, id').fetchall()
+
+        # Build the levels for each slide, skipping slides that can't be read
+        n_built, pr_cache = 0, {}
+        for row in rc:
+            if slide_ids and row['id'] not in slide_ids:
+                continue
+            if row['project'] not in pr_cache:
+                pr_cache[row['project']] = ProjectRef(row['project'])
+            sr = get_slide_ref(row['id'], pr_cache[row['project']])
+            url = sr.get_resource_url(resource, False)
+            if url is None:
+                continue
+            t0 = time.time()
+            try:
+                status, desc = build_slide_levels(url, levels_dir, max_ratio, min_size, quality, force, dry_run)
+            except Exception as e:
+                print(f'{row["id"]:8d}  failed     {url}: {e}')
+                continue
+            if status != 'ok':
+                print(f'{row["id"]:8d}  {status:9s}  {url}: {desc}' +
+                      (f' ({time.time() - t0:.1f}s)' if status == 'built' else ''))
+                n_built += 1 if status == 'built' else 0
+        print(f'Built synthetic levels for {n_built} slides')
+
+        if repeat is None:
+            break
+        force = False
+        time.sleep(repeat * 60)
+
+
 # CLI stuff
 def init_app(app):
+    slide_server_shm.size = int(app.config.get('SLIDE_SERVER_SHM_SIZE_MB', 0) * 1024**2)
+    slide_descriptor_cache.ttl = app.config.get('SLIDE_SERVER_DESCRIPTOR_TTL', 300)
+    slide_server_pool.timeout = app.config.get('SLIDE_SERVER_TIMEOUT', 120)
+    dz_geometry_cache.max_bytes = int(app.config.get('DZI_GEOMETRY_CACHE_SIZE_MB', 16) * 1024**2)
     app.cli.add_command(delegate_dzi_ping_command)
     app.cli.add_command(run_slide_server)
     app.cli.add_command(list_slide_associated_images)
+    app.cli.add_command(slide_server_routing_command)
+    app.cli.add_command(slide_server_status_command)
+    app.cli.add_command(slides_build_levels_command)
+    app.cli.add_command(slide_source_check_command)
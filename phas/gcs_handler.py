@@ -16,15 +16,21 @@
 #   along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 import urllib.parse as urlparse
+import re
 import os
+import sys
 import threading
 from google.cloud import storage
+import httpx
 import io
 import tifffile
 import numpy as np
 from PIL import Image
-from sortedcontainers import SortedKeyList
+from collections import OrderedDict
 import time
+import bisect
+import pickle
+from .tile_cache import LocalDiskCache
 
 # This class handles remote URLs for Google cloud. The remote URLs must have format
 # "gs://bucket/path/to/blob.ext"
@@ -126,30 +132,88 @@ class AbstractMultiFilePageCache:
         self.cache = {}
         self.page_size = page_size_mb * 1024**2
         self.t_last_purge = time.time_ns()
+        
+        # The cache may be shared by multiple threads. The lock protects the page
+        # dictionaries, and in_flight holds an event for each page that is currently
+        # being fetched, so that other threads wait for it instead of fetching it again
+        self.lock = threading.RLock()
+        self.in_flight = {}
+        
+        # Optional second tier on local disk, which receives the pages that are purged
+        # from memory and is checked before pages are read from the source
+        self.l2 = None
 
     def get_page(self, url, pageno):        
-        pages = self.cache.get(url)
-        if not pages:
-            self.cache[url] = pages = dict()
-        page = pages.get(pageno)
-        if page:
-            page.t_access = time.time_ns()
-            return page
+        with self.lock:
+            pages = self.cache.get(url)
+            if not pages:
+                self.cache[url] = pages = dict()
+            page = pages.get(pageno)
+            if page:
+                page.t_access = time.time_ns()
+                return page
     
     def set_page(self, url, pageno, data):
-        pages = self.cache.get(url)
-        if not pages:
-            self.cache[url] = pages = dict()
-        page = pages.get(pageno)
-        if not page:
-            pages[pageno] = page = self.CachePage(pageno, time.time_ns(), data)
-            return page
+        with self.lock:
+            pages = self.cache.get(url)
+            if not pages:
+                self.cache[url] = pages = dict()
+            page = pages.get(pageno)
+            if not page:
+                pages[pageno] = page = self.CachePage(pageno, time.time_ns(), data)
+                return page
+
+    def copy_page(self, url, pageno, off_page, size, dest, off_dest):
+        """Copy up to size bytes of a cached page, starting at off_page, into dest at
+        off_dest. Returns the number of bytes copied, or None if the page is not cached"""
+        page = self.get_page(url, pageno)
+        if page is None:
+            return None
+        n = max(0, min(size, len(page.data) - off_page))
+        dest[off_dest:off_dest+n] = memoryview(page.data)[off_page:off_page+n]
+        return n
+    
+    def touch_page(self, url, pageno):
+        """Update the access time of a page, returning False if the page is not cached"""
+        return self.get_page(url, pageno) is not None
 
     def purge(self, t_purge):
-        if t_purge > self.t_last_purge:
-            for url, pages in self.cache.items():
-                self.cache[url] = dict({ i: page for (i, page) in pages.items() if page.t_access >= t_purge })
-            self.t_last_purge = t_purge
+        evicted = []
+        with self.lock:
+            if t_purge > self.t_last_purge:
+                for url, pages in self.cache.items():
+                    stale = [ i for (i, page) in pages.items() if page.t_access < t_purge ]
+                    evicted.extend([ (url, pages.pop(i)) for i in stale ])
+                self.t_last_purge = t_purge
+        self._spill(evicted)
+
+    def evict_pages(self, pages):
+        """Evict specific pages, given as a list of (url, pageno, t_access) tuples. A page
+        is only evicted if it has not been accessed since t_access, so that pages touched
+        after the eviction decision was made are kept"""
+        evicted = []
+        with self.lock:
+            for url, pageno, t_access in pages:
+                url_pages = self.cache.get(url)
+                page = url_pages.get(pageno) if url_pages else None
+                if page is not None and page.t_access <= t_access:
+                    evicted.append((url, url_pages.pop(pageno)))
+                    if not url_pages:
+                        del self.cache[url]
+            if len(evicted):
+                self.t_last_purge = time.time_ns()
+        self._spill(evicted)
+        return len(evicted)
+
+    # Spill evicted pages to the second tier, outside of the lock. The second tier is
+    # normally a WriteBehindDiskCache, which writes them in a background thread
+    def _spill(self, evicted):
+        if self.l2 is not None:
+            for url, page in evicted:
+                self.l2.put(self.l2_key(url, page.index), page.data)
+            
+    def l2_key(self, url, pageno):
+        return (url, self.page_size, pageno)
 
 
 class SelfManagedMultiFilePageCache(AbstractMultiFilePageCache):
@@ -157,8 +221,11 @@ class SelfManagedMultiFilePageCache(AbstractMultiFilePageCache):
     An in-memory cache for large files. A file is divided into discrete pages of equal
     size. Each page has a timestamp that is updated when the page is read or written.
 
-    This cache does simple memory management based on maximum allowed size. When the size
-    is exceeded, the specified fraction of the cache is purged.
+    This cache does simple memory management based on maximum allowed size. Pages are 
+    kept in an LRU ordered dict, in which an access moves a page to the end, and the
+    page dicts of the files serve as the index of the pages of each file. When the size
+    is exceeded, the least recently used pages are evicted until the specified fraction
+    of the cache is free, which takes time proportional to the number of evicted pages.
     """
 
     def __init__(self, page_size_mb=1, cache_max_size_mb=1024, purge_size_pct=0.25):
@@ -166,28 +233,103 @@ class SelfManagedMultiFilePageCache(AbstractMultiFilePageCache):
         self.cache_max_size = cache_max_size_mb * 1024**2
         self.purge_size_pct = purge_size_pct
         self.total_size = 0
+        self.lru = OrderedDict()
+
+    def get_page(self, url, pageno):
+        with self.lock:
+            page = AbstractMultiFilePageCache.get_page(self, url, pageno)
+            if page:
+                self.lru.move_to_end((url, pageno))
+            return page
 
     def set_page(self, url, pageno, data):
-        page = AbstractMultiFilePageCache.set_page(self, url, pageno, data)
-        if page:
-            self.total_size += self.page_size
-        
-        if self.total_size >= self.cache_max_size:
-            # Time has come to purge the cache. For this we need to sort
-            # all the pages by access time
-            l_purge = SortedKeyList()
-            for _, pp in self.cache.items():
-                for _, page in pp.items():
-                    l_purge.add(page.t_access)
-                    
-            # Purge pages to free up space
-            n_purge = min(max(1, int(len(l_purge) * self.purge_size_pct)), len(l_purge)-1)
-            if n_purge > 0:
-                self.purge(l_purge[n_purge-1])
-                
+        evicted = []
+        with self.lock:
+            page = AbstractMultiFilePageCache.set_page(self, url, pageno, data)
+            if page:
+                self.lru[(url, pageno)] = len(data)
+                self.total_size += len(data)
+            
+            # Evict the least recently used pages once the cache is full
+            if self.total_size >= self.cache_max_size:
+                while self.total_size > self.cache_max_size * (1 - self.purge_size_pct) and len(self.lru) > 1:
+                    evicted.append(self._remove(*next(iter(self.lru))))
+        self._spill(evicted)
         return page
+
+    def purge(self, t_purge):
+        # Pages in the LRU are ordered by access time, so the stale pages are at the front
+        evicted = []
+        with self.lock:
+            while len(self.lru):
+                url, pageno = next(iter(self.lru))
+                if self.cache[url][pageno].t_access >= t_purge:
+                    break
+                evicted.append(self._remove(url, pageno))
+            self.t_last_purge = max(self.t_last_purge, t_purge)
+        self._spill(evicted)
+
+    def evict_pages(self, pages):
+        evicted = []
+        with self.lock:
+            for url, pageno, t_access in pages:
+                page = self.cache.get(url, {}).get(pageno)
+                if page is not None and page.t_access <= t_access:
+                    evicted.append(self._remove(url, pageno))
+        self._spill(evicted)
+        return len(evicted)
+
+    def purge_file(self, url):
+        """Evict all the pages of a file"""
+        with self.lock:
+            evicted = [ self._remove(url, pageno) for pageno in list(self.cache.get(url, {})) ]
+        self._spill(evicted)
+        return len(evicted)
+
+    def _remove(self, url, pageno):
+        # Remove a page from the LRU and the index of its file, called with the lock held
+        self.total_size -= self.lru.pop((url, pageno))
+        pages = self.cache[url]
+        page = pages.pop(pageno)
+        if not pages:
+            del self.cache[url]
+        return url, page
         
 
+class MemoryUsageReporter:
+    """
+    Reports the items held in memory by a slide server worker (cache pages and open
+    slides) to the manager process, which accounts for the memory used by all workers
+    and decides which items to evict. Each report holds the item's last access time
+    and its size in bytes. Accesses are not sent one by one. Instead the latest report
+    for each item is kept here and the reports are sent as a batch, so that repeated 
+    reads of the same item cost a single entry.
+    """
+
+    def __init__(self, unique_id, report_queue, batch_size=64):
+        self.unique_id = unique_id
+        self.report_queue = report_queue
+        self.batch_size = batch_size
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def report(self, url, item, t_access, n_bytes):
+        with self.lock:
+            self.pending[(url, item)] = (t_access, n_bytes)
+            if len(self.pending) < self.batch_size:
+                return
+        self.flush()
+
+    def flush(self):
+        """Send the pending reports to the manager process"""
+        with self.lock:
+            if not self.pending:
+                return
+            batch = [ (url, item, t, n) for ((url, item), (t, n)) in self.pending.items() ]
+            self.pending = {}
+        self.report_queue.put((self.unique_id, batch))
+
+
 class MultiprocessManagedMultiFilePageCache(AbstractMultiFilePageCache):
     """
     An in-memory cache for large files. A file is divided into discrete pages of equal
@@ -195,46 +337,302 @@ class MultiprocessManagedMultiFilePageCache(AbstractMultiFilePageCache):
 
     A special feature of this cache is that it is designed to be used in a multiprocess
     setting. Each process has its own cache, but the size of the cache across all the 
-    processes is monitored and constrained. The cache is purged whenever the total size
-    of all caches exceeds a threshhold. To facilitate this, the cache writes to a queue
-    each time that a page is read or written, allowing the manager process to keep track
-    of pages and timestamps across all pages. 
+    processes is monitored and constrained. To facilitate this, the cache reports
+    page reads and writes, with the size of each page, to the manager process, which
+    keeps track of pages and timestamps across all pages. When the total memory used 
+    by all processes exceeds a threshold, the manager tells each process which of its
+    pages to evict.
     """
 
-    def __init__(self, unique_id, report_queue, page_size_mb=1):
+    def __init__(self, reporter, page_size_mb=1):
         AbstractMultiFilePageCache.__init__(self, page_size_mb)
         self.cache = {}
-        self.unique_id = unique_id
-        self.report_queue = report_queue
+        self.reporter = reporter
         self.page_size = page_size_mb * 1024**2
 
     def get_page(self, url, pageno):        
         page = AbstractMultiFilePageCache.get_page(self, url, pageno)
         if page:
-            self.report_queue.put((self.unique_id, url, pageno, page.t_access))
+            self.reporter.report(url, pageno, page.t_access, len(page.data))
         return page
 
     def set_page(self, url, pageno, data):
         page = AbstractMultiFilePageCache.set_page(self, url, pageno, data)
         if page:
-            self.report_queue.put((self.unique_id, url, pageno, page.t_access))
+            self.reporter.report(url, pageno, page.t_access, len(page.data))
         return page
 
 
+class SharedSlabPageCache:
+    """
+    A page cache that lives in a single block of shared memory (the slab) that is
+    attached by all slide server workers, so that a page fetched by one worker is
+    available to all of them and the total size of the cache is strictly bounded.
+    
+    The slab holds a table of headers followed by the page data, which is divided into
+    units of the smallest page size. A page takes a run of units whose length is a power
+    of two and which is aligned to its length, so pages smaller than the cache's page
+    size only take the space they need. The header of the first unit of a page stores
+    the hash of the page key (URL, page size and page number) and the length of the
+    data, and the headers of all the units of a page store its access time and its
+    first unit. The cache is set-associative: a key can only be stored in the set of 
+    units given by its hash, which holds ways pages of the cache's page size, and when
+    the set is full, the least recently used run of units of the set is reused. Sets
+    are protected by a list of striped interprocess locks, so workers only contend when
+    they access the same stripe.
+    
+    Pages are copied out of the slab under the lock of their set, so readers never see
+    a page that is being overwritten, and readers only copy the part of a page that 
+    they need. Pages that are replaced are spilled to the second tier on 
+    local disk if there is one. The slab counts the pages that are replaced within
+    hot_age seconds of their last access, which tells workers that the slab is too 
+    small for the pages in use and that readahead should back off.
+    """
+    
+    # Size of the header of each unit in bytes: key hash, access time, data length
+    # and first unit of the page
+    header_size = 48
+    
+    CachePage = AbstractMultiFilePageCache.CachePage
+    
+    @classmethod
+    def _units_per_page(cls, page_size, unit_size):
+        # Number of units in a page of the cache's size, which is a power of two
+        return 1 << ((page_size // min(unit_size or page_size, page_size)).bit_length() - 1)
+    
+    @classmethod
+    def slab_size(cls, page_size_mb, n_pages, unit_size=None):
+        """Size of the shared memory block needed to hold n_pages pages"""
+        page_size = page_size_mb * 1024**2
+        return cls._data_offset(n_pages * cls._units_per_page(page_size, unit_size)) + n_pages * page_size
+    
+    @classmethod
+    def _data_offset(cls, n_units):
+        # Page data starts at the first 4K boundary after the headers and the counter
+        # of recently used pages that were replaced
+        return -(-(n_units * cls.header_size + 8) // 4096) * 4096
+    
+    def __init__(self, buf, locks, page_size_mb=1, ways=8, unit_size=None, hot_age=60.0):
+        self.page_size = page_size_mb * 1024**2
+        self.buf = buf
+        self.locks = locks
+        self.ways = ways
+        self.hot_age_ns = int(hot_age * 1000**3)
+        
+        # Work out how many pages of the cache's size fit into the buffer
+        k = self._units_per_page(self.page_size, unit_size)
+        self.unit_size = self.page_size // k
+        n_pages = len(buf) // (self.header_size * k + self.page_size)
+        while self._data_offset(n_pages * k) + n_pages * self.page_size > len(buf):
+            n_pages -= 1
+        n_units = n_pages * k
+        self.set_units = ways * k
+        self.n_sets = n_pages // ways
+        self.n_units = self.n_sets * self.set_units
+        
+        # Views of the header table (keys, access times, lengths, first units) and the units
+        self.keys = np.ndarray((n_units, 24), dtype=np.uint8, buffer=buf, offset=0)
+        self.t_access = np.ndarray((n_units,), dtype=np.int64, buffer=buf, offset=n_units * 24)
+        self.lengths = np.ndarray((n_units,), dtype=np.int64, buffer=buf, offset=n_units * 32)
+        self.heads = np.ndarray((n_units,), dtype=np.int64, buffer=buf, offset=n_units * 40)
+        self.n_hot_replaced = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=n_units * 48)
+        self.data = np.ndarray((n_units, self.unit_size), dtype=np.uint8, buffer=buf, 
+                               offset=self._data_offset(n_units))
+        
+        # Process-local state used by CachedFileRepresentation to avoid fetching the
+        # same page twice within this process
+        self.lock = threading.RLock()
+        self.in_flight = {}
+        self.t_last_purge = time.time_ns()
+        self.l2 = None
+        
+    def l2_key(self, url, pageno):
+        return (url, self.page_size, pageno)
+    
+    def _locate(self, url, pageno):
+        # The key hash is the same as the digest used by the second tier, so that
+        # replaced pages can be spilled without knowing their URL
+        digest = LocalDiskCache.digest(self.l2_key(url, pageno))
+        key = np.zeros(24, dtype=np.uint8)
+        key[:len(digest)] = np.frombuffer(digest, dtype=np.uint8)
+        i_set = int.from_bytes(digest[:8], 'little') % self.n_sets
+        return key, i_set, self.locks[i_set % len(self.locks)]
+    
+    def _find(self, key, i_set):
+        u0 = i_set * self.set_units
+        match = np.flatnonzero((self.keys[u0:u0+self.set_units] == key).all(axis=1))
+        return u0 + match[0] if len(match) else None
+    
+    def _units(self, length):
+        # Number of units taken by a page with length bytes of data
+        return 1 << (max(1, -(-int(length) // self.unit_size)) - 1).bit_length()
+    
+    def _page_data(self, u):
+        # View of the data of the page whose first unit is u
+        n = int(self.lengths[u])
+        return self.data[u:u+self._units(n)].reshape(-1)[:n]
+        
+    def get_page(self, url, pageno):
+        key, i_set, lock = self._locate(url, pageno)
+        with lock:
+            u = self._find(key, i_set)
+            if u is not None:
+                t = time.time_ns()
+                self.t_access[u:u+self._units(self.lengths[u])] = t
+                return self.CachePage(pageno, t, self._page_data(u).tobytes())
+            
+    def copy_page(self, url, pageno, off_page, size, dest, off_dest):
+        """Copy up to size bytes of a cached page, starting at off_page, into dest at
+        off_dest. Returns the number of bytes copied, or None if the page is not cached"""
+        key, i_set, lock = self._locate(url, pageno)
+        with lock:
+            u = self._find(key, i_set)
+            if u is None:
+                return None
+            self.t_access[u:u+self._units(self.lengths[u])] = time.time_ns()
+            data = self._page_data(u)
+            n = max(0, min(size, len(data) - off_page))
+            dest[off_dest:off_dest+n] = memoryview(data[off_page:off_page+n])
+            return n
+    
+    def touch_page(self, url, pageno):
+        """Update the access time of a page, returning False if the page is not cached"""
+        key, i_set, lock = self._locate(url, pageno)
+        with lock:
+            u = self._find(key, i_set)
+            if u is not None:
+                self.t_access[u:u+self._units(self.lengths[u])] = time.time_ns()
+            return u is not None
+            
+    def set_page(self, url, pageno, data):
+        key, i_set, lock = self._locate(url, pageno)
+        m = self._units(len(data))
+        spill = []
+        with lock:
+            if self._find(key, i_set) is not None:
+                return None
+            
+            # Use the aligned run of units of the set whose most recently used unit is
+            # the oldest, which is an empty run if there is one
+            u0 = i_set * self.set_units
+            t_runs = self.t_access[u0:u0+self.set_units].reshape(-1, m).max(axis=1)
+            u = u0 + int(np.argmin(t_runs)) * m
+            
+            # Remove the pages that overlap the run. Since runs are aligned to their
+            # length, each of these pages either lies within the run or contains it
+            t = time.time_ns()
+            for h in np.unique(self.heads[u:u+m][self.t_access[u:u+m] > 0]):
+                if self.l2 is not None:
+                    spill.append((self.keys[h, :20].tobytes(), self._page_data(h).tobytes()))
+                if self.t_access[h] > t - self.hot_age_ns:
+                    # The counter is shared by all sets, so concurrent updates under
+                    # different locks may lose counts, which only delays the signal
+                    self.n_hot_replaced[0] += 1
+                self.keys[h] = 0
+                self.t_access[h:h+self._units(self.lengths[h])] = 0
+                
+            # Write the page, whose key is set last so that it is only found when complete
+            self.data[u:u+m].reshape(-1)[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+            self.lengths[u] = len(data)
+            self.heads[u:u+m] = u
+            self.t_access[u:u+m] = t
+            self.keys[u] = key
+        
+        # Spill the replaced pages outside of the lock. The second tier queues them to
+        # be written by its background thread, so the disk is not written on this thread
+        for digest, page_data in spill:
+            self.l2.put(None, page_data, digest=digest)
+        return self.CachePage(pageno, t, data)
+    
+    def purge(self, t_purge):
+        # Pages are replaced within their set as new pages arrive, so the cache
+        # never needs to be purged to stay within its size
+        pass
+
+    def evict_pages(self, pages):
+        # The slab is bounded by its size and is not managed by the cache manager
+        return 0
+    
+    def hot_replacements(self):
+        """Number of pages replaced within hot_age seconds of their last access, by all
+        the workers that share the slab"""
+        return int(self.n_hot_replaced[0])
+    
+    def usage(self):
+        """Number of units in use and total number of units"""
+        return int(np.count_nonzero(self.t_access)), self.n_units
+
+
 class CachedFileRepresentation:
     """
     This class works together with a cache to provide fast access to files that may
     be on a remote filesystem. The main method is readinto which reads data either 
     from the source using the callback supplied by the user, or from the cache if
     available.
+    
+    Each file may use its own page size, up to the page size of the cache. Pages of a
+    file whose page size differs from the cache's are stored under a key that includes
+    the page size, so that the page size can be changed at any time. If min_page_size
+    is smaller than the cache's page size, the page size is adapted to the observed
+    access pattern: it is halved when much of the data read from the source is never
+    requested, and doubled when most reads from the source span many pages.
     """
         
-    def __init__(self, cache):
+    def __init__(self, cache, max_gap=0, min_page_size=None, adapt_interval=64):
         self.cache = cache
-        self.page_size = cache.page_size
+        self.layout = (cache.page_size, '')
+        self.min_page_size = min_page_size or cache.page_size
+        self.adapt_interval = adapt_interval
+        self.n_page_size_changes = 0
+        
+        # Adaptive files start with the smallest pages, which suit the small reads of
+        # the TIFF structure, until the page size is chosen for the tiles
+        self.set_page_size(self.min_page_size)
+        self.n_page_size_changes = 0
+        
+        # Statistics of the current adaptation window
+        self.stats_lock = threading.Lock()
+        self._reset_window()
+        
+        # Runs of missing pages separated by at most this many bytes are read with
+        # a single call, also reading the pages in between
+        self.max_gap = max_gap
+        
+    @property
+    def page_size(self):
+        return self.layout[0]
+        
+    def set_page_size(self, page_size):
+        """Set the page size for this file, which is rounded down to a power of two times
+        the minimum page size and limited to the page size of the cache"""
+        page_size = max(self.min_page_size, min(page_size, self.cache.page_size))
+        page_size = self.min_page_size << ((page_size // self.min_page_size).bit_length() - 1)
+        if page_size != self.page_size:
+            self.layout = (page_size, '' if page_size == self.cache.page_size else f'@{page_size}')
+            self.n_page_size_changes += 1
+            
+    def _reset_window(self):
+        self.w_served, self.w_fetched, self.w_calls, self.w_pages = 0, 0, 0, 0
+            
+    def _adapt(self, served=0, fetched=0, calls=0, pages=0):
+        # Update the statistics of the window and change the page size at the end of it
+        if self.min_page_size >= self.cache.page_size:
+            return
+        with self.stats_lock:
+            self.w_served += served
+            self.w_fetched += fetched
+            self.w_calls += calls
+            self.w_pages += pages
+            if self.w_calls < self.adapt_interval:
+                return
+            if self.w_served < 0.5 * self.w_fetched:
+                self.set_page_size(self.page_size // 2)
+            elif self.w_pages >= 4 * self.w_calls and self.w_served >= self.w_fetched:
+                self.set_page_size(self.page_size * 2)
+            self._reset_window()
         
-    def fullfill(self, offset, size, dest, page):
-        page_start = page.index * self.page_size        
+    def fullfill(self, offset, size, dest, page, ps):
+        page_start = page.index * ps
         off_dest = max(0, page_start - offset)
         off_page = max(0, offset - page_start)
         len_page = len(page.data)
@@ -254,70 +652,324 @@ class CachedFileRepresentation:
             ranges.append((current_start, p1))
         return ranges    
         
+    def _copy_cached(self, url, p, offset, size, dest, ps):
+        # Copy the part of a cached page that falls within the range into the destination,
+        # returning the number of bytes copied or None if the page is not cached
+        page_start = p * ps
+        off_page = max(0, offset - page_start)
+        off_dest = max(0, page_start - offset)
+        n = min(offset + size, page_start + ps) - (page_start + off_page)
+        return self.cache.copy_page(url, p, off_page, n, dest, off_dest)
+        
     def readinto(self, url, offset, size, dest, fn_readinto):
         
         # This is the range of pages that is spanned by the data
-        ps = self.page_size
+        ps, suffix = self.layout
+        url = url + suffix
         p0, p1 = offset // ps, (offset+size-1) // ps
         
-        # Iterate over the needed pages
-        size_fullfilled = 0
-        not_in_cache = []
-        p = p0
-        while True:
-            page = self.cache.get_page(url, p) if p <= p1 else None
-            if p <= p1 and page is None:
-                not_in_cache.append(p)
+        # Copy the parts of the pages that are in the cache into the destination. The
+        # cache does its own locking, so the lock of this process is not held here
+        size_fullfilled, missing = 0, []
+        for p in range(p0, p1+1):
+            n = self._copy_cached(url, p, offset, size, dest, ps)
+            if n is None:
+                missing.append(p)
             else:
-                if len(not_in_cache) > 0:
-
-                    # Read the missing pages
-                    j0, j1 = not_in_cache[0], not_in_cache[-1]
-                    chunk_size = (1 + j1 - j0) * ps
-                    chunk = bytearray(chunk_size)
-                    fn_readinto(j0 * ps, chunk_size, chunk)
+                size_fullfilled += n
+        
+        # Sort the missing pages into those that another thread is already fetching,
+        # and those that this thread will fetch. A page that another thread finishes
+        # in the meantime is fetched again, which is rare and harmless
+        waiting, claimed = {}, []
+        if missing:
+            with self.cache.lock:
+                for p in missing:
+                    if (url, p) in self.cache.in_flight:
+                        waiting[p] = self.cache.in_flight[(url, p)]
+                    else:
+                        self.cache.in_flight[(url, p)] = threading.Event()
+                        claimed.append(p)
                     
-                    # Place the missing pages into the cache
-                    for j in range(j0, j1+1):
-                        pnew = self.cache.set_page(url, j, chunk[(j-j0)*ps:(j+1-j0)*ps])
-                        size_fullfilled += self.fullfill(offset, size, dest, pnew)
-
-                    not_in_cache = []
-                if p <= p1:
-                    size_fullfilled += self.fullfill(offset, size, dest, page)
-                else:
-                    break
-            p += 1
-                
+        # Read runs of consecutive missing pages with one call each
+        fetched = {}
+        try:
+            for j0, j1 in self.consecutive_runs(claimed, self.max_gap // ps):
+                fetched.update(self._fetch_pages(url, j0, j1, fn_readinto, ps))
+        finally:
+            with self.cache.lock:
+                for p in claimed:
+                    self.cache.in_flight.pop((url, p)).set()
+        for p in claimed:
+            size_fullfilled += self.fullfill(offset, size, dest, fetched[p], ps)
+                    
+        # Collect the pages fetched by other threads. If the other thread failed or
+        # the page was replaced in the meantime, read it here
+        for p, event in waiting.items():
+            event.wait()
+            n = self._copy_cached(url, p, offset, size, dest, ps)
+            if n is None:
+                n = self.fullfill(offset, size, dest, self._fetch_pages(url, p, p, fn_readinto, ps)[p], ps)
+            size_fullfilled += n
+            
+        self._adapt(served=size_fullfilled)
         return size_fullfilled
+    
+    def prefetch(self, url, ranges, fn_readinto):
+        """Read the pages spanned by a list of (offset, size) byte ranges into the cache,
+        without copying the data anywhere. Pages that are cached or being fetched by
+        another thread are skipped, and the remaining pages are read with as few calls
+        as possible. Returns the number of pages read"""
+        ps, suffix = self.layout
+        url = url + suffix
+        needed = sorted(set(p for (offset, size) in ranges if size > 0 
+                            for p in range(offset // ps, (offset + size - 1) // ps + 1)))
+        missing = [ p for p in needed if not self.cache.touch_page(url, p) ]
+        claimed = []
+        if missing:
+            with self.cache.lock:
+                for p in missing:
+                    if (url, p) not in self.cache.in_flight:
+                        self.cache.in_flight[(url, p)] = threading.Event()
+                        claimed.append(p)
+        try:
+            for j0, j1 in self.consecutive_runs(claimed, self.max_gap // ps):
+                self._fetch_pages(url, j0, j1, fn_readinto, ps)
+        finally:
+            with self.cache.lock:
+                for p in claimed:
+                    self.cache.in_flight.pop((url, p)).set()
+                    
+        # Prefetched data is expected to be requested later
+        self._adapt(served=sum(size for (_, size) in ranges))
+        return len(claimed)
+    
+    @staticmethod
+    def consecutive_runs(p_list, max_gap=0):
+        # Group a sorted list of pages into [first, last] runs, allowing up to 
+        # max_gap pages to be skipped within a run
+        runs = []
+        for p in p_list:
+            if runs and p - runs[-1][1] - 1 <= max_gap:
+                runs[-1][1] = p
+            else:
+                runs.append([p, p])
+        return runs
+        
+    def _fetch_pages(self, url, j0, j1, fn_readinto, ps):
+        
+        # Look for the pages in the second tier first
+        fetched, missing = {}, list(range(j0, j1+1))
+        l2 = self.cache.l2
+        if l2 is not None:
+            missing = []
+            for j in range(j0, j1+1):
+                data = l2.get(self.cache.l2_key(url, j))
+                if data is not None:
+                    fetched[j] = self._store_page(url, j, bytearray(data))
+                else:
+                    missing.append(j)
+        
+        # Read the remaining pages from the source
+        for k0, k1 in self.consecutive_runs(missing, self.max_gap // ps):
+            chunk_size = (1 + k1 - k0) * ps
+            chunk = bytearray(chunk_size)
+            n_read = fn_readinto(k0 * ps, chunk_size, chunk)
+            for j in range(k0, k1+1):
+                if j not in fetched:
+                    fetched[j] = self._store_page(url, j, chunk[(j-k0)*ps:(j+1-k0)*ps])
+            self._adapt(fetched=n_read, calls=1, pages=1 + k1 - k0)
+        return fetched
+    
+    def _store_page(self, url, j, data):
+        # Place a page into the cache
+        page = self.cache.set_page(url, j, data)
+        return page if page is not None else self.cache.CachePage(j, time.time_ns(), data)
 
 import concurrent.futures
-class GoogleCloudTiffHandle(io.RawIOBase):
-    def __init__(self, client: storage.Client, gs_url: str, cache):
-        self.gs_url = gs_url
+class ByteRangeSource:
+    """
+    A file that is read in byte ranges, such as an object in cloud storage, a file on 
+    an HTTP server or a file on a network file system. Subclasses set the url, the size
+    of the file and its version, which must change whenever the contents change since
+    it is part of the key of cached data, and implement read_range.
+    """
+    url = None
+    size = 0
+    version = None
+
+    def read_range(self, offset, size):
+        """Read size bytes starting at offset"""
+        raise NotImplementedError
+
+
+class GoogleCloudByteRangeSource(ByteRangeSource):
+    """Object in Google Cloud Storage with URL gs://bucket/path/to/blob.ext"""
+
+    def __init__(self, client: storage.Client, gs_url: str):
+        self.url = gs_url
         url_parts = urlparse.urlparse(gs_url)
-        self._bucket = client.get_bucket(url_parts.netloc)
-        self._blob = self._bucket.get_blob(url_parts.path.strip('/'))        
-        self.fsize = self._blob.size  
+        self._blob = client.bucket(url_parts.netloc).get_blob(url_parts.path.strip('/'))
+        if self._blob is None:
+            raise FileNotFoundError(gs_url)
+        self.size = self._blob.size
+        self.version = str(self._blob.generation)
+
+    def read_range(self, offset, size):
+        return self._blob.download_as_bytes(start=offset, end=offset+size-1, checksum=None)
+
+
+class HttpByteRangeSource(ByteRangeSource):
+    """File on an HTTP(S) server or object store that supports Range requests. The
+    version is taken from the ETag or from the modification time and size. Servers
+    that ignore Range requests are refused when the source is opened, since each read
+    would download the whole file"""
+
+    def __init__(self, url, client: httpx.Client = None):
+        self.url = url
+        self.client = client if client is not None else httpx.Client(follow_redirects=True)
+        
+        # Ask for the first byte of the file, which checks that the server supports ranges
+        # and gives the size of the file in the Content-Range header. The response is
+        # streamed and closed unread, so a server that ignores the range doesn't send
+        # the whole file
+        with self.client.stream('GET', url, headers={'Range': 'bytes=0-0'}) as r:
+            r.raise_for_status()
+            content_range = r.headers.get('content-range', '')
+            if r.status_code != 206 or not re.fullmatch(r'bytes 0-0/\d+', content_range):
+                raise OSError(f'Server does not support range requests for {url}')
+            self.size = int(content_range.split('/')[1])
+            self.version = r.headers.get('etag') or f'{r.headers.get("last-modified")}-{self.size}'
+
+    def read_range(self, offset, size):
+        # The status is checked before the body is read, in case the server has started
+        # to ignore ranges since the source was opened
+        with self.client.stream('GET', self.url, headers={'Range': f'bytes={offset}-{offset+size-1}'}) as r:
+            r.raise_for_status()
+            if r.status_code != 206 or not r.headers.get('content-range', '').startswith(f'bytes {offset}-'):
+                raise OSError(f'Server ignored the range request for {self.url}')
+            return r.read()
+
+
+class LocalFileByteRangeSource(ByteRangeSource):
+    """File on a local or network file system with URL file:///path/to/file.ext, read
+    with positional reads so that it can be shared by threads"""
+
+    def __init__(self, url):
+        self.url = url
+        self.path = urlparse.unquote(urlparse.urlparse(url).path)
+        self.fd = os.open(self.path, os.O_RDONLY)
+        st = os.fstat(self.fd)
+        self.size = st.st_size
+        self.version = f'{st.st_mtime_ns}-{st.st_size}'
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    def read_range(self, offset, size):
+        return os.pread(self.fd, size, offset)
+
+
+# Schemes of the URLs that can be read as byte range sources
+byte_range_schemes = ('gs', 'http', 'https', 'file')
+
+
+# Open the byte range source for a URL based on its scheme, or return None if the URL
+# is a local path. Clients are created for the source if they are not given
+def open_byte_range_source(url, gcs_client=None, http_client=None):
+    scheme = urlparse.urlparse(url).scheme
+    if scheme not in byte_range_schemes:
+        return None
+    if scheme == 'gs':
+        return GoogleCloudByteRangeSource(gcs_client or storage.Client(), url)
+    elif scheme in ('http', 'https'):
+        return HttpByteRangeSource(url, http_client)
+    else:
+        return LocalFileByteRangeSource(url)
+
+
+# Get the version of the file at a URL from its metadata alone, without reading any of
+# its contents. This is the same version as that of the byte range source for the URL,
+# or the modification time and size of a local path. It is None if there is no file or
+# its metadata can't be read, in which case responses derived from it are not validated
+def get_url_version(url, gcs_client=None, http_client=None):
+    scheme = urlparse.urlparse(url).scheme
+    try:
+        if scheme == 'gs':
+            url_parts = urlparse.urlparse(url)
+            blob = (gcs_client or storage.Client()).bucket(url_parts.netloc).get_blob(url_parts.path.strip('/'))
+            return str(blob.generation) if blob is not None else None
+        elif scheme in ('http', 'https'):
+            r = (http_client or httpx.Client(follow_redirects=True)).head(url)
+            if r.status_code != 200:
+                return None
+            return r.headers.get('etag') or f'{r.headers.get("last-modified")}-{r.headers.get("content-length")}'
+        else:
+            st = os.stat(urlparse.unquote(urlparse.urlparse(url).path) if scheme == 'file' else url)
+            return f'{st.st_mtime_ns}-{st.st_size}'
+    except Exception:
+        return None
+
+
+class RemoteTiffHandle(io.RawIOBase):
+    """
+    File object for a TIFF file in a byte range source. Reads go through a page cache
+    shared by all files, and the TIFF structure of the file can be kept in a slide index
+    """
+    def __init__(self, source: ByteRangeSource, cache, coalesce_gap=0, index_cache=None, min_page_size=None):
+        self.source = source
+        self.url = source.url
+        self.fsize = source.size
+        self.version = source.version
+        self.cache_key = f'{self.url}#{self.version}'
         self.pos = 0
-        self.cache = CachedFileRepresentation(cache)
+        self.cache = CachedFileRepresentation(cache, coalesce_gap, min_page_size)
         self.total_read = 0
+        self.total_prefetch_ranges = 0
         self.total_served = 0
+        self.total_index_served = 0
         self.total_gcpops = 0
         self.total_gcpns = 0
-        print(f'Created handle for GCS-hosted Tiff file {gs_url} of size {self.fsize}')  
+        
+        # The slide index holds the byte ranges of the file that make up the TIFF 
+        # structure (header, IFDs and tag values such as tile offsets and JPEG tables),
+        # so that the file can be parsed again without reading from the source. If there
+        # is no index for this version of the file, the ranges are recorded while the
+        # file is parsed and saved to the index by save_index()
+        self.index_cache = index_cache
+        self.index_key = (self.url, self.version, 'tiff-index')
+        self.index_offsets, self.index_ranges, self.recording = [], [], None
+        if index_cache is not None and index_cache.enabled:
+            data = index_cache.get(self.index_key)
+            if data is not None:
+                self.index_ranges = pickle.loads(data)
+                self.index_offsets = [ offset for (offset, _) in self.index_ranges ]
+            else:
+                self.recording = []
+        print(f'Created handle for Tiff file {self.url} of size {self.fsize}'
+              f'{" from slide index" if self.index_ranges else ""}')  
 
     def __del__(self):
         self.print_report()
         
+    def choose_page_size(self, tile_bytes):
+        """Choose the cache page size for this file so that a page holds a few tiles of
+        typical size. The page size then adapts to how the file is accessed"""
+        self.cache.set_page_size(int(4 * tile_bytes))
+        
     def print_report(self):        
-        print(f'Cache Performance for GoogleCloudTiffHandle[{self.gs_url}]:')
+        print(f'Cache Performance for RemoteTiffHandle[{self.url}]:')
         print(f'  Total Read (MB)        : {self.total_read / 1024**2:6.2f}')
         print(f'  Total Served (MB)      : {self.total_served / 1024**2:6.2f}MB') 
-        print(f'  Efficiency             : {self.total_served / self.total_read}')
-        print(f'  REST API calls         : {self.total_gcpops}')
-        print(f'  MB per call            : {self.total_read / (1024**2 * self.total_gcpops):6.2f}')
-        print(f'  Time per call (ms)     : {self.total_gcpns / (1000**2 * self.total_gcpops):6.2f}')
+        print(f'  Served by index (MB)   : {self.total_index_served / 1024**2:6.2f}MB') 
+        print(f'  Efficiency             : {self.total_served / max(1, self.total_read)}')
+        print(f'  Page size (KB)         : {self.cache.page_size // 1024}')
+        print(f'  Page size changes      : {self.cache.n_page_size_changes}')
+        print(f'  Remote calls           : {self.total_gcpops}')
+        print(f'  Prefetched ranges      : {self.total_prefetch_ranges}')
+        print(f'  MB per call            : {self.total_read / (1024**2 * max(1, self.total_gcpops)):6.2f}')
+        print(f'  Time per call (ms)     : {self.total_gcpns / (1000**2 * max(1, self.total_gcpops)):6.2f}')
     
     def _readinto_internal(self, offset, size, buffer):
         size = min(size, self.fsize - offset)
@@ -326,7 +978,7 @@ class GoogleCloudTiffHandle(io.RawIOBase):
         '''
         def dl_piece(start, end):
             # print(f'  chunk {start}:{end}')
-            data = self._blob.download_as_bytes(start=start, end=end, checksum=None)
+            data = self.source.read_range(start, end - start + 1)
             return start, data
         n_threads = 8
         piece_bnd = np.lib.stride_tricks.sliding_window_view(np.linspace(offset,offset+size-1,n_threads+1).astype(int),2).tolist()
@@ -342,11 +994,11 @@ class GoogleCloudTiffHandle(io.RawIOBase):
         
         # Non-concurrent download
         t_start = time.time_ns()
-        chunk = self._blob.download_as_bytes(start=offset, end=offset+size-1, checksum=None)
+        chunk = self.source.read_range(offset, size)
         t_used = time.time_ns() - t_start
         
         n_read = len(chunk)
-        print(f'GCS DL {n_read//1024**2}MB @{offset//1024**2}MB from {self.gs_url} in {t_used//1000**2}ms')
+        print(f'DL {n_read//1024**2}MB @{offset//1024**2}MB from {self.url} in {t_used//1000**2}ms')
         buffer[:n_read] = chunk
         self.total_read += n_read
         self.total_gcpops += 1
@@ -359,14 +1011,64 @@ class GoogleCloudTiffHandle(io.RawIOBase):
             print(buffer, len(buffer), self.fsize, self.pos, self.fsize - self.pos)
         elif not isinstance(buffer, (bytearray, memoryview)):
             raise TypeError("Buffer object expected, got: {}".format(type(buffer)))
-        size = min(len(buffer), self.fsize - self.pos)
-        if self.cache:
-            n_read = self.cache.readinto(self.gs_url, self.pos, size, buffer, self._readinto_internal)
-        else:
-            n_read = self._readinto_internal(self.pos, size, buffer)            
+        n_read = self._readinto_at(self.pos, buffer)
         self.pos += n_read
+        return n_read
+    
+    def _readinto_at(self, offset, buffer):
+        size = max(0, min(len(buffer), self.fsize - offset))
+        n_read = self._readinto_from_index(offset, size, buffer)
+        if n_read is None:
+            if self.cache:
+                n_read = self.cache.readinto(self.cache_key, offset, size, buffer, self._readinto_internal)
+            else:
+                n_read = self._readinto_internal(offset, size, buffer)
+            if self.recording is not None:
+                self.recording.append((offset, bytes(buffer[:n_read])))
         self.total_served += n_read
         return n_read
+    
+    def _readinto_from_index(self, offset, size, buffer):
+        # Serve the read from the slide index if one of its ranges contains it
+        i = bisect.bisect_right(self.index_offsets, offset) - 1
+        if i < 0:
+            return None
+        r_offset, r_data = self.index_ranges[i]
+        if offset + size > r_offset + len(r_data):
+            return None
+        buffer[:size] = r_data[offset - r_offset:offset - r_offset + size]
+        self.total_index_served += size
+        return size
+    
+    def save_index(self):
+        """Save the byte ranges read since the handle was created to the slide index,
+        merging overlapping and adjacent ranges. This should be called once the TIFF
+        structure has been parsed and before any pixel data is read"""
+        if self.recording is None:
+            return
+        ranges = []
+        for offset, data in sorted(self.recording, key=lambda x: x[0]):
+            if ranges and offset <= ranges[-1][0] + len(ranges[-1][1]):
+                r_offset, r_data = ranges[-1]
+                ranges[-1] = (r_offset, r_data + data[r_offset + len(r_data) - offset:])
+            else:
+                ranges.append((offset, data))
+        self.recording = None
+        self.index_cache.put(self.index_key, pickle.dumps(ranges))
+    
+    def prefetch(self, ranges):
+        """Load a list of (offset, size) byte ranges into the page cache, merging nearby
+        ranges into a few large ranged GETs"""
+        ranges = [ (offset, max(0, min(size, self.fsize - offset))) for (offset, size) in ranges ]
+        self.total_prefetch_ranges += len(ranges)
+        self.cache.prefetch(self.cache_key, ranges, self._readinto_internal)
+    
+    def read_at(self, offset, size):
+        """Read size bytes at offset without moving the file position. Unlike seek
+        followed by read, this is safe to call from multiple threads"""
+        data = bytearray(max(0, min(size, self.fsize - offset)))
+        nread = self._readinto_at(offset, data)
+        return bytes(data) if len(data) == nread else bytes(data[:nread])
 
     def read(self, size=-1):
         if size == -1:
@@ -391,12 +1093,19 @@ class GoogleCloudTiffHandle(io.RawIOBase):
         """Return the current file position."""
         return self.pos
 
+
+class GoogleCloudTiffHandle(RemoteTiffHandle):
+    def __init__(self, client: storage.Client, gs_url: str, cache, coalesce_gap=0, index_cache=None):
+        RemoteTiffHandle.__init__(self, GoogleCloudByteRangeSource(client, gs_url), cache, coalesce_gap, index_cache)
+
     
-# OpenSlide wrapper for GCS
+# OpenSlide wrapper for TIFF files in GCS and other byte range sources
 class AbstractStreamOpenSlideWrapper:
     
-    def __init__(self, stream):
+    def __init__(self, stream, executor=None):
         # Load the tiff file
+        self.stream = stream
+        self.executor = executor
         self.tf = tifffile.TiffFile(stream)
         
         # Collect the tiled pages
@@ -404,55 +1113,231 @@ class AbstractStreamOpenSlideWrapper:
         
         # Place to store associated images
         self.assoc = {}
+        self._memory_usage = None
+        
+        # Lock for operations that move the position of the stream. This is shared with
+        # tifffile, which moves the position when it loads tag values on first access
+        self.tf.filehandle.set_lock(True)
+        self.lock = self.tf.filehandle.lock
         
-    def read_region(self, location, level, size):
+        # Streams with a page cache can choose their page size from the size of the tiles
+        if hasattr(self.stream, 'choose_page_size') and self.tiled_pages:
+            tile_bytes = np.concatenate([ np.asarray(p.databytecounts) for p in self.tiled_pages ])
+            self.stream.choose_page_size(np.median(tile_bytes[tile_bytes > 0]) if np.any(tile_bytes > 0) else 0)
+            
+        # Streams that keep an index of the TIFF structure can save it once all the
+        # tags that are needed to describe the slide have been loaded
+        if hasattr(self.stream, 'save_index'):
+            self.describe()
+            self.stream.save_index()
+        
+    def _read_bytes(self, offset, size):
+        # Streams that support positional reads can be used concurrently
+        if hasattr(self.stream, 'read_at'):
+            return self.stream.read_at(offset, size)
+        with self.lock:
+            self.stream.seek(offset)
+            return self.stream.read(size)
+        
+    def _decode_tile(self, page, i_tile):
+        data = self._read_bytes(page.dataoffsets[i_tile], page.databytecounts[i_tile])
+        
+        # The decoder is created by tifffile on first use, which reads from the stream
+        with self.lock:
+            decode = page.decode
+        tile, indices, shape = decode(data, i_tile, jpegtables=page.jpegtables)
+        return tile
+    
+    # Adobe APP14 marker declaring that the JPEG components are stored without a color transform
+    JPEG_APP14_NO_TRANSFORM = b'\xff\xee\x00\x0eAdobe\x00\x64\x00\x00\x00\x00\x00'
+    
+    @property
+    def jpeg_tile_size(self):
+        """Size of the square JPEG tiles shared by all levels of the pyramid, or None if
+        the pyramid is not stored as such tiles and its tiles can't be passed through"""
+        sizes = set((p.tilewidth, p.tilelength) for p in self.tiled_pages)
+        if len(sizes) != 1 or any(p.compression != tifffile.COMPRESSION.JPEG or p.samplesperpixel != 3
+                                  or p.photometric not in (tifffile.PHOTOMETRIC.RGB, tifffile.PHOTOMETRIC.YCBCR)
+                                  for p in self.tiled_pages):
+            return None
+        tw, th = sizes.pop()
+        return tw if tw == th else None
+    
+    def read_raw_jpeg_tile(self, level, tx, ty):
+        """Return the stored JPEG stream of a tile as a standalone JPEG file, without decoding"""
+        page = self.tiled_pages[level]
+        ntx = 1 + (page.imagewidth-1) // page.tilewidth
+        return self._jpeg_tile_stream(page, ty * ntx + tx)
+    
+    def _jpeg_tile_stream(self, page, i_tile):
+        data = self._read_bytes(page.dataoffsets[i_tile], page.databytecounts[i_tile])
+        
+        # Merge the shared quantization and Huffman tables into the tile stream
+        if page.jpegtables:
+            data = page.jpegtables[:-2] + data[2:]
+            
+        # Without the APP14 marker, decoders would treat RGB components as YCbCr
+        i_app14 = data.find(b'\xff\xee')
+        has_app14 = i_app14 >= 0 and data[i_app14+4:i_app14+9] == b'Adobe'
+        if page.photometric == tifffile.PHOTOMETRIC.RGB and not has_app14:
+            data = data[:2] + self.JPEG_APP14_NO_TRANSFORM + data[2:]
+        return data
+    
+    @staticmethod
+    def _jpeg_decode_scale(page, location, size, out_size):
+        # Largest factor (2, 4 or 8) by which the JPEG tiles of a region can be scaled down
+        # while they are decoded, keeping the decoded region at least as large as out_size.
+        # The region and the tiles must be aligned with the scaled pixel grid
+        if (out_size is None or not page.is_tiled or page.compression != tifffile.COMPRESSION.JPEG
+                or page.samplesperpixel != 3 
+                or page.photometric not in (tifffile.PHOTOMETRIC.RGB, tifffile.PHOTOMETRIC.YCBCR)):
+            return 1
+        ratio = min(size[0] / max(1, out_size[0]), size[1] / max(1, out_size[1]))
+        for scale in (8, 4, 2):
+            if (scale <= ratio and page.tilewidth % scale == 0 and page.tilelength % scale == 0
+                    and location[0] % scale == 0 and location[1] % scale == 0):
+                return scale
+        return 1
+    
+    def _decode_tile_scaled(self, page, i_tile, scale):
+        # Decode a JPEG tile at 1/scale of its size, which libjpeg does by computing a
+        # reduced inverse DCT, skipping most of the work of a full decode
+        tw, th = page.tilewidth // scale, page.tilelength // scale
+        image = Image.open(io.BytesIO(self._jpeg_tile_stream(page, i_tile)))
+        image.draft('RGB', (tw, th))
+        if image.size != (tw, th):
+            image = image.resize((tw, th), Image.BOX)
+        return np.asarray(image.convert('RGB'))
+    
+    def _read_region_array(self, location, level, size, tile_cache=None, scale=1):
         page = self.tiled_pages[level]
         
         # The pos coordinates are in the coordinate frame of level 0 and
         # have to be converted to the correct coordinate frame
-        ds = self.level_downsamples[level]
-        location = [ int(0.5 + x // ds) for x in location ]
+        location = self._level_location(location, level)
 
         if not page.is_tiled:
             arr = page.asarray()
             icrop = arr[location[1]:(location[1]+size[1]),location[0]:(location[0]+size[0]),:]
 
         else:
-            fh = self.tf.filehandle
-            tw, th = page.tilewidth, page.tilelength
-            
-            # How many tiles in x and y
             ntx = 1 + (page.imagewidth-1) // page.tilewidth
-            nty = 1 + (page.imagelength-1) // page.tilelength
+            tiles = self._region_tiles(page, location, size)
             
-            tx0 = location[0] // tw
-            ty0 = location[1] // th
-            tx1 = (location[0] + size[0]) // tw
-            ty1 = (location[1] + size[1]) // th
-            stx, sty = 1+tx1-tx0, 1+ty1-ty0
+            # When the tiles are decoded at reduced scale, the tiles are pasted into a 
+            # region that is scaled down by the same factor
+            tw, th = page.tilewidth // scale, page.tilelength // scale
+            iw, ih = -(-page.imagewidth // scale), -(-page.imagelength // scale)
+            x0, y0 = location[0] // scale, location[1] // scale
+            size = (-(-size[0] // scale), -(-size[1] // scale))
             
-            image = np.zeros((sty * th, stx * tw, page.samplesperpixel), dtype=page.dtype)
-            for ty in range(ty0, np.minimum(ty1 + 1, nty)):
-                for tx in range(tx0, np.minimum(tx1 + 1, ntx)):
+            # Tiles are pasted directly into the output array, parts of the region
+            # outside of the image are left as zeros
+            icrop = np.zeros((size[1], size[0], page.samplesperpixel), dtype=page.dtype)
+            
+            def decode_and_paste(tx, ty):
+                # Intersection of the tile with the region in region coordinates. Edge tiles
+                # are padded beyond the image and the padding is not pasted
+                rx0, ry0 = max(tx * tw - x0, 0), max(ty * th - y0, 0)
+                rx1 = min((tx + 1) * tw, iw) - x0
+                ry1 = min((ty + 1) * th, ih) - y0
+                rx1, ry1 = min(rx1, size[0]), min(ry1, size[1])
+                if rx1 <= rx0 or ry1 <= ry0:
+                    return
+                
+                # Tiles shared between regions of a batch are only decoded once
+                i_tile = ty * ntx + tx
+                tile = tile_cache.get((level, i_tile, scale)) if tile_cache is not None else None
+                if tile is None:
+                    if scale > 1:
+                        tile = self._decode_tile_scaled(page, i_tile, scale)
+                    else:
+                        tile = self._decode_tile(page, i_tile).reshape(th, tw, -1)
+                    if tile_cache is not None:
+                        tile_cache[(level, i_tile, scale)] = tile
+                ox, oy = x0 - tx * tw, y0 - ty * th
+                icrop[ry0:ry1,rx0:rx1,:] = tile[(ry0+oy):(ry1+oy),(rx0+ox):(rx1+ox),:]
+                
+            # Decode the tiles concurrently, since the codecs release the GIL
+            if self.executor is not None and len(tiles) > 1:
+                for _ in self.executor.map(lambda t: decode_and_paste(*t), tiles):
+                    pass
+            else:
+                for (tx, ty) in tiles:
+                    decode_and_paste(tx, ty)
+        
+        return icrop
+    
+    def _level_location(self, location, level):
+        # The pos coordinates are in the coordinate frame of level 0 and
+        # have to be converted to the correct coordinate frame
+        ds = self.level_downsamples[level]
+        return [ int(x // ds) for x in location ]
+    
+    @staticmethod
+    def _region_tiles(page, location, size):
+        # The (tx, ty) indices of the tiles of a page that overlap a region
+        tw, th = page.tilewidth, page.tilelength
+        ntx = 1 + (page.imagewidth-1) // tw
+        nty = 1 + (page.imagelength-1) // th
+        x0, y0 = location
+        return [ (tx, ty) 
+                 for ty in range(max(y0 // th, 0), min((y0 + size[1] - 1) // th + 1, nty))
+                 for tx in range(max(x0 // tw, 0), min((x0 + size[0] - 1) // tw + 1, ntx)) ]
+    
+    def prefetch_regions(self, regions):
+        """Ask the stream to load the bytes of all tiles needed for a list of regions 
+        at once, so that nearby tiles are read with a few large requests rather
+        than a request per tile. Nothing is decoded"""
+        if not hasattr(self.stream, 'prefetch'):
+            return
+        ranges = set()
+        for (location, level, size) in regions:
+            page = self.tiled_pages[level]
+            if page.is_tiled:
+                ntx = 1 + (page.imagewidth-1) // page.tilewidth
+                for (tx, ty) in self._region_tiles(page, self._level_location(location, level), size):
                     i_tile = ty * ntx + tx
-                    fh.seek(page.dataoffsets[i_tile])
-                    data = fh.read(page.databytecounts[i_tile])
-                    tile, indices, shape = page.decode(data, i_tile, jpegtables=page.jpegtables)
-                    offx, offy = (tx - tx0) * tw, (ty - ty0) * th
-                    image[offy:(offy+th),offx:(offx+th),:] = np.array(tile, dtype=page.dtype)
-                    
-            # Crop out the exact image requested
-            crop_x, crop_y = location[0] - tx0 * tw, location[1] - ty0 * th
-            icrop = image[crop_y:(crop_y+size[1]),crop_x:(crop_x+size[0]),:]
+                    ranges.add((page.dataoffsets[i_tile], page.databytecounts[i_tile]))
+        if len(ranges) > 1:
+            self.stream.prefetch(sorted(ranges))
+    
+    @staticmethod
+    def _array_to_mode(arr, mode):
+        # Convert the region to a PIL image in the requested mode, or keep it as NumPy array
+        if mode == 'array':
+            return arr
+        image = Image.fromarray(arr)
+        return image if image.mode == mode else image.convert(mode)
         
-        # Return the image as PIL
-        return Image.fromarray(icrop).convert("RGBA")
+    def read_region(self, location, level, size, mode='RGBA', out_size=None):
+        """Read a region as a PIL image in the given mode ('RGBA', 'RGB') or as
+        a NumPy array (mode='array'). If out_size is given, the region is resampled
+        to that size, and when out_size is at least 2x smaller than size, JPEG tiles
+        are decoded directly at 1/2, 1/4 or 1/8 scale"""
+        self.prefetch_regions([(location, level, size)])
+        scale = self._jpeg_decode_scale(self.tiled_pages[level], self._level_location(location, level), size, out_size)
+        arr = self._read_region_array(location, level, size, scale=scale)
+        if out_size is not None and (arr.shape[1], arr.shape[0]) != tuple(out_size):
+            resample = getattr(Image, 'Resampling', Image).LANCZOS
+            arr = np.asarray(Image.fromarray(arr).resize(tuple(out_size), resample))
+        return self._array_to_mode(arr, mode)
+    
+    def read_regions(self, regions, mode='RGBA'):
+        # Read a list of (location, level, size) regions, decoding each tile once
+        tile_cache = {}
+        self.prefetch_regions(regions)
+        return [ self._array_to_mode(self._read_region_array(location, level, size, tile_cache), mode)
+                 for (location, level, size) in regions ]
 
     def get_thumbnail(self, size):
         # Taken from openslide
         downsample = max(dim / thumb for dim, thumb in zip(self.dimensions, size))
         level = self.get_best_level_for_downsample(downsample)
-        tile = self.read_region((0, 0), level, self.level_dimensions[level])
+        dims = self.level_dimensions[level]
+        scale = max(dim / thumb for dim, thumb in zip(dims, size))
+        out_size = tuple(max(1, round(dim / scale)) for dim in dims) if scale > 1 else None
+        tile = self.read_region((0, 0), level, dims, out_size=out_size)
         # Apply on solid background
         bg_color = '#' + self.properties.get('openslide.background-color', 'ffffff')
         thumb = Image.new('RGB', tile.size, bg_color)
@@ -485,12 +1370,38 @@ class AbstractStreamOpenSlideWrapper:
     
     @property
     def associated_images(self):
+        with self.lock:
+            return self._load_associated_images()
+        
+    # Approximate size of the parsed tags of a TIFF page, other than the tile offsets
+    page_overhead = 4096
+
+    def memory_usage(self):
+        """Estimate of the memory held by the open slide: the parsed pages with their 
+        tile offsets and byte counts, and the associated images that have been loaded"""
+        if self._memory_usage is not None:
+            return self._memory_usage
+        n_bytes = 0
+        with self.lock:
+            for page in self.tf.pages:
+                n_bytes += self.page_overhead
+                for arr in (getattr(page, 'dataoffsets', ()), getattr(page, 'databytecounts', ())):
+                    # A tuple of Python ints, each taking 32 bytes plus the tuple's pointer
+                    n_bytes += sys.getsizeof(arr) + 32 * len(arr)
+                n_bytes += len(getattr(page, 'jpegtables', None) or b'')
+            for image in self.assoc.values():
+                n_bytes += image.width * image.height * len(image.getbands())
+        self._memory_usage = n_bytes
+        return n_bytes
+
+    def _load_associated_images(self):
         if not self.assoc:
             for page in self.tf.pages:
                 if page.is_tiled is False and 'ImageDescription' in page.tags:
                     for tag in 'macro', 'label', 'thumbnail':
                         if tag in page.tags['ImageDescription'].value.lower():
                             self.assoc[tag] = Image.fromarray(page.asarray()).convert("RGBA")
+            self._memory_usage = None
         return self.assoc
     
     # TODO: add all the TIFF properties 
@@ -543,6 +1454,18 @@ class AbstractStreamOpenSlideWrapper:
                     
         return props        
 
+    def describe(self):
+        """Return the static geometry and properties of the slide in a single dict"""
+        return {
+            'version': getattr(self.stream, 'version', None),
+            'jpeg_tile_size': self.jpeg_tile_size,
+            'level_count': self.level_count,
+            'dimensions': self.dimensions,
+            'level_dimensions': self.level_dimensions,
+            'level_downsamples': self.level_downsamples,
+            'properties': self.properties
+        }
+
     def get_best_level_for_downsample(self, downsample):
         ds = self.level_downsamples
         for (i, ds_i) in enumerate(ds):
@@ -551,8 +1474,15 @@ class AbstractStreamOpenSlideWrapper:
         return len(ds)-1
 
 
-class GoogleCloudOpenSlideWrapper(AbstractStreamOpenSlideWrapper):
+class RemoteOpenSlideWrapper(AbstractStreamOpenSlideWrapper):
      
-    def __init__(self, client, gs_url, cache=None):
+    def __init__(self, source, cache=None, executor=None, coalesce_gap=0, index_cache=None, min_page_size=None):
         AbstractStreamOpenSlideWrapper.__init__(self,
-             GoogleCloudTiffHandle(client, gs_url, cache))
+             RemoteTiffHandle(source, cache, coalesce_gap, index_cache, min_page_size), executor)
+
+
+class GoogleCloudOpenSlideWrapper(RemoteOpenSlideWrapper):
+     
+    def __init__(self, client, gs_url, cache=None, executor=None, coalesce_gap=0, index_cache=None):
+        RemoteOpenSlideWrapper.__init__(self,
+             GoogleCloudByteRangeSource(client, gs_url), cache, executor, coalesce_gap, index_cache)
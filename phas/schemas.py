@@ -26,6 +26,13 @@ task_schema = {
         },
         "restrict-access": {"type": "boolean"},
         "download-slide-size-limit": {"type": "integer"},
+        "tile-quality": {
+            "type": "object",
+            "properties": {
+                "full": {"type": "integer", "minimum": 1, "maximum": 100},
+                "low-zoom": {"type": "integer", "minimum": 1, "maximum": 100}
+            }
+        },
         "anonymize": {"type": "boolean"},
         "stains": {
             "type": "array",
@@ -74,7 +81,14 @@ project_schema = {
         "disp_name": {"type": "string", "minLength": 2, "maxLength": 80},
         "desc": {"type": "string", "maxLength": 1024},
         "base_url": {"type": "string"},
-        "url_schema": {"type": "object"}},
+        "url_schema": {"type": "object"},
+        "tile-quality": {
+            "type": "object",
+            "properties": {
+                "full": {"type": "integer", "minimum": 1, "maximum": 100},
+                "low-zoom": {"type": "integer", "minimum": 1, "maximum": 100}
+            }
+        }},
     "required": ["disp_name", "desc", "base_url"]
 }
 
@@ -29,7 +29,8 @@ from .project_ref import ProjectRef, TaskRef
 from .slideref import SlideRef, get_slide_ref, get_project_task_slide_ref
 from .project_cli import get_task_data, update_edit_meta, create_edit_meta, update_edit_meta_to_current, refresh_slide_db
 from .delegate import find_delegate_for_slide
-from .dzi import get_affine_matrix, get_random_patch, get_osl
+from .dzi import (get_affine_matrix, get_random_patch, get_osl, local_file_version, slide_etag,
+                  with_cache_headers, not_modified_response)
 from .common import cache
 from .schemas import user_preferences_schema
 from io import BytesIO, StringIO
@@ -1353,12 +1354,18 @@ def get_slide_thumbnail(task_id, slide_id):
     _,_,sr = get_project_task_slide_ref(task_id, slide_id)
     f_local = sr.get_local_copy('thumb')
     if f_local:
+        # The local copy of the thumbnail is replaced when the thumbnail changes
+        cache_control = current_app.config['DZI_TILE_CACHE_CONTROL']
+        etag = slide_etag(f_local, local_file_version(f_local), 'thumbnail')
+        resp = not_modified_response(etag, cache_control)
+        if resp is not None:
+            return resp
         im = Image.open(f_local)
         buf = io.BytesIO()
         im.save(buf, 'PNG')
         resp = make_response(buf.getvalue())
         resp.mimetype = 'image/png'
-        return resp
+        return with_cache_headers(resp, etag, cache_control)
     else:
         abort(404)
         
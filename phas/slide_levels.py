@@ -0,0 +1,237 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import tifffile
+import numpy as np
+from PIL import Image
+from .gcs_handler import AbstractStreamOpenSlideWrapper
+
+
+# Name of the file that lists the synthetic levels of a slide. It is written last,
+# so a directory without it holds an incomplete build and is ignored
+SYNTHETIC_LEVELS_MANIFEST = 'levels.json'
+
+
+# Directory holding the synthetic levels of a given version of a slide
+def synthetic_levels_path(levels_dir, url, version):
+    return os.path.join(levels_dir, hashlib.sha1(repr((url, version)).encode('utf-8')).hexdigest())
+
+
+# Read the manifest of the synthetic levels of a slide, or None if they have not been built
+def load_synthetic_levels_manifest(levels_dir, url, version):
+    if levels_dir is None or version is None:
+        return None
+    try:
+        with open(os.path.join(synthetic_levels_path(levels_dir, url, version), SYNTHETIC_LEVELS_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Plan the synthetic levels that fill the gaps in the pyramid of a slide. Where the
+# ratio between the widths of consecutive levels exceeds max_ratio, levels are added
+# by halving the finer level until the gap is at most 2x, and the coarsest level is
+# halved until it fits within min_size. Returns a list of (source_level, k, dimensions)
+# where the synthetic level is source_level downsampled by 2**k
+def plan_synthetic_levels(level_dimensions, max_ratio=4.0, min_size=1024):
+    plan = []
+    for i, (w, h) in enumerate(level_dimensions):
+        w_next = level_dimensions[i+1][0] if i+1 < len(level_dimensions) else None
+        if w_next is not None and w <= max_ratio * w_next:
+            continue
+        k, w_k, h_k = 0, w, h
+        while True:
+            # Dimensions are rounded up when halving, like the levels of DeepZoom
+            if w_next is not None and -(-w_k // 2) < 2 * w_next:
+                break
+            if w_next is None and (max(w_k, h_k) <= min_size or min(w_k, h_k) <= 1):
+                break
+            k, w_k, h_k = k + 1, -(-w_k // 2), -(-h_k // 2)
+            plan.append((i, k, (w_k, h_k)))
+    return plan
+
+
+# Read a region of a slide level resampled to out_size, as an RGB image composited
+# on the background color. The stream wrapper decodes JPEG tiles at reduced scale
+def _read_region_resampled(osl, location, level, size, out_size, background):
+    if isinstance(osl, AbstractStreamOpenSlideWrapper):
+        return osl.read_region(location, level, size, mode='RGB', out_size=out_size)
+    region = osl.read_region(location, level, size)
+    image = Image.new('RGB', region.size, background)
+    image.paste(region, None, region)
+    if image.size != tuple(out_size):
+        image = image.resize(tuple(out_size), getattr(Image, 'Resampling', Image).LANCZOS)
+    return image
+
+
+# Write one synthetic level as a tiled JPEG TIFF. Each tile is read from the 2x larger
+# level above it, given as a slide, a level of that slide and the downsample of the level
+def _write_synthetic_level(filename, source, dimensions, tile_size, quality, background):
+    osl, level, ds = source
+    src_w, src_h = osl.level_dimensions[level]
+    w, h = dimensions
+
+    def tiles():
+        for y in range(0, h, tile_size):
+            for x in range(0, w, tile_size):
+                cw, ch = min(tile_size, w - x), min(tile_size, h - y)
+                src_size = (min(2 * cw, src_w - 2 * x), min(2 * ch, src_h - 2 * y))
+                region = _read_region_resampled(
+                    osl, (round(2 * x * ds), round(2 * y * ds)), level, src_size, (cw, ch), background)
+                tile = Image.new('RGB', (tile_size, tile_size), background)
+                tile.paste(region, (0, 0))
+                yield np.asarray(tile)
+
+    with tifffile.TiffWriter(filename, bigtiff=True) as tw:
+        tw.write(tiles(), shape=(h, w, 3), dtype='uint8', tile=(tile_size, tile_size),
+                 compression='jpeg', compressionargs={'level': quality}, photometric='rgb')
+
+
+# Build the synthetic levels of a slide in the given directory. Each level is computed
+# from the level above it, either the slide level it is derived from or the previous
+# synthetic level, so every level costs about one pass over a 2x larger image. Levels
+# are written to a temporary directory that is moved into place when complete
+def build_synthetic_levels(osl, path, plan, tile_size=256, quality=90, metadata=None):
+    background = '#' + dict(osl.properties).get('openslide.background-color', 'ffffff')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp')
+    files, levels = [], []
+    try:
+        for (i, k, dims) in plan:
+            if k == 1:
+                source = (osl, i, osl.level_downsamples[i])
+            else:
+                source = (levels[-1], 0, 1.0)
+            fn = f'level_{len(levels):02d}.tiff'
+            _write_synthetic_level(os.path.join(tmp_path, fn), source, dims, tile_size, quality, background)
+            files.append(open(os.path.join(tmp_path, fn), 'rb'))
+            levels.append(AbstractStreamOpenSlideWrapper(files[-1]))
+
+        manifest = dict(metadata or {})
+        manifest['level_dimensions'] = [ list(d) for d in osl.level_dimensions ]
+        manifest['levels'] = [ { 'file': f'level_{j:02d}.tiff', 'source_level': i, 'dimensions': list(dims) }
+                               for j, (i, k, dims) in enumerate(plan) ]
+        with open(os.path.join(tmp_path, SYNTHETIC_LEVELS_MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        # Replace the levels from an earlier build. Slide servers that have the old
+        # files open can still read them until they close the slide
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    finally:
+        for f in files:
+            f.close()
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return manifest
+
+
+class SyntheticLevelsSlide:
+    """
+    A slide combined with the synthetic levels that were built for it. It behaves like
+    the slide wrapper, except that its levels are the levels of the slide and the
+    synthetic levels ordered by decreasing size, so DeepZoom generators built on it read
+    low-resolution tiles from a nearby level rather than from a much larger one.
+    Everything else is passed through to the slide.
+    """
+
+    def __init__(self, slide, levels, files=()):
+        self.slide = slide
+        self.files = list(files)
+        entries = [ (slide, i, tuple(slide.level_dimensions[i])) for i in range(slide.level_count) ]
+        entries += [ (level, 0, tuple(level.level_dimensions[0])) for level in levels ]
+        self._levels = sorted(entries, key=lambda e: -e[2][0])
+
+    def __getattr__(self, name):
+        return getattr(self.slide, name)
+
+    @property
+    def level_count(self):
+        return len(self._levels)
+
+    @property
+    def level_dimensions(self):
+        return [ dims for (_, _, dims) in self._levels ]
+
+    @property
+    def level_downsamples(self):
+        w = self._levels[0][2][0]
+        return [ w / dims[0] for (_, _, dims) in self._levels ]
+
+    def get_best_level_for_downsample(self, downsample):
+        ds = self.level_downsamples
+        for (i, ds_i) in enumerate(ds):
+            if downsample < ds_i:
+                return max(i-1, 0)
+        return len(ds)-1
+
+    def _owner(self, location, level):
+        # The slide or synthetic level that holds a level, the index of the level in
+        # its owner and the location in the level 0 coordinates of the owner
+        owner, i, dims = self._levels[level]
+        if owner is self.slide:
+            return owner, i, location
+        ds = self.level_downsamples[level]
+        return owner, i, tuple(int(x // ds) for x in location)
+
+    def read_region(self, location, level, size, mode='RGBA', out_size=None):
+        owner, i, location = self._owner(location, level)
+        if out_size is None and mode == 'RGBA':
+            return owner.read_region(location, i, size)
+        return owner.read_region(location, i, size, mode=mode, out_size=out_size)
+
+    def read_regions(self, regions, mode='RGBA'):
+        return [ self.read_region(location, level, size, mode) for (location, level, size) in regions ]
+
+    def prefetch_regions(self, regions):
+        by_owner = {}
+        for (location, level, size) in regions:
+            owner, i, location = self._owner(location, level)
+            by_owner.setdefault(id(owner), (owner, []))[1].append((location, i, size))
+        for owner, owner_regions in by_owner.values():
+            if hasattr(owner, 'prefetch_regions'):
+                owner.prefetch_regions(owner_regions)
+
+    @property
+    def jpeg_tile_size(self):
+        sizes = set(getattr(owner, 'jpeg_tile_size', None) for (owner, _, _) in self._levels)
+        return sizes.pop() if len(sizes) == 1 else None
+
+    def read_raw_jpeg_tile(self, level, tx, ty):
+        owner, i, _ = self._levels[level]
+        return owner.read_raw_jpeg_tile(i, tx, ty)
+
+    def memory_usage(self):
+        levels = set(owner for (owner, _, _) in self._levels if owner is not self.slide)
+        return self.slide.memory_usage() + sum(level.memory_usage() for level in levels)
+
+
+# Combine a slide with its synthetic levels if they have been built for this version
+# of the slide and match its pyramid. Otherwise the slide is returned as is
+def open_synthetic_levels(slide, levels_dir, url, version, executor=None):
+    manifest = load_synthetic_levels_manifest(levels_dir, url, version)
+    if manifest is None or [ list(d) for d in slide.level_dimensions ] != manifest.get('level_dimensions'):
+        return slide
+    path = synthetic_levels_path(levels_dir, url, version)
+    files = [ open(os.path.join(path, e['file']), 'rb') for e in manifest['levels'] ]
+    levels = [ AbstractStreamOpenSlideWrapper(f, executor) for f in files ]
+    return SyntheticLevelsSlide(slide, levels, files)
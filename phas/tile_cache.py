@@ -0,0 +1,327 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import json
+import time
+import fcntl
+import heapq
+import hashlib
+import tempfile
+import threading
+import traceback
+import click
+from flask.cli import with_appcontext
+
+
+class LocalDiskCache:
+    """
+    A persistent cache of immutable byte strings kept in a directory on local disk. 
+    Keys are hashed to give the filename of each entry, so keys must include everything
+    that affects the stored bytes.
+
+    The cache may be shared by many processes. Entries are written to a temporary file
+    and renamed into place, so concurrent writers never produce partial entries. The
+    modification time of an entry is updated on every hit, and when the total size of
+    the cache exceeds its budget, the least recently used entries are deleted. Hit and
+    miss counters are accumulated in each process and periodically added to a shared
+    stats file.
+    """
+
+    def __init__(self, path=None, max_bytes=0, cleanup_fraction=0.05, stats_flush_interval=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.cleanup_fraction = cleanup_fraction
+        self.stats_flush_interval = stats_flush_interval
+        self._lock = threading.Lock()
+        self._bytes_since_cleanup = 0
+        self._stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats():
+        return { 'hits': 0, 'misses': 0, 'bytes_served': 0, 'bytes_written': 0, 'evicted': 0 }
+
+    @property
+    def enabled(self):
+        return self.path is not None and self.max_bytes > 0
+
+    @staticmethod
+    def digest(key):
+        """The hash of a key that determines the filename of its entry"""
+        return hashlib.sha1(repr(key).encode('utf-8')).digest()
+
+    def get_filename(self, key, digest=None):
+        hexdigest = (digest or self.digest(key)).hex()
+        return os.path.join(self.path, hexdigest[:2], hexdigest[2:])
+
+    def get(self, key, digest=None):
+        """Get the bytes stored for a key, or None if they are not in the cache. The
+        digest of the key may be given instead of the key"""
+        if not self.enabled:
+            return None
+        fn = self.get_filename(key, digest)
+        try:
+            with open(fn, 'rb') as f:
+                data = f.read()
+            os.utime(fn)
+        except OSError:
+            self._count(misses=1)
+            return None
+        self._count(hits=1, bytes_served=len(data))
+        return data
+
+    def put(self, key, data, digest=None):
+        """Store the bytes for a key (or the digest of a key). Entries are immutable, 
+        so existing entries are only marked as recently used"""
+        if not self.enabled:
+            return
+        fn = self.get_filename(key, digest)
+        try:
+            os.utime(fn)
+            return
+        except OSError:
+            pass
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            fd, fn_tmp = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(fn_tmp, fn)
+        except OSError as e:
+            print(f'Failed to write to disk cache {fn}: {e}')
+            return
+        self._count(bytes_written=len(data))
+
+        # Check the size of the cache once enough data has been written by this process
+        with self._lock:
+            self._bytes_since_cleanup += len(data)
+            need_cleanup = self._bytes_since_cleanup > self.cleanup_fraction * self.max_bytes
+            if need_cleanup:
+                self._bytes_since_cleanup = 0
+        if need_cleanup:
+            self.cleanup()
+
+    def _count(self, **kwargs):
+        with self._lock:
+            for k, v in kwargs.items():
+                self._stats[k] += v
+            n_ops = self._stats['hits'] + self._stats['misses']
+            if n_ops < self.stats_flush_interval:
+                return
+            stats, self._stats = self._stats, self._empty_stats()
+        self._flush_stats(stats)
+
+    def _flush_stats(self, stats):
+        # Add the counters from this process to the shared stats file
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'stats.json'), 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                text = f.read()
+                total = json.loads(text) if text else self._empty_stats()
+                for k, v in stats.items():
+                    total[k] = total.get(k, 0) + v
+                f.seek(0)
+                f.truncate()
+                json.dump(total, f)
+        except (OSError, ValueError) as e:
+            print(f'Failed to update disk cache statistics: {e}')
+
+    def read_stats(self):
+        """Read the counters accumulated by all processes"""
+        try:
+            with open(os.path.join(self.path, 'stats.json'), 'r') as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return json.load(f)
+        except (OSError, ValueError):
+            return self._empty_stats()
+
+    def scan(self):
+        """Return a list of (mtime, size, filename) for all the entries in the cache"""
+        result = []
+        if self.path is None or not os.path.isdir(self.path):
+            return result
+        for entry in os.scandir(self.path):
+            if entry.is_dir() and len(entry.name) == 2:
+                for item in os.scandir(entry.path):
+                    if not item.name.startswith('.tmp'):
+                        try:
+                            st = item.stat()
+                            result.append((st.st_mtime, st.st_size, item.path))
+                        except OSError:
+                            pass
+        return result
+
+    def cleanup(self, target_fraction=0.9):
+        """Delete least recently used entries until the cache is below its budget"""
+        try:
+            with open(os.path.join(self.path, 'cleanup.lock'), 'w') as flock:
+                # Only one process needs to do the cleanup at a time
+                try:
+                    fcntl.flock(flock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                entries = self.scan()
+                total_bytes = sum(t[1] for t in entries)
+                if total_bytes <= self.max_bytes:
+                    return
+                heapq.heapify(entries)
+                n_evicted = 0
+                while total_bytes > target_fraction * self.max_bytes and len(entries) > 0:
+                    _, size, fn = heapq.heappop(entries)
+                    try:
+                        os.remove(fn)
+                        total_bytes -= size
+                        n_evicted += 1
+                    except OSError:
+                        pass
+                print(f'Disk cache {self.path}: evicted {n_evicted} entries, {total_bytes / 1024**2:.1f}MB in use')
+            self._count(evicted=n_evicted)
+        except OSError as e:
+            print(f'Failed to clean up disk cache {self.path}: {e}')
+
+    def purge(self, older_than=None):
+        """Delete all entries, or entries not accessed for older_than seconds"""
+        t_cutoff = time.time() - older_than if older_than is not None else None
+        n_deleted, n_bytes = 0, 0
+        for mtime, size, fn in self.scan():
+            if t_cutoff is None or mtime < t_cutoff:
+                try:
+                    os.remove(fn)
+                    n_deleted, n_bytes = n_deleted + 1, n_bytes + size
+                except OSError:
+                    pass
+        if t_cutoff is None and self.path is not None:
+            try:
+                os.remove(os.path.join(self.path, 'stats.json'))
+            except OSError:
+                pass
+        return n_deleted, n_bytes
+
+
+class WriteBehindDiskCache(LocalDiskCache):
+    """
+    A local disk cache whose entries are written by a background thread, so that the
+    threads that put entries, such as slide server threads that spill evicted pages while
+    serving tiles, never wait for the disk. Entries that are waiting to be written are
+    served from memory. At most max_pending entries wait to be written, and further
+    entries are dropped, since the cache only saves reading the data again.
+    """
+
+    def __init__(self, path=None, max_bytes=0, max_pending=256, **kwargs):
+        LocalDiskCache.__init__(self, path, max_bytes, **kwargs)
+        self.max_pending = max_pending
+        self.n_dropped = 0
+        self._pending = {}
+        self._queue_cond = threading.Condition()
+        self._writer = None
+
+    def get(self, key, digest=None):
+        digest = digest or self.digest(key)
+        with self._queue_cond:
+            data = self._pending.get(digest)
+        return data if data is not None else LocalDiskCache.get(self, key, digest)
+
+    def put(self, key, data, digest=None):
+        """Queue the bytes for a key (or the digest of a key) to be written"""
+        if not self.enabled:
+            return
+        digest = digest or self.digest(key)
+        with self._queue_cond:
+            if len(self._pending) >= self.max_pending:
+                self.n_dropped += 1
+                return
+            self._pending[digest] = data
+            
+            # The writer is started on first use, in the process that uses the cache
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, daemon=True)
+                self._writer.start()
+            self._queue_cond.notify()
+
+    def flush(self):
+        """Wait until all queued entries have been written"""
+        with self._queue_cond:
+            self._queue_cond.wait_for(lambda: len(self._pending) == 0)
+
+    def _run_writer(self):
+        while True:
+            with self._queue_cond:
+                self._queue_cond.wait_for(lambda: len(self._pending) > 0)
+                digest, data = next(iter(self._pending.items()))
+            try:
+                LocalDiskCache.put(self, None, data, digest=digest)
+            except Exception:
+                traceback.print_exc()
+            with self._queue_cond:
+                del self._pending[digest]
+                self._queue_cond.notify_all()
+
+
+class EncodedTileCache(LocalDiskCache):
+    """
+    A persistent cache of encoded DeepZoom tiles shared by all uwsgi processes. Slide
+    tiles never change for a given slide version, so the key of a tile includes the
+    slide URL, the version (blob generation or mtime) and all the parameters that
+    affect the encoded bytes.
+    """
+    pass
+
+
+# The encoded tile cache used by this process, configured in init_app
+encoded_tile_cache = EncodedTileCache()
+
+
+@click.command('tile-cache-info')
+@with_appcontext
+def tile_cache_info_command():
+    """Print the size and hit/miss statistics of the encoded tile cache"""
+    tc = encoded_tile_cache
+    tiles = tc.scan()
+    total_bytes = sum(t[1] for t in tiles)
+    stats = tc.read_stats()
+    n_lookups = stats['hits'] + stats['misses']
+    print(f'Encoded tile cache: {tc.path}')
+    print(f'  Enabled                : {tc.enabled}')
+    print(f'  Tiles                  : {len(tiles)}')
+    print(f'  Size (MB)              : {total_bytes / 1024**2:.2f} of {tc.max_bytes / 1024**2:.2f}')
+    print(f'  Hits                   : {stats["hits"]}')
+    print(f'  Misses                 : {stats["misses"]}')
+    print(f'  Hit rate               : {stats["hits"] / n_lookups if n_lookups > 0 else 0.0:.3f}')
+    print(f'  Served from cache (MB) : {stats["bytes_served"] / 1024**2:.2f}')
+    print(f'  Written to cache (MB)  : {stats["bytes_written"] / 1024**2:.2f}')
+    print(f'  Evicted tiles          : {stats["evicted"]}')
+
+
+@click.command('tile-cache-purge')
+@click.option('--older-than', type=float, default=None,
+              help='Only delete tiles that have not been accessed for this many days')
+@with_appcontext
+def tile_cache_purge_command(older_than):
+    """Delete tiles from the encoded tile cache"""
+    n_deleted, n_bytes = encoded_tile_cache.purge(
+        older_than * 86400 if older_than is not None else None)
+    print(f'Deleted {n_deleted} tiles ({n_bytes / 1024**2:.2f}MB)')
+
+
+def init_app(app):
+    encoded_tile_cache.path = app.config.get(
+        'DZI_TILE_CACHE_DIR', os.path.join(app.instance_path, 'tile_cache'))
+    encoded_tile_cache.max_bytes = int(app.config.get('DZI_TILE_CACHE_SIZE_MB', 0) * 1024**2)
+    app.cli.add_command(tile_cache_info_command)
+    app.cli.add_command(tile_cache_purge_command)
@@ -0,0 +1,90 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import queue
+import shutil
+import socketserver
+import tempfile
+import threading
+import urllib.parse
+import numpy as np
+import pytest
+import tifffile
+
+
+# Write a pyramidal TIFF slide stored as square JPEG tiles, with a full resolution level
+# and levels downsampled by 4 and 16, like a typical scanner slide
+def write_tiled_slide(path, width=1200, height=900, tile_size=256):
+    yy, xx = np.mgrid[0:height, 0:width]
+    img = np.stack([(xx // 7) % 256, (yy // 5) % 256, ((xx + yy) // 11) % 256], -1).astype(np.uint8)
+    opts = dict(tile=(tile_size, tile_size), compression='jpeg', photometric='rgb',
+                resolution=(40000, 40000), resolutionunit='CENTIMETER')
+    with tifffile.TiffWriter(path) as tw:
+        tw.write(img, description='Generic', **opts)
+        tw.write(img[::4, ::4].copy(), subfiletype=1, **opts)
+        tw.write(img[::16, ::16].copy(), subfiletype=1, **opts)
+    return path
+
+
+# A slide shared by all tests in the session
+@pytest.fixture(scope='session')
+def slide_tiff(tmp_path_factory):
+    return str(write_tiled_slide(tmp_path_factory.mktemp('slides') / 'slide.tiff'))
+
+
+# Application with its instance folder in a temporary directory
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('FLASK_INSTANCE_PATH', str(tmp_path / 'instance'))
+    from phas import create_app
+    return create_app({ 'TESTING': True })
+
+
+# A slide server worker running in a thread of the test process
+@pytest.fixture
+def slide_server():
+    from phas import dzi
+    path = tempfile.mkdtemp(prefix='phas')
+    addr = os.path.join(path, 'osl.sock')
+    server = socketserver.ThreadingUnixStreamServer(addr, dzi.OpenSlideConnectionHandler)
+    server.osl_handler = dzi.OpenSlideRequestHandler(0, queue.Queue(), 1, decode_threads=1, readahead=False)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield addr
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(path)
+
+
+# The application serving a copy of the test slide, which the tests may modify, with
+# the database lookups of the endpoints replaced by the slide's URL and the settings
+@pytest.fixture
+def slide_app(app, slide_server, slide_tiff, tmp_path, monkeypatch):
+    from phas import dzi
+    path = str(tmp_path / 'slide.tiff')
+    shutil.copy(slide_tiff, path)
+    url = 'file://' + urllib.parse.quote(path)
+    monkeypatch.setattr(dzi, 'get_slide_resource_url_cached', lambda project, slide_id, resource: url)
+    monkeypatch.setattr(dzi, 'get_tile_quality_settings', lambda project, task_id: { 'full': 75, 'low-zoom': 60 })
+    monkeypatch.setattr(dzi, 'dzi_get_project_and_slide_ref', lambda project, slide_id: (None, None))
+    monkeypatch.setattr(dzi, 'get_affine_matrix', lambda *args: None)
+    monkeypatch.setattr(dzi, 'get_osl', lambda slide_id, sr, resource='raw': 
+                        dzi.OpenSlideThinInterface(url, app.config['SLIDE_SERVER_ADDR']))
+    app.config['SLIDE_SERVER_ADDR'] = [ slide_server ]
+    app.slide_path = path
+    return app
@@ -0,0 +1,169 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import http.server
+import os
+import re
+import threading
+import urllib.parse
+
+import httpx
+import pytest
+
+from phas.gcs_handler import (HttpByteRangeSource, LocalFileByteRangeSource, RemoteOpenSlideWrapper,
+                              SelfManagedMultiFilePageCache, get_url_version, open_byte_range_source)
+
+
+class LocalRangeHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server on localhost that serves a single local file and supports single byte
+    range requests, so that the HTTP byte range source can be tested without a remote
+    server. With ranges=False, Range headers are ignored like by servers that don't 
+    support them. The server runs in a background thread once started.
+    """
+    
+    class RequestHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def do_HEAD(self):
+            self.send_file(False)
+            
+        def do_GET(self):
+            self.send_file(True)
+            
+        def log_message(self, format, *args):
+            pass
+            
+        def send_file(self, send_body):
+            path, st = self.server.path, os.stat(self.server.path)
+            if urllib.parse.unquote(self.path) != '/' + os.path.basename(path):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = 0, st.st_size - 1
+            m = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', '').strip())
+            if self.server.ranges and m and (m[1] or m[2]):
+                if m[1]:
+                    start, end = int(m[1]), min(int(m[2]), end) if m[2] else end
+                else:
+                    start = max(0, st.st_size - int(m[2]))
+                if start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{st.st_size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{st.st_size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes' if self.server.ranges else 'none')
+            self.send_header('ETag', f'"{st.st_mtime_ns:x}-{st.st_size:x}"')
+            self.end_headers()
+            if send_body:
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    self.wfile.write(f.read(end - start + 1))
+
+    def __init__(self, path, ranges=True):
+        self.path = path
+        self.ranges = ranges
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), self.RequestHandler)
+        
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/{urllib.parse.quote(os.path.basename(self.path))}'
+        
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+@pytest.fixture
+def range_server(slide_tiff):
+    server = LocalRangeHTTPServer(slide_tiff).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Random ranges across the file, including its first and last bytes
+def sample_ranges(size, n=50, seed=0):
+    import random
+    rng = random.Random(seed)
+    ranges = [ (0, 1), (size - 1, 1), (0, size) ]
+    for _ in range(n):
+        offset = rng.randrange(size)
+        ranges.append((offset, rng.randint(1, min(size - offset, 256 * 1024))))
+    return ranges
+
+
+def test_local_file_source(slide_tiff):
+    data = open(slide_tiff, 'rb').read()
+    src = open_byte_range_source('file://' + urllib.parse.quote(slide_tiff))
+    assert isinstance(src, LocalFileByteRangeSource)
+    assert src.size == len(data)
+    for offset, size in sample_ranges(src.size):
+        assert src.read_range(offset, size) == data[offset:offset+size]
+
+
+def test_local_path_is_not_a_source(slide_tiff):
+    assert open_byte_range_source(slide_tiff) is None
+
+
+def test_http_source(range_server, slide_tiff):
+    data = open(slide_tiff, 'rb').read()
+    with httpx.Client() as client:
+        src = open_byte_range_source(range_server.url, http_client=client)
+        assert isinstance(src, HttpByteRangeSource)
+        assert src.size == len(data)
+        for offset, size in sample_ranges(src.size):
+            assert src.read_range(offset, size) == data[offset:offset+size]
+
+
+def test_http_source_without_ranges_is_refused(range_server):
+    range_server.ranges = False
+    with pytest.raises(OSError):
+        HttpByteRangeSource(range_server.url)
+
+
+def test_http_source_that_stops_honoring_ranges(range_server):
+    src = HttpByteRangeSource(range_server.url)
+    range_server.ranges = False
+    with pytest.raises(OSError):
+        src.read_range(100, 10)
+
+
+def test_missing_http_file(range_server):
+    with pytest.raises(httpx.HTTPStatusError):
+        HttpByteRangeSource(range_server.url + '.missing')
+
+
+def test_url_version_matches_source_version(range_server, slide_tiff):
+    file_url = 'file://' + urllib.parse.quote(slide_tiff)
+    assert get_url_version(file_url) == open_byte_range_source(file_url).version
+    assert get_url_version(range_server.url) == HttpByteRangeSource(range_server.url).version
+    assert get_url_version(range_server.url + '.missing') is None
+
+
+def test_http_slide_matches_local_slide(range_server, slide_tiff):
+    from openslide import OpenSlide
+    osl = RemoteOpenSlideWrapper(HttpByteRangeSource(range_server.url), SelfManagedMultiFilePageCache(cache_max_size_mb=16))
+    assert tuple(osl.level_dimensions) == OpenSlide(slide_tiff).level_dimensions
@@ -0,0 +1,123 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import socketserver
+import pytest
+from phas.dzi import SlideServerConnectionPool, SlideServerError, send_message, recv_message
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    """
+    Answers each request on a connection with its value and the number of the
+    connection, after an optional delay, in the framing used by the slide server
+    """
+    def handle(self):
+        with self.server.count_lock:
+            self.server.n_connections += 1
+            self.server.connections.append(self.request)
+            conn_id = self.server.n_connections
+        try:
+            while True:
+                request = recv_message(self.request)
+                if request is None:
+                    return
+                time.sleep(request.get('delay', 0))
+                if request['command'] == 'fail':
+                    send_message(self.request, ('error', ('ValueError', 'bad request')))
+                else:
+                    send_message(self.request, ('ok', (request['value'], conn_id)))
+        except OSError:
+            # The client gave up on the connection
+            pass
+
+
+# Start a server on the given socket address
+def start_server(addr):
+    server = socketserver.ThreadingUnixStreamServer(addr, EchoHandler)
+    server.daemon_threads = True
+    server.n_connections, server.connections, server.count_lock = 0, [], threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Stop a server and close its open connections, like a worker that exits
+def stop_server(server):
+    server.shutdown()
+    for conn in server.connections:
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    server.server_close()
+    os.remove(server.server_address)
+
+
+@pytest.fixture
+def echo_addr():
+    path = tempfile.mkdtemp(prefix='phas')
+    yield os.path.join(path, 'echo.sock')
+    shutil.rmtree(path)
+
+
+def echo(pool, addr, value, delay=0):
+    return pool.execute(addr, { 'command': 'echo', 'value': value, 'delay': delay })
+
+
+# Requests reuse one pooled connection, and error responses leave it usable
+def test_connections_are_reused(echo_addr):
+    server = start_server(echo_addr)
+    pool = SlideServerConnectionPool()
+    assert [ echo(pool, echo_addr, i) for i in range(3) ] == [ (0, 1), (1, 1), (2, 1) ]
+    with pytest.raises(SlideServerError) as e:
+        pool.execute(echo_addr, { 'command': 'fail' })
+    assert e.value.error_type == 'ValueError'
+    assert echo(pool, echo_addr, 3) == (3, 1)
+    stop_server(server)
+
+
+# A request that times out is not retried and its connection is not pooled, so the
+# late response is never read as the response to the next request
+def test_timeout_discards_connection(echo_addr):
+    server = start_server(echo_addr)
+    pool = SlideServerConnectionPool(timeout=0.2)
+    assert echo(pool, echo_addr, 0) == (0, 1)
+    with pytest.raises(socket.timeout):
+        echo(pool, echo_addr, 1, delay=0.5)
+    assert pool._idle[echo_addr] == []
+    assert echo(pool, echo_addr, 2) == (2, 2)
+    stop_server(server)
+
+
+# A pooled connection to a server that has restarted is replaced by a new one, while
+# a server that cannot be reached raises an error
+def test_stale_connection_is_retried(echo_addr):
+    server = start_server(echo_addr)
+    pool = SlideServerConnectionPool()
+    assert echo(pool, echo_addr, 0) == (0, 1)
+    stop_server(server)
+    with pytest.raises(OSError):
+        echo(pool, echo_addr, 1)
+
+    server = start_server(echo_addr)
+    assert echo(pool, echo_addr, 2) == (2, 1)
+    stop_server(server)
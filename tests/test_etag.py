@@ -0,0 +1,93 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+
+from phas import dzi
+
+
+# Stop the slide server from being reached and forget what it described, so that any
+# slide I/O fails
+def disconnect_slide_server(app):
+    app.config['SLIDE_SERVER_ADDR'] = [ '/nonexistent/osl.sock' ]
+    dzi.slide_descriptor_cache._entries.clear()
+
+
+def get_tile(app, headers=None, method='GET', level=11, col=1, row=1, format='jpeg'):
+    with app.test_request_context('/', method=method, headers=headers or {}):
+        return dzi.tile_db.__wrapped__('raw', 'p', 1, 'raw', level, col, row, format)
+
+
+def get_dzi(app, headers=None, query=''):
+    with app.test_request_context('/' + query, headers=headers or {}):
+        return dzi.dzi.__wrapped__('raw', 'p', 1, 'raw')
+
+
+def get_header(app, headers=None):
+    with app.test_request_context('/', headers=headers or {}):
+        return dzi.dzi_download_header.__wrapped__('p', 1, 'raw')
+
+
+def test_tile_not_modified_without_slide_io(slide_app):
+    resp = get_tile(slide_app)
+    assert resp.status_code == 200 and resp.headers['ETag']
+    assert resp.headers['Cache-Control'] == slide_app.config['DZI_TILE_CACHE_CONTROL']
+    
+    disconnect_slide_server(slide_app)
+    resp_304 = get_tile(slide_app, { 'If-None-Match': resp.headers['ETag'] })
+    assert resp_304.status_code == 304
+    assert resp_304.headers['ETag'] == resp.headers['ETag']
+    assert 'Accept' in resp_304.vary
+
+
+def test_tile_etag_depends_on_request(slide_app):
+    etag = get_tile(slide_app).headers['ETag']
+    assert get_tile(slide_app, col=2).headers['ETag'] != etag
+    assert get_tile(slide_app, format='png').headers['ETag'] != etag
+    if 'webp' in dzi.tile_codecs:
+        assert get_tile(slide_app, { 'Accept': 'image/webp' }).headers['ETag'] != etag
+
+
+def test_tile_etag_changes_with_slide_version(slide_app):
+    etag = get_tile(slide_app).headers['ETag']
+    st = os.stat(slide_app.slide_path)
+    os.utime(slide_app.slide_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    resp = get_tile(slide_app, { 'If-None-Match': etag })
+    assert resp.status_code == 200 and resp.headers['ETag'] != etag
+
+
+def test_post_is_never_not_modified(slide_app):
+    etag = get_tile(slide_app).headers['ETag']
+    assert get_tile(slide_app, { 'If-None-Match': etag }, method='POST').status_code == 200
+    assert get_tile(slide_app, { 'If-None-Match': '"other"' }).status_code == 200
+
+
+def test_dzi_not_modified_without_slide_io(slide_app):
+    resp = get_dzi(slide_app, query='?format=png')
+    assert resp.status_code == 200 and b'Format="png"' in resp.get_data()
+    assert get_dzi(slide_app).headers['ETag'] != resp.headers['ETag']
+    
+    disconnect_slide_server(slide_app)
+    assert get_dzi(slide_app, { 'If-None-Match': resp.headers['ETag'] }, query='?format=png').status_code == 304
+
+
+def test_header_not_modified_without_slide_io(slide_app):
+    resp = get_header(slide_app)
+    assert resp.status_code == 200 and resp.headers['ETag']
+    
+    disconnect_slide_server(slide_app)
+    assert get_header(slide_app, { 'If-None-Match': resp.headers['ETag'] }).status_code == 304
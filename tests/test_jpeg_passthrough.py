@@ -0,0 +1,167 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import io
+import queue
+import urllib.parse
+
+import imagecodecs
+import numpy as np
+import pytest
+import tifffile
+from PIL import Image
+
+from phas.dzi import OpenSlideRequestHandler, is_passthrough_level
+from phas.gcs_handler import AbstractStreamOpenSlideWrapper
+
+
+# Split a JPEG stream into its marker segments, the last of which is the scan
+def jpeg_segments(data):
+    segments, i = [], 2
+    while data[i:i+2] != b'\xff\xda':
+        n = int.from_bytes(data[i+2:i+4], 'big')
+        segments.append(data[i:i+2+n])
+        i += 2 + n
+    return segments + [ data[i:] ]
+
+
+# Number the components of a frame or scan header 1, 2, 3 rather than 'R', 'G', 'B', 
+# which decoders would otherwise recognize as RGB without the APP14 marker
+def with_numeric_component_ids(segment):
+    segment = bytearray(segment)
+    if segment[:2] == b'\xff\xc0':
+        for i in range(3):
+            segment[10 + 3 * i] = i + 1
+    elif segment[:2] == b'\xff\xda':
+        for i in range(3):
+            segment[5 + 2 * i] = i + 1
+    return bytes(segment)
+
+
+# Write an RGB slide whose JPEG tiles share their quantization and Huffman tables in the
+# JPEGTables tag and have no APP14 marker, like the tiles written by some scanners
+@pytest.fixture(scope='module')
+def tables_tiff(tmp_path_factory):
+    img = np.random.default_rng(0).integers(0, 256, (512, 512, 3)).astype(np.uint8)
+    tiles, tables = [], None
+    for ty in range(2):
+        for tx in range(2):
+            jpeg = imagecodecs.jpeg8_encode(img[ty*256:(ty+1)*256, tx*256:(tx+1)*256], level=90,
+                                            colorspace='rgb', outcolorspace='rgb')
+            segments = [ with_numeric_component_ids(s) for s in jpeg_segments(jpeg) ]
+            tables = b'\xff\xd8' + b''.join(s for s in segments if s[:2] in (b'\xff\xdb', b'\xff\xc4')) + b'\xff\xd9'
+            tiles.append(b'\xff\xd8' + b''.join(s for s in segments if s[:2] not in (b'\xff\xdb', b'\xff\xc4', b'\xff\xee')))
+    path = str(tmp_path_factory.mktemp('slides') / 'tables.tiff')
+    with tifffile.TiffWriter(path) as tw:
+        tw.write(iter(tiles), shape=img.shape, dtype=np.uint8, tile=(256, 256), compression='jpeg', 
+                 photometric='rgb', compressionargs={ 'outcolorspace': 'rgb' }, 
+                 extratags=[(347, 7, len(tables), tables, True)])
+    return path
+
+
+# The stored bytes of a tile and the tile as decoded by tifffile
+def stored_tile(path, level, i_tile):
+    with tifffile.TiffFile(path) as tf:
+        page = [ p for p in tf.pages if p.is_tiled ][level]
+        tf.filehandle.seek(page.dataoffsets[i_tile])
+        data = tf.filehandle.read(page.databytecounts[i_tile])
+        return data, page.decode(data, i_tile, jpegtables=page.jpegtables)[0][0]
+
+
+@pytest.fixture
+def handler():
+    return OpenSlideRequestHandler(0, queue.Queue(), 1, decode_threads=1, readahead=False)
+
+
+def file_url(path):
+    return 'file://' + urllib.parse.quote(path)
+
+
+passthrough_params = { 'tile_size': 256, 'overlap': 0, 'limit_bounds': False }
+
+
+def test_standalone_tile_is_passed_through_unchanged(slide_tiff):
+    osl = AbstractStreamOpenSlideWrapper(open(slide_tiff, 'rb'))
+    assert osl.jpeg_tile_size == 256
+    data, _ = stored_tile(slide_tiff, 0, 6)
+    assert osl.read_raw_jpeg_tile(0, 1, 1) == data
+
+
+def test_jpeg_tables_are_merged_into_tile(tables_tiff):
+    osl = AbstractStreamOpenSlideWrapper(open(tables_tiff, 'rb'))
+    data, pixels = stored_tile(tables_tiff, 0, 3)
+    raw = osl.read_raw_jpeg_tile(0, 1, 1)
+    
+    # The scan of the stored tile is kept byte for byte, after the tables and the APP14
+    # marker, and the tile decodes to the same pixels as the stored tile with its tables
+    assert raw.startswith(b'\xff\xd8') and raw.endswith(data[2:])
+    assert b'\xff\xdb' in raw[:-len(data)] and b'\xff\xc4' in raw[:-len(data)]
+    assert np.array_equal(imagecodecs.jpeg8_decode(raw), pixels)
+
+
+def test_rgb_tile_gets_adobe_marker(tables_tiff):
+    osl = AbstractStreamOpenSlideWrapper(open(tables_tiff, 'rb'))
+    raw = osl.read_raw_jpeg_tile(0, 0, 1)
+    app14 = jpeg_segments(raw)[0]
+    assert app14[:2] == b'\xff\xee' and app14[4:9] == b'Adobe' and app14[-1] == 0
+    
+    # Browsers decode the tile as RGB rather than YCbCr
+    _, pixels = stored_tile(tables_tiff, 0, 2)
+    decoded = np.asarray(Image.open(io.BytesIO(raw)).convert('RGB')).astype(int)
+    assert np.abs(decoded - pixels).max() <= 2
+
+
+def test_dz_tiles_of_full_resolution_level_are_stored_tiles(handler, slide_tiff):
+    url = file_url(slide_tiff)
+    osl = AbstractStreamOpenSlideWrapper(open(slide_tiff, 'rb'))
+    desc = handler.describe(url)
+    assert desc['jpeg_tile_size'] == 256
+    
+    # The top DeepZoom level of the 1200x900 slide is level 0, whose interior tiles are
+    # sent as stored. Tiles cropped by the edge of the image are resampled
+    top = len(desc['dz_level_downsamples']) - 1
+    assert desc['dz_level_downsamples'][top] == 1
+    for col in range(4):
+        for row in range(3):
+            tile = handler.get_dz_tile(url, top, col, row, 'jpeg', 75, **passthrough_params)
+            assert tile == osl.read_raw_jpeg_tile(0, col, row)
+    edge = handler.get_dz_tile(url, top, 4, 3, 'jpeg', 75, **passthrough_params)
+    assert Image.open(io.BytesIO(edge)).size == (1200 - 1024, 900 - 768)
+
+
+def test_default_geometry_is_not_passed_through(handler, slide_tiff):
+    entry = handler.get_slide_cache_entry(file_url(slide_tiff))
+    dz = entry.get_dz_generator()
+    top = dz.level_count - 1
+    assert handler.get_passthrough_dz_tile(entry, dz, top, 1, 1) is None
+    assert handler.get_passthrough_dz_tile(entry, entry.get_dz_generator(**passthrough_params), 
+                                           top, 1, 1, **passthrough_params) is not None
+
+
+def test_passthrough_levels_match_slide_server(app, handler, slide_tiff):
+    class SlideDescriptor:
+        def describe(self):
+            return handler.describe(file_url(slide_tiff))
+        
+    osa = SlideDescriptor()
+    downsamples = osa.describe()['dz_level_downsamples']
+    with app.app_context():
+        decisions = [ is_passthrough_level(osa, level, passthrough_params) for level in range(len(downsamples)) ]
+        assert decisions == [ ds == 1 for ds in downsamples ]
+        assert not is_passthrough_level(osa, len(downsamples) - 1, { 'tile_size': 254, 'overlap': 1, 'limit_bounds': False })
+        app.config['SLIDE_SERVER_JPEG_PASSTHROUGH'] = False
+        assert not is_passthrough_level(osa, len(downsamples) - 1, passthrough_params)
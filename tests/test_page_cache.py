@@ -0,0 +1,151 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import threading
+from phas.gcs_handler import SharedSlabPageCache, SelfManagedMultiFilePageCache
+from phas.tile_cache import WriteBehindDiskCache
+
+MB = 1024**2
+URL = 'gs://bucket/slide.svs'
+
+
+# Contents of a test page
+def page_data(pageno, size=MB):
+    return bytes([pageno % 251]) * (size - 1) + b'\xff'
+
+
+# A slab holding n_pages pages of 1MB, divided into 256K units
+def make_slab(n_pages=8, ways=2, unit_size=256*1024, **kwargs):
+    buf = bytearray(SharedSlabPageCache.slab_size(1, n_pages, unit_size))
+    locks = [ threading.Lock() for _ in range(4) ]
+    return SharedSlabPageCache(buf, locks, 1, ways=ways, unit_size=unit_size, **kwargs)
+
+
+# Pages are read back whole or in part, and pages are only stored once
+def test_slab_get_set():
+    slab = make_slab()
+    assert slab.get_page(URL, 0) is None
+    assert slab.set_page(URL, 0, page_data(0)) is not None
+    assert slab.set_page(URL, 0, page_data(1)) is None
+    assert slab.get_page(URL, 0).data == page_data(0)
+    assert slab.touch_page(URL, 0) and not slab.touch_page(URL, 1)
+
+    dest = bytearray(16)
+    assert slab.copy_page(URL, 0, MB - 8, 16, dest, 4) == 8
+    assert bytes(dest[4:12]) == page_data(0)[-8:]
+    assert slab.copy_page(URL, 1, 0, 16, dest, 0) is None
+
+
+# Short pages, such as the last page of a file, only take the units they need
+def test_slab_short_pages():
+    slab = make_slab()
+    assert slab.usage() == (0, 32)
+    slab.set_page(URL, 0, page_data(0, 1000))
+    slab.set_page(URL, 1, page_data(1, 300 * 1024))
+    assert slab.usage() == (3, 32)
+    assert slab.get_page(URL, 0).data == page_data(0, 1000)
+    assert slab.get_page(URL, 1).data == page_data(1, 300 * 1024)
+
+
+# Every page that is replaced in the slab is spilled to the disk tier, so every page
+# that was stored can still be read from one of the two tiers
+def test_slab_spills_replaced_pages(tmp_path):
+    slab = make_slab()
+    slab.l2 = WriteBehindDiskCache(str(tmp_path), 1024 * MB)
+    for pageno in range(24):
+        slab.set_page(URL, pageno, page_data(pageno))
+    slab.l2.flush()
+
+    in_slab = [ p for p in range(24) if slab.touch_page(URL, p) ]
+    assert len(in_slab) == 8
+    assert len(slab.l2.scan()) == 16
+    for pageno in range(24):
+        page = slab.get_page(URL, pageno)
+        data = page.data if page is not None else slab.l2.get(slab.l2_key(URL, pageno))
+        assert data == page_data(pageno)
+
+    # All the pages were replaced right after being written
+    assert slab.hot_replacements() == 16
+
+
+# Entries waiting to be written are served from memory, entries beyond max_pending are
+# dropped, and flush waits until the queued entries are on disk
+def test_write_behind(tmp_path):
+    cache = WriteBehindDiskCache(str(tmp_path), 1024 * MB, max_pending=2)
+
+    # Holding the lock keeps the writer from taking entries off the queue
+    with cache._queue_cond:
+        for i in range(3):
+            cache.put(('key', i), page_data(i, 1000))
+        assert cache.n_dropped == 1
+        assert cache.get(('key', 0)) == page_data(0, 1000)
+        assert not os.path.exists(cache.get_filename(('key', 0)))
+    cache.flush()
+    assert os.path.exists(cache.get_filename(('key', 0)))
+    assert cache.get(('key', 1)) == page_data(1, 1000)
+    assert cache.get(('key', 2)) is None
+
+
+# A disabled write-behind cache queues nothing
+def test_write_behind_disabled():
+    cache = WriteBehindDiskCache()
+    cache.put(('key', 0), b'data')
+    cache.flush()
+    assert cache.get(('key', 0)) is None and cache._writer is None
+
+
+# Pages that are cached in a self-managed cache, in LRU order
+def cached_pages(cache):
+    return [ p for (url, p) in cache.lru ]
+
+
+# When the cache is full the least recently used pages are evicted until the given
+# fraction of the cache is free, and reading a page makes it the most recently used
+def test_self_managed_lru(tmp_path):
+    cache = SelfManagedMultiFilePageCache(1, cache_max_size_mb=8, purge_size_pct=0.25)
+    for pageno in range(7):
+        cache.set_page(URL, pageno, page_data(pageno))
+    assert cache.get_page(URL, 0).data == page_data(0)
+    assert cached_pages(cache) == [1, 2, 3, 4, 5, 6, 0]
+
+    cache.l2 = WriteBehindDiskCache(str(tmp_path), 1024 * MB)
+    cache.set_page(URL, 7, page_data(7))
+    assert cached_pages(cache) == [3, 4, 5, 6, 0, 7]
+    assert cache.total_size == 6 * MB
+    cache.l2.flush()
+    assert cache.l2.get(cache.l2_key(URL, 1)) == page_data(1)
+
+
+# Purging removes the pages not accessed since a given time, and pages of a file or
+# specific pages can be evicted
+def test_self_managed_purge_and_evict():
+    cache = SelfManagedMultiFilePageCache(1, cache_max_size_mb=64)
+    for pageno in range(4):
+        cache.set_page(URL, pageno, page_data(pageno, 1000))
+        cache.set_page('other', pageno, page_data(pageno, 1000))
+    t_purge = cache.get_page(URL, 3).t_access
+    cache.get_page('other', 3)
+    cache.purge(t_purge)
+    assert sorted(cache.lru) == [(URL, 3), ('other', 3)]
+
+    # Pages accessed after the eviction decision are kept
+    page = cache.get_page(URL, 3)
+    assert cache.evict_pages([(URL, 3, page.t_access - 1)]) == 0
+    assert cache.purge_file('other') == 1
+    assert cache.evict_pages([(URL, 3, page.t_access)]) == 1
+    assert cache.cache == {} and len(cache.lru) == 0 and cache.total_size == 0
@@ -0,0 +1,76 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import time
+import threading
+import concurrent.futures
+import pytest
+from phas.dzi import SingleFlight
+
+
+# Run n calls for the same key while the first one is blocked, and release it once
+# the others are waiting for it. Returns the futures of the calls and the number of
+# times the computation ran
+def run_overlapping(sf, n, outcome):
+    started, release, n_runs = threading.Event(), threading.Event(), []
+
+    def compute():
+        n_runs.append(1)
+        started.set()
+        release.wait(10)
+        return outcome()
+
+    with concurrent.futures.ThreadPoolExecutor(n) as pool:
+        futures = [ pool.submit(sf.do, 'key', compute) ]
+        started.wait(10)
+        futures += [ pool.submit(sf.do, 'key', compute) for _ in range(n - 1) ]
+        t_end = time.time() + 10
+        while sf.n_coalesced < n - 1 and time.time() < t_end:
+            time.sleep(0.001)
+        release.set()
+        concurrent.futures.wait(futures)
+    return futures, len(n_runs)
+
+
+# Overlapping calls share the result of one computation
+def test_calls_are_coalesced():
+    sf = SingleFlight()
+    result = object()
+    futures, n_runs = run_overlapping(sf, 8, lambda: result)
+    assert n_runs == 1 and sf.n_coalesced == 7
+    assert all(f.result() is result for f in futures)
+
+
+# The exception of the computation is raised in all the waiting callers
+def test_exceptions_are_shared():
+    def fail():
+        raise ValueError('bad tile')
+    futures, n_runs = run_overlapping(SingleFlight(), 4, fail)
+    assert n_runs == 1
+    for f in futures:
+        with pytest.raises(ValueError, match='bad tile'):
+            f.result()
+
+
+# Nothing is kept once a computation completes, and different keys never wait for
+# each other
+def test_completed_calls_are_not_cached():
+    sf = SingleFlight()
+    assert sf.do('key', lambda: 1) == 1
+    assert sf.do('key', lambda: 2) == 2
+    assert sf.do('other', lambda: sf.do('key', lambda: 3)) == 3
+    assert sf.n_coalesced == 0 and sf._calls == {}
@@ -0,0 +1,77 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import numpy as np
+import openslide
+import tifffile
+from phas.slide_levels import plan_synthetic_levels, build_synthetic_levels, \
+    synthetic_levels_path, load_synthetic_levels_manifest, SYNTHETIC_LEVELS_MANIFEST
+
+
+# A pyramid without gaps larger than max_ratio and a small coarsest level needs nothing
+def test_plan_complete_pyramid():
+    assert plan_synthetic_levels([(1200, 900), (300, 225), (75, 57)]) == []
+
+
+# A 16x gap is filled by halving until it is at most 2x, and the coarsest level is
+# halved until it fits in min_size, with dimensions rounded up like DeepZoom
+def test_plan_fills_gaps():
+    plan = plan_synthetic_levels([(40000, 30000), (2500, 1875)], max_ratio=4.0, min_size=1024)
+    assert plan == [
+        (0, 1, (20000, 15000)), (0, 2, (10000, 7500)), (0, 3, (5000, 3750)),
+        (1, 1, (1250, 938)), (1, 2, (625, 469))]
+
+
+# A single level slide is halved down to min_size
+def test_plan_single_level():
+    plan = plan_synthetic_levels([(5000, 100)], min_size=1024)
+    assert [d for (i, k, d) in plan] == [(2500, 50), (1250, 25), (625, 13)]
+    assert all(i == 0 for (i, k, d) in plan)
+
+
+# Built levels are written with the planned dimensions and a manifest, and look like
+# the slide level they are derived from
+def test_build_synthetic_levels(slide_tiff, tmp_path):
+    osl = openslide.OpenSlide(slide_tiff)
+    plan = plan_synthetic_levels(osl.level_dimensions, max_ratio=2.0, min_size=64)
+    assert plan == [(0, 1, (600, 450)), (1, 1, (150, 113)), (2, 1, (38, 29))]
+
+    levels_dir = str(tmp_path / 'levels')
+    assert load_synthetic_levels_manifest(levels_dir, 'slide', 'v1') is None
+    path = synthetic_levels_path(levels_dir, 'slide', 'v1')
+    manifest = build_synthetic_levels(osl, path, plan, tile_size=128, metadata={ 'version': 'v1' })
+    assert load_synthetic_levels_manifest(levels_dir, 'slide', 'v1') == manifest
+    assert load_synthetic_levels_manifest(levels_dir, 'slide', 'v2') is None
+    assert manifest['version'] == 'v1'
+    assert manifest['level_dimensions'] == [list(d) for d in osl.level_dimensions]
+    assert sorted(os.listdir(path)) == sorted([SYNTHETIC_LEVELS_MANIFEST, 'level_00.tiff', 'level_01.tiff', 'level_02.tiff'])
+
+    for entry, (i, k, dims) in zip(manifest['levels'], plan):
+        assert entry['source_level'] == i and entry['dimensions'] == list(dims)
+        img = tifffile.imread(os.path.join(path, entry['file']))
+        assert img.shape == (dims[1], dims[0], 3)
+
+    # The 2x level should match the full resolution level downsampled by 2
+    img = tifffile.imread(os.path.join(path, 'level_00.tiff')).astype(float)
+    ref = np.asarray(osl.read_region((0, 0), 0, osl.level_dimensions[0]).convert('RGB').resize((600, 450)))
+    assert np.mean(np.abs(img - ref)) < 8
+
+    # A rebuild replaces the previous levels and leaves no temporary directories
+    build_synthetic_levels(osl, path, plan[:1], tile_size=128)
+    assert sorted(os.listdir(path)) == sorted([SYNTHETIC_LEVELS_MANIFEST, 'level_00.tiff'])
+    assert os.listdir(levels_dir) == [os.path.basename(path)]
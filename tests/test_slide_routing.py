@@ -0,0 +1,60 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+from collections import Counter
+from phas.dzi import slide_server_route
+
+
+# Socket addresses of n slide server workers in the given directory
+def worker_addrs(n, sock_dir='/tmp/phas'):
+    return [ f'{sock_dir}/oslserver_{i:02d}.sock' for i in range(n) ]
+
+
+URLS = [ f'gs://bucket/project/slide_{i:04d}.svs' for i in range(2000) ]
+
+
+# The same slide is always routed to the same worker, whatever the order of the workers
+def test_route_is_stable():
+    addrs = worker_addrs(4)
+    for url in URLS[:100]:
+        worker = slide_server_route(url, addrs)
+        assert worker in addrs
+        assert slide_server_route(url, list(reversed(addrs))) == worker
+
+
+# The route depends on the worker socket names, not on the directory they are in
+def test_route_ignores_socket_dir():
+    for url in URLS[:100]:
+        a = slide_server_route(url, worker_addrs(4, '/tmp/a'))
+        b = slide_server_route(url, worker_addrs(4, '/var/run/b'))
+        assert a.split('/')[-1] == b.split('/')[-1]
+
+
+# Slides are spread about evenly over the workers
+def test_route_balances_load():
+    load = Counter(slide_server_route(url, worker_addrs(4)) for url in URLS)
+    assert len(load) == 4
+    assert min(load.values()) > 0.8 * len(URLS) / 4
+
+
+# Adding a fifth worker only moves slides to the new worker, about a fifth of them
+def test_route_minimal_movement():
+    before = { url: slide_server_route(url, worker_addrs(4)) for url in URLS }
+    after = { url: slide_server_route(url, worker_addrs(5)) for url in URLS }
+    moved = [ url for url in URLS if before[url] != after[url] ]
+    assert all(after[url] == worker_addrs(5)[4] for url in moved)
+    assert 0.1 * len(URLS) < len(moved) < 0.3 * len(URLS)
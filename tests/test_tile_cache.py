@@ -0,0 +1,96 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import os
+import time
+from phas.tile_cache import LocalDiskCache
+
+
+# Key of the i-th test entry and its bytes
+def entry(i, size=1000):
+    return ('gs://bucket/slide.svs', 'v1', i), bytes([i % 256]) * size
+
+
+# Set the access time of an entry to the given number of seconds in the past
+def age(cache, key, seconds):
+    t = time.time() - seconds
+    os.utime(cache.get_filename(key), (t, t))
+
+
+# A cache without a directory or budget stores nothing
+def test_disabled(tmp_path):
+    for cache in (LocalDiskCache(), LocalDiskCache(str(tmp_path), 0)):
+        key, data = entry(0)
+        cache.put(key, data)
+        assert cache.get(key) is None
+    assert os.listdir(tmp_path) == []
+
+
+# Entries are read back by key or by digest, and misses return None
+def test_get_put(tmp_path):
+    cache = LocalDiskCache(str(tmp_path), 1024**2)
+    key, data = entry(1)
+    assert cache.get(key) is None
+    cache.put(key, data)
+    assert cache.get(key) == data
+    assert cache.get(None, digest=cache.digest(key)) == data
+    assert cache.get(entry(2)[0]) is None
+    assert [os.path.basename(fn) for (_, _, fn) in cache.scan()] == [cache.digest(key).hex()[2:]]
+
+
+# When the budget is exceeded the least recently used entries are deleted until the
+# cache is below 90% of the budget, and entries that were read count as recently used
+def test_lru_eviction(tmp_path):
+    cache = LocalDiskCache(str(tmp_path), 10000, stats_flush_interval=1)
+    for i in range(10):
+        cache.put(*entry(i))
+        age(cache, entry(i)[0], 1000 - i)
+    assert len(cache.scan()) == 10
+
+    assert cache.get(entry(0)[0]) is not None
+    cache.put(*entry(10))
+    kept = [ i for i in range(11) if os.path.exists(cache.get_filename(entry(i)[0])) ]
+    assert kept == [0] + list(range(3, 11))
+
+    # Counters are added to the stats file with the next lookup
+    cache.get(entry(0)[0])
+    assert cache.read_stats()['evicted'] == 2
+
+
+# Hits, misses and bytes are accumulated in the shared stats file
+def test_stats(tmp_path):
+    cache = LocalDiskCache(str(tmp_path), 1024**2, stats_flush_interval=1)
+    key, data = entry(1)
+    cache.get(key)
+    cache.put(key, data)
+    cache.get(key)
+    cache.get(key)
+    stats = LocalDiskCache(str(tmp_path)).read_stats()
+    assert stats['hits'] == 2 and stats['misses'] == 1
+    assert stats['bytes_served'] == 2 * len(data) and stats['bytes_written'] == len(data)
+
+
+# Purge deletes all entries, or only those not accessed for a given time
+def test_purge(tmp_path):
+    cache = LocalDiskCache(str(tmp_path), 1024**2)
+    for i in range(4):
+        cache.put(*entry(i))
+    age(cache, entry(0)[0], 3600)
+    assert cache.purge(older_than=60) == (1, 1000)
+    assert cache.get(entry(0)[0]) is None and cache.get(entry(1)[0]) is not None
+    assert cache.purge() == (3, 3000)
+    assert cache.scan() == []
@@ -0,0 +1,80 @@
+#
+#   PICSL Histology Annotator
+#   Copyright (C) 2019 Paul A. Yushkevich
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import io
+import pytest
+from PIL import Image
+from phas import dzi
+
+needs_webp = pytest.mark.skipif('webp' not in dzi.tile_codecs, reason='Pillow is built without WebP')
+
+
+# Format negotiated for a tile requested with the given Accept header
+def negotiate(app, accept, format='jpeg', passthrough=False):
+    with app.test_request_context('/', headers={ 'Accept': accept } if accept else {}):
+        return dzi.negotiate_tile_format(format, passthrough)
+
+
+# Browsers that do not list WebP explicitly get JPEG, even if they accept anything
+@needs_webp
+def test_negotiate_webp(app):
+    assert negotiate(app, 'image/avif,image/webp,*/*') == 'webp'
+    assert negotiate(app, 'image/webp;q=0,*/*') == 'jpeg'
+    assert negotiate(app, '*/*') == 'jpeg'
+    assert negotiate(app, None) == 'jpeg'
+
+
+# Only JPEG tiles are negotiated, and passed through tiles stay JPEG unless configured
+@needs_webp
+def test_negotiate_only_lossy_tiles(app):
+    assert negotiate(app, 'image/webp', format='png') == 'png'
+    assert negotiate(app, 'image/webp', passthrough=True) == 'jpeg'
+    app.config['DZI_TILE_NEGOTIATE_PASSTHROUGH'] = True
+    assert negotiate(app, 'image/webp', passthrough=True) == 'webp'
+
+
+# Formats are tried in the configured order, skipping those Pillow cannot encode
+@needs_webp
+def test_negotiate_order(app, monkeypatch):
+    app.config['DZI_TILE_NEGOTIATE_FORMATS'] = []
+    assert negotiate(app, 'image/webp') == 'jpeg'
+    app.config['DZI_TILE_NEGOTIATE_FORMATS'] = ['avif', 'webp']
+    monkeypatch.setattr(dzi, 'tile_codecs', ['jpeg', 'png', 'webp'])
+    assert negotiate(app, 'image/avif,image/webp') == 'webp'
+    monkeypatch.setattr(dzi, 'tile_codecs', ['jpeg', 'png', 'webp', 'avif'])
+    assert negotiate(app, 'image/avif,image/webp') == 'avif'
+
+
+# Tile of the test slide requested with the given Accept header
+def get_tile(app, accept):
+    with app.test_request_context('/', headers={ 'Accept': accept }):
+        return dzi.tile_db.__wrapped__('raw', 'p', 1, 'raw', 11, 1, 1, 'jpeg')
+
+
+# The tile endpoint sends the negotiated codec with a matching content type, and the
+# stored JPEG tiles that are passed through stay JPEG
+@needs_webp
+def test_tile_endpoint_sends_webp(slide_app):
+    resp = get_tile(slide_app, 'image/webp')
+    assert resp.mimetype == 'image/jpeg' and 'Accept' in resp.vary
+
+    slide_app.config['SLIDE_SERVER_JPEG_PASSTHROUGH'] = False
+    for accept, mimetype, pil_format in (('image/webp', 'image/webp', 'WEBP'), ('*/*', 'image/jpeg', 'JPEG')):
+        resp = get_tile(slide_app, accept)
+        assert resp.status_code == 200 and resp.mimetype == mimetype
+        assert 'Accept' in resp.vary
+        assert Image.open(io.BytesIO(resp.get_data())).format == pil_format